@@ -0,0 +1,97 @@
+#!/bin/env python3
+""" Replays requests recorded by pybloob_corpus through the Utils and Cores, comparing this build with the one they were
+recorded on: how long each stage takes now against how long it took then, and which requests are now heard, routed or
+answered differently.
+
+As with pipeline_benchmark (whose PipelineDriver does the work), the Utils and Cores need to be running. Requests are
+sent at the pace they were recorded at, sped up --speed times, with gaps longer than --max-gap seconds cut short.
+--speed 0 sends each as soon as the last's finished.
+
+Run with: python src/benchmarks/corpus_replay.py --device-id test --speed 0
+"""
+import argparse
+import json
+import sys
+import time
+
+import pybloob
+import pybloob_corpus
+from pipeline_benchmark import PipelineDriver, StageTimeout, formatStageReport, stageReport, stages
+
+# Replayed stage -> the span that timed it when it was recorded
+recorded_stages = {"stt": "transcribe", "intent_parse": "intent_parse", "core": "core", "tts": "tts", "playback": "playback"}
+
+if __name__ == "__main__":
+  arg_parser = argparse.ArgumentParser()
+  arg_parser.add_argument('--host', default="localhost")
+  arg_parser.add_argument('--port', default=1883, type=int)
+  arg_parser.add_argument('--user')
+  arg_parser.add_argument('--pass')
+  arg_parser.add_argument('--device-id', default="test")
+  arg_parser.add_argument('--path', default=str(pybloob_corpus.default_corpus_path), help="Directory the corpus was recorded to")
+  arg_parser.add_argument('--speed', default=0, type=float, help="How many times faster than recorded to send requests, or 0 for back to back")
+  arg_parser.add_argument('--max-gap', default=10, type=float, help="Most seconds (before speeding up) to wait between requests")
+  arg_parser.add_argument('--limit', type=int, help="Only replay the most recent this many requests")
+  arg_parser.add_argument('--timeout', default=30, type=float, help="Seconds to wait for any one stage")
+  arg_parser.add_argument('--json', action="store_true", help="Print the results as JSON")
+  arguments = arg_parser.parse_args()
+
+  corpus = pybloob_corpus.Corpus(arguments.path)
+  entries = corpus.entries[-arguments.limit:] if arguments.limit != None else corpus.entries
+  if len(entries) == 0:
+    sys.exit(f"There's nothing recorded in {corpus.path}, run src/pybloob/pybloob_corpus.py to record some requests")
+
+  client = pybloob.createMqttClient()
+  if arguments.user != None:
+    client.username_pw_set(arguments.user, arguments.__dict__.get("pass"))
+  client.connect(arguments.host, arguments.port)
+  driver = PipelineDriver(client, arguments.device_id, arguments.timeout)
+  client.loop_start()
+
+  results = {stage: [] for stage in stages}
+  recorded_results = {stage: [] for stage in stages}
+  # (entry, what changed, what it was, what it is now)
+  differences = []
+  failures = 0
+  # Where the replay is, in the recording's time
+  replay_time = entries[0]["time"]
+  replay_start = time.monotonic()
+  for entry in entries:
+    if arguments.speed > 0:
+      replay_time += min(entry["time"] - replay_time, arguments.max_gap)
+      time.sleep(max(replay_start + (replay_time - entries[0]["time"]) / arguments.speed - time.monotonic(), 0))
+
+    try:
+      latencies, heard, answer = driver.run(corpus.audio(entry))
+    except StageTimeout as e:
+      print(f"{entry['id']}: {e}", file=sys.stderr)
+      failures += 1
+      continue
+    for stage, seconds in latencies.items():
+      results[stage].append(seconds)
+    recorded_latencies = {stage: entry["timings"][span_name] for stage, span_name in recorded_stages.items() if entry["timings"].get(span_name) != None}
+    for stage, seconds in recorded_latencies.items():
+      recorded_results[stage].append(seconds)
+    # Recorded requests' times are taken from the wakeword, so totals are compared by adding up the stages instead
+    if len(recorded_latencies) == len(recorded_stages):
+      recorded_results["total"].append(sum(recorded_latencies.values()))
+
+    if heard != entry["transcript"]:
+      differences.append((entry, "transcript", entry["transcript"], heard))
+    elif answer != entry["output"]:
+      differences.append((entry, "output", entry["output"], answer))
+
+  if len(results["stt"]) == 0:
+    sys.exit("No requests made it through")
+
+  if arguments.json:
+    print(json.dumps({"requests": len(results["stt"]), "failures": failures, "stages": stageReport(results), "recorded_stages": stageReport(recorded_results), "differences": [{"id": entry["id"], "field": field, "recorded": recorded, "replayed": replayed} for entry, field, recorded, replayed in differences]}))
+  else:
+    print("Replayed:")
+    print(formatStageReport(stageReport(results)))
+    print("Recorded:")
+    print(formatStageReport(stageReport(recorded_results)))
+    for entry, field, recorded, replayed in differences:
+      print(f"{entry['id']}: {field} was \"{recorded}\", now \"{replayed}\"")
+    print(f"{len(results['stt'])} requests replayed, {len(differences)} heard or answered differently, {failures} failed")
+  client.loop_stop()
@@ -0,0 +1,106 @@
+#!/bin/env python3
+""" Micro-benchmark for pybloob's device / text matching
+
+Compares the old per-name substring search that getDeviceMatches used to do against a prebuilt pybloob.Matcher,
+with thousands of synthetic device aliases (like a house full of WLED / Tasmota devices would have)
+
+Run with: python src/benchmarks/matcher_benchmark.py --devices 1000 --aliases 3
+"""
+import argparse
+import random
+import time
+
+import pybloob
+
+rooms = ["kitchen", "living room", "bedroom", "bathroom", "hallway", "office", "garage", "garden", "attic", "landing", "porch", "dining room", "study", "nursery", "utility room"]
+things = ["light", "lamp", "strip", "bulb", "spotlight", "fan", "heater", "plug", "tv", "speaker", "switch", "ceiling light", "desk lamp", "fairy lights", "led"]
+describers = ["big", "small", "left", "right", "upper", "lower", "front", "back", "corner", "main", "second", "old", "new", "blue", "warm"]
+utterance_fillers = ["turn", "the", "on", "off", "and", "set", "to", "please", "make", "red", "percent", "50"]
+
+class BenchmarkDevice:
+  def __init__(self, names):
+    self.names = names
+    self.friendly_name = names[0]
+
+# How getDeviceMatches used to work, kept here for comparison
+def legacyGetDeviceMatches(device_list, check_string):
+  check_string = check_string.lower()
+  name_matches = []
+  device_matches = []
+  for device in device_list:
+    for name in device.names:
+      if name.lower() in check_string:
+        name_matches.append(name)
+  name_matches.sort(key=lambda name: check_string.find(name.lower()))
+  for name in name_matches:
+    for device in device_list:
+      if name in device.names:
+        device_matches.append(device)
+  return(device_matches)
+
+def makeDevices(device_count: int, aliases_per_device: int):
+  devices = []
+  used_names = set()
+  for device_number in range(device_count):
+    names = []
+    while len(names) < aliases_per_device:
+      name = f"{random.choice(describers)} {random.choice(rooms)} {random.choice(things)} {device_number}"
+      if name not in used_names:
+        used_names.add(name)
+        names.append(name)
+    devices.append(BenchmarkDevice(names))
+  return devices
+
+def makeUtterances(devices: list, utterance_count: int):
+  utterances = []
+  for _ in range(utterance_count):
+    mentioned = [random.choice(random.choice(devices).names) for _ in range(random.randint(1, 3))]
+    words = []
+    for name in mentioned:
+      words += random.sample(utterance_fillers, 3) + [name]
+    utterances.append(" ".join(words))
+  return utterances
+
+def timePerCall(function, utterances: list, repeats: int):
+  start = time.perf_counter()
+  for _ in range(repeats):
+    for utterance in utterances:
+      function(utterance)
+  return (time.perf_counter() - start) / (repeats * len(utterances))
+
+if __name__ == "__main__":
+  arg_parser = argparse.ArgumentParser()
+  arg_parser.add_argument("--devices", default=1000, type=int)
+  arg_parser.add_argument("--aliases", default=3, type=int)
+  arg_parser.add_argument("--utterances", default=200, type=int)
+  arg_parser.add_argument("--repeats", default=5, type=int)
+  arg_parser.add_argument("--seed", default=0, type=int)
+  arguments = arg_parser.parse_args()
+
+  random.seed(arguments.seed)
+  devices = makeDevices(arguments.devices, arguments.aliases)
+  utterances = makeUtterances(devices, arguments.utterances)
+
+  start = time.perf_counter()
+  matcher = pybloob.Matcher.fromDevices(devices)
+  matcher.find("")
+  build_time = time.perf_counter() - start
+
+  # Both should agree (besides the legacy version repeating devices that had several of their names matched)
+  for utterance in utterances:
+    legacy_devices = list(dict.fromkeys(legacyGetDeviceMatches(devices, utterance)))
+    matcher_devices = list(dict.fromkeys(matcher.match(utterance)))
+    assert legacy_devices == matcher_devices, f"Results differ for \"{utterance}\""
+
+  legacy_time = timePerCall(lambda utterance: legacyGetDeviceMatches(devices, utterance), utterances, arguments.repeats)
+  matcher_time = timePerCall(matcher.match, utterances, arguments.repeats)
+  # The first call builds the Matcher, which is what getDeviceMatches then reuses
+  pybloob.getDeviceMatches(devices, "")
+  cached_time = timePerCall(lambda utterance: pybloob.getDeviceMatches(devices, utterance), utterances, arguments.repeats)
+
+  print(f"{arguments.devices} devices, {arguments.devices * arguments.aliases} aliases, {arguments.utterances} utterances")
+  print(f"Matcher build time:             {build_time * 1000:10.2f} ms (once)")
+  print(f"Legacy getDeviceMatches:        {legacy_time * 1000000:10.1f} us per call")
+  print(f"Prebuilt Matcher.match:         {matcher_time * 1000000:10.1f} us per call")
+  print(f"getDeviceMatches (cached):      {cached_time * 1000000:10.1f} us per call")
+  print(f"Speedup (prebuilt vs legacy):   {legacy_time / matcher_time:10.1f}x")
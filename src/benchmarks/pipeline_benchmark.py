@@ -0,0 +1,177 @@
+#!/bin/env python3
+""" End-to-end latency benchmark for the voice pipeline, from a finished recording to its answer starting to play
+
+Sends WAV fixtures through the STT, Intent Parser, whichever Core the Intent Parser picks, TTS and Audio Playback, as if
+the Audio Recorder had just recorded them, passing each stage's output on to the next just as the Orchestrator does.
+Reports latency percentiles for each stage and for the whole thing, against the target of answering within 1.5 s.
+
+The Utils and Cores need to be running (starting the Orchestrator does this, and it ignores these requests, since
+they don't start with a wakeword), ideally with "audio_playback_util": {"audio_output": "null"} in the config so
+nothing is actually played. Point --host at a local broker, so the network isn't part of what's measured.
+
+Run with: python src/benchmarks/pipeline_benchmark.py --device-id test --iterations 50 fixtures/*.wav
+(with no recordings to hand, the TTS can make some: --make-fixture "what's 5 plus 5" fixtures/calc.wav)
+"""
+import argparse
+import json
+import pathlib
+import queue
+import random
+import sys
+import time
+import types
+
+import pybloob
+
+stages = ["stt", "intent_parse", "core", "tts", "playback", "total"]
+
+## The value that percentile% of values are at or below
+def percentile(values: list, percentile: float):
+  values = sorted(values)
+  return values[min(int(len(values) * percentile / 100), len(values) - 1)]
+
+## Stage -> {"p50", "p95", "p99", "max"}, from stage -> list of seconds
+def stageReport(results: dict):
+  return {stage: {"p50": percentile(results[stage], 50), "p95": percentile(results[stage], 95), "p99": percentile(results[stage], 99), "max": max(results[stage])} for stage in stages if len(results.get(stage, [])) > 0}
+
+def formatStageReport(report: dict):
+  lines = [f"{'Stage':<14}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}"]
+  for stage, statistics in report.items():
+    lines.append(f"{stage:<14}" + "".join(f"{statistics[statistic] * 1000:>7.0f} ms" for statistic in ["p50", "p95", "p99", "max"]))
+  return "\n".join(lines)
+
+class StageTimeout(Exception):
+  pass
+
+# Plays the Orchestrator's part, sending each stage's output on to the next and timing how long each took to reply
+class PipelineDriver:
+  def __init__(self, client, device_id: str, timeout: float):
+    self.client = client
+    self.device_id = device_id
+    self.timeout = timeout
+    # (time received, topic, payload) for everything finished, in the order it arrived
+    self.replies = queue.Queue()
+    client.on_message = lambda client, userdata, message: self.replies.put((time.perf_counter(), message.topic, message.payload))
+    client.subscribe(f"bloob/{device_id}/cores/+/finished", pybloob.bloobQOS)
+
+  def publish(self, core_id: str, topic_name: str, payload):
+    self.client.publish(f"bloob/{self.device_id}/cores/{core_id}/{topic_name}", payload, qos=pybloob.bloobQOS)
+
+  ## Waits for core_id to finish request_id, returning when it did, the raw payload, and the payload decoded with decode
+  def waitFor(self, core_id: str, request_id: str, decode):
+    topic = f"bloob/{self.device_id}/cores/{core_id}/finished"
+    deadline = time.perf_counter() + self.timeout
+    while True:
+      try:
+        received_time, received_topic, payload = self.replies.get(timeout=max(deadline - time.perf_counter(), 0))
+      except queue.Empty:
+        raise StageTimeout(f"{core_id} didn't finish within {self.timeout} s")
+      if received_topic != topic:
+        continue
+      try:
+        message = decode(payload)
+      except pybloob.MessageError:
+        continue
+      if message.id == request_id:
+        return received_time, payload, message
+
+  ## Runs one recording (a pybloob.AudioMessage, whose id is replaced) all the way through, returning stage -> seconds,
+  ## what was heard, and what was answered (None if no Intent was found, in which case later stages are left out)
+  def run(self, audio):
+    request_id = f"benchmark_{random.randint(1, 1000000000)}"
+    audio.id = request_id
+    latencies = {}
+    start_time = stage_start = time.perf_counter()
+
+    self.publish("stt_util", "transcribe", audio.encode())
+    stage_end, _, transcript = self.waitFor("stt_util", request_id, pybloob.TranscriptMessage.decode)
+    latencies["stt"], stage_start = stage_end - stage_start, time.perf_counter()
+
+    self.publish("intent_parser_util", "run", pybloob.encodeJson({"id": request_id, "text": transcript.text}))
+    stage_end, _, parse = self.waitFor("intent_parser_util", request_id, lambda payload: types.SimpleNamespace(**pybloob.decodeJson(payload)))
+    latencies["intent_parse"], stage_start = stage_end - stage_start, time.perf_counter()
+    if parse.intent_id.strip() == "":
+      return latencies, transcript.text, None
+
+    self.publish(parse.core_id, "run", pybloob.CoreRunMessage(request_id, parse.text, parse.intent_id, parse.core_id).encode())
+    stage_end, _, output = self.waitFor(parse.core_id, request_id, pybloob.CoreFinishedMessage.decode)
+    latencies["core"], stage_start = stage_end - stage_start, time.perf_counter()
+
+    self.publish("tts_util", "run", pybloob.SpeakMessage(request_id, output.text).encode())
+    stage_end, speech, _ = self.waitFor("tts_util", request_id, pybloob.AudioMessage.decode)
+    latencies["tts"], stage_start = stage_end - stage_start, time.perf_counter()
+
+    # Passed on as it is, just like the Orchestrator does
+    self.publish("audio_playback_util", "play_file", speech)
+    stage_end, _, _ = self.waitFor("audio_playback_util", request_id, pybloob.PlaybackFinishedMessage.decode)
+    latencies["playback"] = stage_end - stage_start
+    latencies["total"] = stage_end - start_time
+    return latencies, transcript.text, output.text
+
+  ## Has the TTS speak text, returning the WAV it made
+  def speak(self, text: str):
+    request_id = f"benchmark_{random.randint(1, 1000000000)}"
+    self.publish("tts_util", "run", pybloob.SpeakMessage(request_id, text).encode())
+    return self.waitFor("tts_util", request_id, pybloob.AudioMessage.decode)[2].asWav()
+
+if __name__ == "__main__":
+  arg_parser = argparse.ArgumentParser()
+  arg_parser.add_argument('fixtures', nargs="*", help="WAV recordings of requests")
+  arg_parser.add_argument('--host', default="localhost")
+  arg_parser.add_argument('--port', default=1883, type=int)
+  arg_parser.add_argument('--user')
+  arg_parser.add_argument('--pass')
+  arg_parser.add_argument('--device-id', default="test")
+  arg_parser.add_argument('--iterations', default=20, type=int, help="Times to run each fixture")
+  arg_parser.add_argument('--warmup', default=1, type=int, help="Times to run each fixture (and not measure) first")
+  arg_parser.add_argument('--timeout', default=30, type=float, help="Seconds to wait for any one stage")
+  arg_parser.add_argument('--target', default=1.5, type=float, help="Seconds a request should be answered within")
+  arg_parser.add_argument('--make-fixture', nargs=2, metavar=("TEXT", "PATH"), help="Save the TTS speaking TEXT to PATH as a fixture, then exit")
+  arg_parser.add_argument('--json', action="store_true", help="Print the results as JSON")
+  arguments = arg_parser.parse_args()
+
+  client = pybloob.createMqttClient()
+  if arguments.user != None:
+    client.username_pw_set(arguments.user, arguments.__dict__.get("pass"))
+  client.connect(arguments.host, arguments.port)
+  driver = PipelineDriver(client, arguments.device_id, arguments.timeout)
+  client.loop_start()
+
+  if arguments.make_fixture != None:
+    text, path = arguments.make_fixture
+    pathlib.Path(path).write_bytes(driver.speak(text))
+    print(f"Saved \"{text}\" to {path}")
+    sys.exit()
+  if len(arguments.fixtures) == 0:
+    arg_parser.error("Give at least one fixture")
+
+  fixtures = {path: pathlib.Path(path).read_bytes() for path in arguments.fixtures}
+  results = {stage: [] for stage in stages}
+  failures = 0
+  for iteration in range(arguments.warmup + arguments.iterations):
+    for path, wav in fixtures.items():
+      try:
+        latencies, heard, answer = driver.run(pybloob.AudioMessage("", wav))
+      except StageTimeout as e:
+        print(f"{path}: {e}", file=sys.stderr)
+        failures += 1
+        continue
+      if iteration == 0:
+        print(f"{path}: heard \"{heard}\", answered \"{answer}\"", file=sys.stderr)
+      if answer == None:
+        failures += 1
+      elif iteration >= arguments.warmup:
+        for stage, seconds in latencies.items():
+          results[stage].append(seconds)
+
+  if len(results["total"]) == 0:
+    sys.exit("No requests made it all the way through")
+
+  report = stageReport(results)
+  within_target = sum(total <= arguments.target for total in results["total"])
+  if arguments.json:
+    print(json.dumps({"requests": len(results["total"]), "failures": failures, "within_target": within_target, "target": arguments.target, "stages": report}))
+  else:
+    print(formatStageReport(report))
+    print(f"{within_target} of {len(results['total'])} requests answered within {arguments.target} s ({failures} failed, or had no Intent)")
+  client.loop_stop()
@@ -0,0 +1,218 @@
+#!/bin/env python3
+""" Load generator for an STT / TTS shared by several devices (like satellites using the STT's "remote:<device-id>" mode)
+
+Simulates --satellites devices each sending requests straight to the shared device's stt_util and tts_util, just as
+their own STTs would in remote mode, arriving in a Poisson process (like real, independent rooms), evenly spaced, or in
+bursts where every satellite sends at once. With --mode both, each transcription is followed by speaking an answer,
+like a real request. Reports, for each Util, throughput, latency percentiles from sending to the reply, and how much
+of that was spent queueing (going by the Util's trace spans, so clocks should be in sync if this is run elsewhere), along
+with any requests dropped.
+
+Run with: python src/benchmarks/satellite_load.py --device-id stt-box --satellites 6 --rate 4 --duration 120 --fixture fixtures/calc.wav
+(with fixtures made as for pipeline_benchmark)
+"""
+import argparse
+import json
+import pathlib
+import random
+import sys
+import threading
+import time
+
+import pybloob
+from pipeline_benchmark import percentile
+
+utils = ["stt_util", "tts_util"]
+
+## Seconds from the start of the run at which each satellite sends a request, as sorted (time, satellite index)
+def arrivalTimes(satellites: int, rate: float, duration: float, pattern: str):
+  interval = 60 / rate
+  arrivals = []
+  for satellite in range(satellites):
+    if pattern == "poisson":
+      arrival_time = random.expovariate(1 / interval)
+    elif pattern == "uniform":
+      arrival_time = random.uniform(0, interval)
+    else:
+      arrival_time = 0
+    while arrival_time < duration:
+      arrivals.append((arrival_time, satellite))
+      arrival_time += random.expovariate(1 / interval) if pattern == "poisson" else interval
+  return sorted(arrivals)
+
+## Reads the ID from an encoded pybloob.AudioMessage without touching its audio, which may be in shared memory on
+## another machine
+def audioMessageId(payload: bytes):
+  if payload[:4] != pybloob.audio_message_magic:
+    return pybloob.AudioMessage.decode(payload).id
+  id_length = pybloob.audio_message_header.unpack_from(payload)[-1]
+  return bytes(payload[pybloob.audio_message_header.size:pybloob.audio_message_header.size + id_length]).decode()
+
+# Sends requests as satellites would, and matches up replies and trace spans with them
+class LoadGenerator:
+  def __init__(self, client, device_id: str, audio: list, text: str, mode: str, deadline: float=None):
+    self.client = client
+    self.device_id = device_id
+    self.audio = audio
+    self.text = text
+    self.mode = mode
+    self.deadline = deadline
+    # Request ID -> {"util", "satellite", "sent" (Unix time), "sent_perf", "finished_perf", "span_start", "span_end"}
+    self.requests = {}
+    self._lock = threading.Lock()
+    self._count = 0
+    client.message_callback_add(f"bloob/{device_id}/cores/stt_util/finished", self._onTranscript)
+    client.message_callback_add(f"bloob/{device_id}/cores/tts_util/finished", self._onSpeech)
+    client.message_callback_add(f"bloob/{device_id}/traces", self._onSpan)
+    client.subscribe([(f"bloob/{device_id}/cores/stt_util/finished", pybloob.bloobQOS), (f"bloob/{device_id}/cores/tts_util/finished", pybloob.bloobQOS), (f"bloob/{device_id}/traces", pybloob.bloobQOS)])
+
+  ## Sends satellite's next request, to the STT unless mode is "tts"
+  def send(self, satellite: int):
+    if self.mode == "tts":
+      self._speak(satellite)
+      return
+    audio = random.choice(self.audio)
+    request_id = self._track("stt_util", satellite)
+    payload = pybloob.AudioMessage(request_id, audio.audio, audio.sample_rate, audio.format, audio.channels, self._deadline(), f"orchestrator:satellite_{satellite}").encode()
+    self.client.publish(f"bloob/{self.device_id}/cores/stt_util/transcribe", payload, qos=pybloob.bloobQOS)
+
+  def _speak(self, satellite: int):
+    request_id = self._track("tts_util", satellite)
+    self.client.publish(f"bloob/{self.device_id}/cores/tts_util/run", pybloob.SpeakMessage(request_id, self.text, self._deadline(), f"orchestrator:satellite_{satellite}").encode(), qos=pybloob.bloobQOS)
+
+  def _deadline(self):
+    return time.time() + self.deadline if self.deadline != None else None
+
+  def _track(self, util: str, satellite: int):
+    with self._lock:
+      self._count += 1
+      request_id = f"load_{satellite}_{self._count}"
+      self.requests[request_id] = {"util": util, "satellite": satellite, "sent": time.time(), "sent_perf": time.perf_counter(), "finished_perf": None, "span_start": None, "span_end": None}
+    return request_id
+
+  def _finished(self, request_id: str):
+    with self._lock:
+      request = self.requests.get(request_id)
+      if request == None or request["finished_perf"] != None:
+        return None
+      request["finished_perf"] = time.perf_counter()
+    return request
+
+  def _onTranscript(self, client, userdata, message):
+    try:
+      request = self._finished(pybloob.TranscriptMessage.decode(message.payload).id)
+    except pybloob.MessageError:
+      return
+    if request != None and self.mode == "both":
+      self._speak(request["satellite"])
+
+  def _onSpeech(self, client, userdata, message):
+    try:
+      self._finished(audioMessageId(message.payload))
+    except (pybloob.MessageError, ValueError):
+      pass
+
+  def _onSpan(self, client, userdata, message):
+    try:
+      span = pybloob.decodeJson(message.payload)
+    except ValueError:
+      return
+    with self._lock:
+      request = self.requests.get(span.get("id"))
+      if request != None and span.get("name") in ["transcribe", "tts"]:
+        request["span_start"], request["span_end"] = span["start"], span["end"]
+
+  ## Whether every request sent has been answered (including, with mode "both", speaking every transcription's answer)
+  def allFinished(self):
+    with self._lock:
+      if self.mode == "both":
+        transcribed = sum(request["util"] == "stt_util" and request["finished_perf"] != None for request in self.requests.values())
+        if sum(request["util"] == "tts_util" for request in self.requests.values()) < transcribed:
+          return False
+      return all(request["finished_perf"] != None for request in self.requests.values())
+
+  ## Util -> its results, over seconds of sending
+  def report(self, seconds: float):
+    report = {}
+    with self._lock:
+      requests = list(self.requests.values())
+    for util in utils:
+      sent = [request for request in requests if request["util"] == util]
+      if len(sent) == 0:
+        continue
+      finished = [request for request in sent if request["finished_perf"] != None]
+      latencies = [request["finished_perf"] - request["sent_perf"] for request in finished]
+      queueing = [max(request["span_start"] - request["sent"], 0) for request in finished if request["span_start"] != None]
+      service = [request["span_end"] - request["span_start"] for request in finished if request["span_start"] != None]
+      util_report = {"sent": len(sent), "finished": len(finished), "dropped": len(sent) - len(finished), "throughput": len(finished) / seconds}
+      for name, values in [("latency", latencies), ("queueing", queueing), ("service", service)]:
+        if len(values) > 0:
+          util_report[name] = {"p50": percentile(values, 50), "p95": percentile(values, 95), "p99": percentile(values, 99), "max": max(values)}
+      report[util] = util_report
+    return report
+
+def formatReport(report: dict):
+  lines = []
+  for util, util_report in report.items():
+    lines.append(f"{util}: {util_report['finished']} of {util_report['sent']} answered ({util_report['dropped']} dropped or timed out), {util_report['throughput'] * 60:.1f}/min")
+    lines.append(f"  {'':<10}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for name in ["latency", "queueing", "service"]:
+      if name in util_report:
+        lines.append(f"  {name:<10}" + "".join(f"{util_report[name][statistic] * 1000:>7.0f} ms" for statistic in ["p50", "p95", "p99", "max"]))
+  return "\n".join(lines)
+
+if __name__ == "__main__":
+  arg_parser = argparse.ArgumentParser()
+  arg_parser.add_argument('--host', default="localhost")
+  arg_parser.add_argument('--port', default=1883, type=int)
+  arg_parser.add_argument('--user')
+  arg_parser.add_argument('--pass')
+  arg_parser.add_argument('--device-id', default="test", help="ID of the device whose STT / TTS is shared")
+  arg_parser.add_argument('--satellites', default=4, type=int)
+  arg_parser.add_argument('--rate', default=2, type=float, help="Requests per minute from each satellite")
+  arg_parser.add_argument('--duration', default=60, type=float, help="Seconds to send requests for")
+  arg_parser.add_argument('--arrivals', default="poisson", choices=["poisson", "uniform", "burst"], help="Whether satellites send independently at random, evenly spaced, or all at once")
+  arg_parser.add_argument('--mode', default="both", choices=["stt", "tts", "both"], help="Which Utils to send to, where both speaks an answer to each transcription")
+  arg_parser.add_argument('--fixture', action="append", default=[], help="WAV recording to transcribe, can be given more than once")
+  arg_parser.add_argument('--text', default="It's twenty past three, and eighteen degrees outside.", help="What to have the TTS speak")
+  arg_parser.add_argument('--opus', action="store_true", help="Send recordings Opus compressed, as satellites do when the shared STT can take it")
+  arg_parser.add_argument('--deadline', type=float, help="Seconds after sending that requests stop being wanted, like the Orchestrator's request_timeout")
+  arg_parser.add_argument('--timeout', default=30, type=float, help="Seconds to wait for answers once everything's sent")
+  arg_parser.add_argument('--json', action="store_true", help="Print the results as JSON")
+  arguments = arg_parser.parse_args()
+
+  if arguments.mode != "tts" and len(arguments.fixture) == 0:
+    arg_parser.error("Give at least one --fixture to transcribe, or use --mode tts")
+  audio = [pybloob.AudioMessage("", pathlib.Path(path).read_bytes()) for path in arguments.fixture]
+  if arguments.opus:
+    if not pybloob.opusAvailable():
+      sys.exit("Opus isn't available, install pybloob[opus] (and libopus)")
+    import pybloob_corpus
+    audio = [pybloob_corpus.compactAudio(recording) for recording in audio]
+
+  client = pybloob.createMqttClient()
+  if arguments.user != None:
+    client.username_pw_set(arguments.user, arguments.__dict__.get("pass"))
+  client.connect(arguments.host, arguments.port)
+  generator = LoadGenerator(client, arguments.device_id, audio, arguments.text, arguments.mode, arguments.deadline)
+  client.loop_start()
+
+  arrivals = arrivalTimes(arguments.satellites, arguments.rate, arguments.duration, arguments.arrivals)
+  print(f"Sending {len(arrivals)} requests from {arguments.satellites} satellites over {arguments.duration} s", file=sys.stderr)
+  start_time = time.monotonic()
+  for arrival_time, satellite in arrivals:
+    time.sleep(max(start_time + arrival_time - time.monotonic(), 0))
+    generator.send(satellite)
+
+  wait_until = time.monotonic() + arguments.timeout
+  while not generator.allFinished() and time.monotonic() < wait_until:
+    time.sleep(0.1)
+  # Spans are published just before the replies they time, but give any stragglers a moment
+  time.sleep(0.5)
+
+  report = generator.report(max(time.monotonic() - start_time, arguments.duration))
+  if arguments.json:
+    print(json.dumps(report))
+  else:
+    print(formatReport(report))
+  client.loop_stop()
@@ -12,7 +12,6 @@ import pybloob
 core_id = "calc"
 
 arguments = pybloob.coreArgParse()
-c = pybloob.Core(device_id=arguments.device_id, core_id=core_id, mqtt_host=arguments.host, mqtt_port=arguments.port, mqtt_user=arguments.user, mqtt_pass=arguments.__dict__.get("pass"))
 
 add_words = ["add", "plus"]
 minus_words = ["minus", "take"]
@@ -32,8 +31,6 @@ core_config = {
   }
 }
 
-c.publishConfig(core_config)
-
 intents = [{
     "id" : "calc",
     "keyphrases": [["$get"], add_words + minus_words + multiply_words + divide_words],
@@ -41,25 +38,25 @@ intents = [{
     "core_id": core_id
   }]
 
-c.publishIntents(intents)
+c = pybloob.AsyncCore(device_id=arguments.device_id, core_id=core_id, mqtt_host=arguments.host, mqtt_port=arguments.port, mqtt_user=arguments.user, mqtt_pass=arguments.__dict__.get("pass"), core_config=core_config, intents=intents)
 
-while True:
-  request_json = c.waitForCoreCall()
+@c.handler("calc")
+def calculate(request):
   numbers = []
-  for word in request_json["text"].split(" "):
+  for word in request.text.split(" "):
     if word.isnumeric(): numbers.append(int(word))
 
   if len(numbers) == 2:
-    if pybloob.getTextMatches(match_item=add_words, check_string=request_json["text"]):
+    if pybloob.getTextMatches(match_item=add_words, check_string=request.text):
       operator = " plus "
       result = numbers[0] + numbers[1]
-    elif pybloob.getTextMatches(match_item=minus_words, check_string=request_json["text"]):
+    elif pybloob.getTextMatches(match_item=minus_words, check_string=request.text):
       operator = " minus "
       result = numbers[0] - numbers[1]
-    elif pybloob.getTextMatches(match_item=divide_words, check_string=request_json["text"]):
+    elif pybloob.getTextMatches(match_item=divide_words, check_string=request.text):
       operator = " divided by "
       result = numbers[0] / numbers[1]
-    elif pybloob.getTextMatches(match_item=multiply_words, check_string=request_json["text"]):
+    elif pybloob.getTextMatches(match_item=multiply_words, check_string=request.text):
       operator = " multiplied by "
       result = numbers[0] * numbers[1]
 
@@ -70,4 +67,7 @@ while True:
     to_speak = f"You didn't say 2 numbers, you said {len(numbers)}"
     explanation = f"Calculator failed, as the user didn't say the 2 required numbers, they said {len(numbers)}"
 
-  c.publishCoreOutput(request_json["id"], to_speak, explanation)
+  return to_speak, explanation
+
+if __name__ == "__main__":
+  c.run()
@@ -14,7 +14,6 @@ import pybloob
 core_id = "datetime"
 
 arguments = pybloob.coreArgParse()
-c = pybloob.Core(device_id=arguments.device_id, core_id=core_id, mqtt_host=arguments.host, mqtt_port=arguments.port, mqtt_user=arguments.user, mqtt_pass=arguments.__dict__.get("pass"))
 
 core_config = {
   "metadata": {
@@ -35,9 +34,7 @@ intents = [{
     "core_id": core_id
   }]
 
-c.publishConfig(core_config)
-
-c.publishIntents(intents)
+c = pybloob.AsyncCore(device_id=arguments.device_id, core_id=core_id, mqtt_host=arguments.host, mqtt_port=arguments.port, mqtt_user=arguments.user, mqtt_pass=arguments.__dict__.get("pass"), core_config=core_config, intents=intents)
 
 from datetime import datetime
 
@@ -60,9 +57,9 @@ def get_time():
   minute = now.strftime('%M') 
   return hr24, hr12, minute, apm
 
-while True:
-  request_json = c.waitForCoreCall()
-  if "date" in request_json["text"] and "time" not in request_json["text"]:
+@c.handler("getDate")
+def getDate(request):
+  if "date" in request.text and "time" not in request.text:
     dayNum, month, weekday = get_date()
     if dayNum[-1] == "1":
       dayNum += "st"
@@ -76,7 +73,7 @@ while True:
 
       
     explanation = f"Got that the current date is the {dayNum} of {month}, which is a {weekday}"
-  elif "time" in request_json["text"] and "date" not in request_json["text"]:
+  elif "time" in request.text and "date" not in request.text:
     hr24, hr12, minute, apm = get_time()
     to_speak = f"The time is {hr12}:{minute} {apm}"
     explanation = f"Got that the current time is {hr12}:{minute} {apm}"
@@ -94,6 +91,7 @@ while True:
     to_speak = f"Right now, it's {hr12}:{minute} {apm} on {weekday} the {dayNum} of {month}"
     explanation = f"Got that the current time is {hr12}:{minute} {apm}, and the current date is {weekday} the {dayNum} of {month}"
 
-  c.publishCoreOutput(request_json["id"], to_speak, explanation)
-
+  return to_speak, explanation
 
+if __name__ == "__main__":
+  c.run()
@@ -8,7 +8,6 @@ import pybloob
 core_id = "default_collections"
 
 arguments = pybloob.coreArgParse()
-c = pybloob.Core(device_id=arguments.device_id, core_id=core_id, mqtt_host=arguments.host, mqtt_port=arguments.port, mqtt_user=arguments.user, mqtt_pass=arguments.__dict__.get("pass"))
 
 core_config = {
 	"metadata": {
@@ -23,8 +22,6 @@ core_config = {
 	}
 }
 
-c.publishConfig(core_config)
-
 colour_collection = {
 	"id": "colours",
 	"keyphrases": [
@@ -196,4 +193,7 @@ get_collection = {
 
 collections_list = [colour_collection, boolean_collection, set_collection, get_collection]
 
-c.publishCollections(collections_list)
+c = pybloob.AsyncCore(device_id=arguments.device_id, core_id=core_id, mqtt_host=arguments.host, mqtt_port=arguments.port, mqtt_user=arguments.user, mqtt_pass=arguments.__dict__.get("pass"), core_config=core_config, collections=collections_list)
+
+if __name__ == "__main__":
+	c.run()
@@ -11,7 +11,6 @@ import pybloob
 core_id = "greet"
 
 arguments = pybloob.coreArgParse()
-c = pybloob.Core(device_id=arguments.device_id, core_id=core_id, mqtt_host=arguments.host, mqtt_port=arguments.port, mqtt_user=arguments.user, mqtt_pass=arguments.__dict__.get("pass"))
 
 core_config = {
   "metadata": {
@@ -32,11 +31,12 @@ intents = [{
     "core_id": core_id
   }]
 
-c.publishConfig(core_config)
+c = pybloob.AsyncCore(device_id=arguments.device_id, core_id=core_id, mqtt_host=arguments.host, mqtt_port=arguments.port, mqtt_user=arguments.user, mqtt_pass=arguments.__dict__.get("pass"), core_config=core_config, intents=intents)
 
-c.publishIntents(intents)
-
-while True:
-  request_json = c.waitForCoreCall()
+@c.handler("helloGreet")
+def greet(request):
   greeting = "Hello, World!"
-  c.publishCoreOutput(request_json["id"], greeting, f"The Greeting Core says {greeting}")
+  return greeting, f"The Greeting Core says {greeting}"
+
+if __name__ == "__main__":
+  c.run()
@@ -1,7 +1,6 @@
 #!/bin/env python3
 
 import pybloob
-import requests
 import json
 
 core_id = "music_mopidy"
@@ -80,8 +79,11 @@ intents = [
 c = pybloob.Core(device_id=arguments.device_id, core_id=core_id, mqtt_host=arguments.host, mqtt_port=arguments.port, mqtt_user=arguments.user, mqtt_pass=arguments.__dict__.get("pass"), core_config=core_conf, intents=intents)
 central_config = c.getCentralConfig()
 
+# Keeps a connection to Mopidy open between commands, and records how long requests take in our metrics
+mopidy_session = c.httpClient("mopidy")
+
 def getPlaybackState():
-  mopidy_response_json = json.loads(requests.post(f"{base_url}/mopidy/rpc", json={"jsonrpc": "2.0", "id": 1, "method": "core.playback.get_state"}).text)
+  mopidy_response_json = json.loads(mopidy_session.post(f"{base_url}/mopidy/rpc", json={"jsonrpc": "2.0", "id": 1, "method": "core.playback.get_state"}).text)
   return mopidy_response_json["result"]
 
 ## Get Mopidy server details from central config
@@ -109,12 +111,14 @@ if search_source == "jf":
   jfauth = search_source_details["auth"]
   user_id = search_source_details["uid"]
   headers = {"X-Emby-Token": jfauth}
+  # Listing a whole library can take a while
+  jellyfin_session = c.httpClient("jellyfin", timeout=(3.05, 60))
 
   jf_songs = {}
 
   c.log(f"Downloading song index for {search_source}")
   ## Download remote
-  remote_songs_request = requests.get(jfurl+"/Users/"+user_id+f"/Items?Recursive=true&IncludeItemTypes=Audio", headers = headers)
+  remote_songs_request = jellyfin_session.get(jfurl+"/Users/"+user_id+f"/Items?Recursive=true&IncludeItemTypes=Audio", headers = headers)
   received_json = json.loads(remote_songs_request.text)
   # Opens "Items" key in JSON file
   songs = received_json["Items"]
@@ -128,7 +132,7 @@ if search_source == "jf":
 
   c.log(f"Downloading Album index for {search_source}")
   jf_albums = {}
-  remote_albums_request = requests.get(jfurl+"/Users/"+user_id+"/Items?Recursive=true&IncludeItemTypes=MusicAlbum", headers = headers)
+  remote_albums_request = jellyfin_session.get(jfurl+"/Users/"+user_id+"/Items?Recursive=true&IncludeItemTypes=MusicAlbum", headers = headers)
   received_json = json.loads(remote_albums_request.text)
   albums = received_json["Items"]
   for album in albums:
@@ -143,7 +147,7 @@ if search_source == "jf":
   c.log(f"Downloading Artist index for {search_source}")
   jf_artists = {}
   # Send get request to AlbumArtists API endpoint on the Jellyfin server with authentication
-  remote_artists_request = requests.get(jfurl+"/Artists/AlbumArtists", headers = headers)
+  remote_artists_request = jellyfin_session.get(jfurl+"/Artists/AlbumArtists", headers = headers)
   received_json = json.loads(remote_artists_request.text)
   # Opens "Items" key in JSON file
   album_artists = received_json["Items"]
@@ -184,69 +188,69 @@ c.publishAll()
   
 while True:
   c.log("Waiting for input...")
-  request_json = c.waitForCoreCall()
+  request = c.waitForCoreCall()
 
   try:
-    match request_json["intent"]:
+    match request.intent:
       case "getCurrentSong":
-        mopidy_response_json = json.loads(requests.post(f"{base_url}/mopidy/rpc", json={"jsonrpc": "2.0", "id": 1, "method": "core.playback.get_current_track"}).text)
+        mopidy_response_json = json.loads(mopidy_session.post(f"{base_url}/mopidy/rpc", json={"jsonrpc": "2.0", "id": 1, "method": "core.playback.get_current_track"}).text)
         if mopidy_response_json["result"] == None:
-          c.publishCoreOutput(request_json["id"], f"Nothing is playing right now", f"The Music (Mopidy) Core found that no song is playing")  
+          c.publishCoreOutput(request.id, f"Nothing is playing right now", f"The Music (Mopidy) Core found that no song is playing")  
         else:
           current_song = mopidy_response_json["result"]["name"]
           current_artist = mopidy_response_json["result"]["artists"][0]["name"]
-          c.publishCoreOutput(request_json["id"], f"The current song is {current_song} by {current_artist}", f"The Music (Mopidy) Core got that the current song is {current_song} by {current_artist}")
+          c.publishCoreOutput(request.id, f"The current song is {current_song} by {current_artist}", f"The Music (Mopidy) Core got that the current song is {current_song} by {current_artist}")
 
       case "pausePlayback":
         match getPlaybackState():
           case "paused":
-            c.publishCoreOutput(request_json["id"], f"I'll unpause the music", f"The Music (Mopidy) Core unpaused the music")
-            mopidy_response_json = json.loads(requests.post(f"{base_url}/mopidy/rpc", json={"jsonrpc": "2.0", "id": 1, "method": "core.playback.resume"}).text)
+            c.publishCoreOutput(request.id, f"I'll unpause the music", f"The Music (Mopidy) Core unpaused the music")
+            mopidy_response_json = json.loads(mopidy_session.post(f"{base_url}/mopidy/rpc", json={"jsonrpc": "2.0", "id": 1, "method": "core.playback.resume"}).text)
           case "playing":
-            c.publishCoreOutput(request_json["id"], f"I'll pause the music", f"The Music (Mopidy) Core paused the music")
-            mopidy_response_json = json.loads(requests.post(f"{base_url}/mopidy/rpc", json={"jsonrpc": "2.0", "id": 1, "method": "core.playback.pause"}).text)
+            c.publishCoreOutput(request.id, f"I'll pause the music", f"The Music (Mopidy) Core paused the music")
+            mopidy_response_json = json.loads(mopidy_session.post(f"{base_url}/mopidy/rpc", json={"jsonrpc": "2.0", "id": 1, "method": "core.playback.pause"}).text)
           case "stopped":
-            c.publishCoreOutput(request_json["id"], f"Nothing is playing right now", f"The Music (Mopidy) Core was asked to pause the music, but nothing is playing")
+            c.publishCoreOutput(request.id, f"Nothing is playing right now", f"The Music (Mopidy) Core was asked to pause the music, but nothing is playing")
 
       case "stopPlayback":
         match getPlaybackState():
           case "paused" | "playing":
-            mopidy_response_json = json.loads(requests.post(f"{base_url}/mopidy/rpc", json={"jsonrpc": "2.0", "id": 1, "method": "core.playback.stop"}).text)
-            c.publishCoreOutput(request_json["id"], f"I'll stop the music", f"The Music (Mopidy) Core stopped the music")
+            mopidy_response_json = json.loads(mopidy_session.post(f"{base_url}/mopidy/rpc", json={"jsonrpc": "2.0", "id": 1, "method": "core.playback.stop"}).text)
+            c.publishCoreOutput(request.id, f"I'll stop the music", f"The Music (Mopidy) Core stopped the music")
           case _:
-            c.publishCoreOutput(request_json["id"], f"Nothing is playing right now", f"The Music (Mopidy) Core was asked to stop the music, but nothing is playing")
+            c.publishCoreOutput(request.id, f"Nothing is playing right now", f"The Music (Mopidy) Core was asked to stop the music, but nothing is playing")
 
       case "nextTrack":
         match getPlaybackState():
           case "paused" | "playing":
-            mopidy_response_json = json.loads(requests.post(f"{base_url}/mopidy/rpc", json={"jsonrpc": "2.0", "id": 1, "method": "core.playback.next"}).text)
-            c.publishCoreOutput(request_json["id"], f"I'll skip this track", f"The Music (Mopidy) Core skipped to the next track")
+            mopidy_response_json = json.loads(mopidy_session.post(f"{base_url}/mopidy/rpc", json={"jsonrpc": "2.0", "id": 1, "method": "core.playback.next"}).text)
+            c.publishCoreOutput(request.id, f"I'll skip this track", f"The Music (Mopidy) Core skipped to the next track")
           case _:
-            c.publishCoreOutput(request_json["id"], f"Nothing is playing right now", f"The Music (Mopidy) Core was asked to skip the music, but nothing is playing")
+            c.publishCoreOutput(request.id, f"Nothing is playing right now", f"The Music (Mopidy) Core was asked to skip the music, but nothing is playing")
 
       case "prevTrack":
         match getPlaybackState():
           case "paused" | "playing":
-            mopidy_response_json = json.loads(requests.post(f"{base_url}/mopidy/rpc", json={"jsonrpc": "2.0", "id": 1, "method": "core.playback.previous"}).text)
-            c.publishCoreOutput(request_json["id"], f"I'll go back a track", f"The Music (Mopidy) Core went back to the previous track")
+            mopidy_response_json = json.loads(mopidy_session.post(f"{base_url}/mopidy/rpc", json={"jsonrpc": "2.0", "id": 1, "method": "core.playback.previous"}).text)
+            c.publishCoreOutput(request.id, f"I'll go back a track", f"The Music (Mopidy) Core went back to the previous track")
           case _:
-            c.publishCoreOutput(request_json["id"], f"Nothing is playing right now", f"The Music (Mopidy) Core was asked to go back a track, but nothing is playing")
+            c.publishCoreOutput(request.id, f"Nothing is playing right now", f"The Music (Mopidy) Core was asked to go back a track, but nothing is playing")
 
       case "playTrack":
         query_success = True
-        if request_json["text"].startswith("play the song"):
-          query_text = request_json["text"].replace("play the song", "")
-        elif request_json["text"].startswith("play"):
-          query_text = request_json["text"].replace("play", "")
+        if request.text.startswith("play the song"):
+          query_text = request.text.replace("play the song", "")
+        elif request.text.startswith("play"):
+          query_text = request.text.replace("play", "")
 
         c.log(f"Searching for the track \"{query_text}\" to play")
         match search_source:
           case None:
             # Query _is_ supposed to be a list of strings... even if it's just one string.
             query_json = {"jsonrpc": "2.0", "id": 1, "method": "core.library.search", "params": {"query": {"track_name": [query_text]}}}
-            mopidy_response_json = json.loads(requests.post(f"{base_url}/mopidy/rpc", json=query_json).text)
+            mopidy_response_json = json.loads(mopidy_session.post(f"{base_url}/mopidy/rpc", json=query_json).text)
             if mopidy_response_json['result'][0].get("tracks") == None:
-              c.publishCoreOutput(request_json["id"], f"I couldn't find any song by the name {query_text}", f"The Music (Mopidy) Core couldn't find a song named {query_text}")
+              c.publishCoreOutput(request.id, f"I couldn't find any song by the name {query_text}", f"The Music (Mopidy) Core couldn't find a song named {query_text}")
               query_success = False
             else:
               found_track = mopidy_response_json['result'][0]['tracks'][0]
@@ -271,7 +275,7 @@ while True:
             track_uri = local_songs[track_index]
             # Search mopidy for metadata, as it's not guaranteed to be gleamable easily from the file itself
             query_json = {"jsonrpc": "2.0", "id": 1, "method": "core.library.lookup", "params": {"uris": [track_uri]}}
-            mopidy_response_json = json.loads(requests.post(f"{base_url}/mopidy/rpc", json=query_json).text)
+            mopidy_response_json = json.loads(mopidy_session.post(f"{base_url}/mopidy/rpc", json=query_json).text)
             mopidy_response_track = mopidy_response_json["result"][track_uri][0]
 
             track_name = "Unknown Track" if mopidy_response_track.get("name") == None else mopidy_response_track["name"]
@@ -281,32 +285,32 @@ while True:
         if query_success:
           ## Add track to the tracklist
           query_json = {"jsonrpc": "2.0", "id": 1, "method": "core.tracklist.add", "params": {"uris": [track_uri]}}
-          track_add_response = json.loads(requests.post(f"{base_url}/mopidy/rpc", json=query_json).text)
+          track_add_response = json.loads(mopidy_session.post(f"{base_url}/mopidy/rpc", json=query_json).text)
 
           ## Play the song at the tlid (tracklist ID?) of the song(s) we just added
           query_json = {"jsonrpc": "2.0", "id": 1, "method": "core.playback.play", "params": {"tlid": track_add_response["result"][0]["tlid"]}}
-          play_tlid_response = json.loads(requests.post(f"{base_url}/mopidy/rpc", json=query_json).text)
+          play_tlid_response = json.loads(mopidy_session.post(f"{base_url}/mopidy/rpc", json=query_json).text)
 
-          c.publishCoreOutput(request_json["id"], f"I'll play the track {track_name} by {track_artist} from the album {track_album}", f"The Music (Mopidy) Core started playing the track {track_name} by {track_artist} from the album {track_album}")
+          c.publishCoreOutput(request.id, f"I'll play the track {track_name} by {track_artist} from the album {track_album}", f"The Music (Mopidy) Core started playing the track {track_name} by {track_artist} from the album {track_album}")
 
       case "playAlbum" | "shuffleAlbum":
         query_success = True
-        if request_json["text"].startswith("play the album"):
-          query_text = request_json["text"].replace("play the album", "")
-        elif request_json["text"].startswith("shuffle the album"):
-          query_text = request_json["text"].replace("shuffle the album", "")          
+        if request.text.startswith("play the album"):
+          query_text = request.text.replace("play the album", "")
+        elif request.text.startswith("shuffle the album"):
+          query_text = request.text.replace("shuffle the album", "")          
 
         c.log(f"Searching for the album \"{query_text}\" to play")
         match search_source:
           case None | "local":
             # Query _is_ supposed to be a list of strings... even if it's just one string.
             query_json = {"jsonrpc": "2.0", "id": 1, "method": "core.library.search", "params": {"query": {"album": [query_text]}}}
-            mopidy_response_json = json.loads(requests.post(f"{base_url}/mopidy/rpc", json=query_json).text)
+            mopidy_response_json = json.loads(mopidy_session.post(f"{base_url}/mopidy/rpc", json=query_json).text)
             # I know that I'm looking for tracks here. No albums are showing up in responses for me, so I'ma
             # searching for songs in a specific album, and checking their album fields for the name.
             c.log(mopidy_response_json['result'][0]["tracks"][0].get("album"))
             if mopidy_response_json['result'][0].get("tracks") == None and mopidy_response_json['result'][0]["tracks"][0].get("album") == None:
-              c.publishCoreOutput(request_json["id"], f"I couldn't find any album by the name {query_text}", f"The Music (Mopidy) Core couldn't find an album named {query_text}")
+              c.publishCoreOutput(request.id, f"I couldn't find any album by the name {query_text}", f"The Music (Mopidy) Core couldn't find an album named {query_text}")
               query_success = False
             else:
               found_album = mopidy_response_json['result'][0]["tracks"][0]["album"]
@@ -326,61 +330,61 @@ while True:
         if query_success:
 
           # If shuffling, we first clear the tracklist before adding tracks so that we don't shuffle into previous tracks
-          if request_json["intent"] == "shuffleAlbum":
+          if request.intent == "shuffleAlbum":
             query_json = {"jsonrpc": "2.0", "id": 1, "method": "core.tracklist.clear"}
-            requests.post(f"{base_url}/mopidy/rpc", json=query_json)
+            mopidy_session.post(f"{base_url}/mopidy/rpc", json=query_json)
 
           ## Add tracks to the tracklist
           query_json = {"jsonrpc": "2.0", "id": 1, "method": "core.tracklist.add", "params": {"uris": [album_uri]}}
-          album_add_response = json.loads(requests.post(f"{base_url}/mopidy/rpc", json=query_json).text)
+          album_add_response = json.loads(mopidy_session.post(f"{base_url}/mopidy/rpc", json=query_json).text)
 
           # If shuffling, shuffle before playing, then play track id 1 (as we earlier cleared the tracklist), else play at the ID of the added and non-shuffled songs
-          if request_json["intent"] == "shuffleAlbum":
+          if request.intent == "shuffleAlbum":
             query_json = {"jsonrpc": "2.0", "id": 1, "method": "core.tracklist.shuffle"}
-            requests.post(f"{base_url}/mopidy/rpc", json=query_json)            
+            mopidy_session.post(f"{base_url}/mopidy/rpc", json=query_json)            
 
             ## Play the song at the tlid (tracklist ID?) of the song(s) we just added
             query_json = {"jsonrpc": "2.0", "id": 1, "method": "core.playback.play", "params": {"tlid": 1}}
-            play_tlid_response = json.loads(requests.post(f"{base_url}/mopidy/rpc", json=query_json).text)
+            play_tlid_response = json.loads(mopidy_session.post(f"{base_url}/mopidy/rpc", json=query_json).text)
             speech_play_type = "shuffle"
           else:
             ## Play the song at the tlid (tracklist ID?) of the song(s) we just added
             query_json = {"jsonrpc": "2.0", "id": 1, "method": "core.playback.play", "params": {"tlid": album_add_response["result"][0]["tlid"]}}
-            play_tlid_response = json.loads(requests.post(f"{base_url}/mopidy/rpc", json=query_json).text)
+            play_tlid_response = json.loads(mopidy_session.post(f"{base_url}/mopidy/rpc", json=query_json).text)
             speech_play_type = "play"
 
-          c.publishCoreOutput(request_json["id"], f"I'll {speech_play_type} the album {album_name} by {album_artist}", f"The Music (Mopidy) Core started {speech_play_type}ing the album {album_name} by {album_artist}")
+          c.publishCoreOutput(request.id, f"I'll {speech_play_type} the album {album_name} by {album_artist}", f"The Music (Mopidy) Core started {speech_play_type}ing the album {album_name} by {album_artist}")
 
       case "playArtist" | "shuffleArtist":
         query_success = True
-        if request_json["text"].startswith("play the artist"):
-          query_text = request_json["text"].replace("play the artist", "")
-        elif request_json["text"].startswith("play songs by"):
-          query_text = request_json["text"].replace("play songs by", "")
-        elif request_json["text"].startswith("play tracks by"):
-          query_text = request_json["text"].replace("play tracks by", "")
-        elif request_json["text"].startswith("play music by"):
-          query_text = request_json["text"].replace("play music by", "")
-        elif request_json["text"].startswith("shuffle the artist"):
-          query_text = request_json["text"].replace("shuffle the artist", "")
-        elif request_json["text"].startswith("shuffle songs by"):
-          query_text = request_json["text"].replace("shuffle songs by", "")
-        elif request_json["text"].startswith("shuffle tracks by"):
-          query_text = request_json["text"].replace("shuffle tracks by", "")
-        elif request_json["text"].startswith("shuffle music by"):
-          query_text = request_json["text"].replace("shuffle music by", "")
+        if request.text.startswith("play the artist"):
+          query_text = request.text.replace("play the artist", "")
+        elif request.text.startswith("play songs by"):
+          query_text = request.text.replace("play songs by", "")
+        elif request.text.startswith("play tracks by"):
+          query_text = request.text.replace("play tracks by", "")
+        elif request.text.startswith("play music by"):
+          query_text = request.text.replace("play music by", "")
+        elif request.text.startswith("shuffle the artist"):
+          query_text = request.text.replace("shuffle the artist", "")
+        elif request.text.startswith("shuffle songs by"):
+          query_text = request.text.replace("shuffle songs by", "")
+        elif request.text.startswith("shuffle tracks by"):
+          query_text = request.text.replace("shuffle tracks by", "")
+        elif request.text.startswith("shuffle music by"):
+          query_text = request.text.replace("shuffle music by", "")
 
         c.log(f"Searching for the artist \"{query_text}\" to play")
         match search_source:
           case None | "local":
             # Query _is_ supposed to be a list of strings... even if it's just one string.
             query_json = {"jsonrpc": "2.0", "id": 1, "method": "core.library.search", "params": {"query": {"artist": [query_text]}}}
-            mopidy_response_json = json.loads(requests.post(f"{base_url}/mopidy/rpc", json=query_json).text)
+            mopidy_response_json = json.loads(mopidy_session.post(f"{base_url}/mopidy/rpc", json=query_json).text)
             
             # I know that I'm looking for tracks here. No artists are showing up in responses for me, so I'ma
             # searching for songs made by a specific artist, and checking their artist fields for the searched artist.
             if mopidy_response_json['result'][0].get("tracks") == None and mopidy_response_json['result'][0]["tracks"][0].get("artists") == None:
-              c.publishCoreOutput(request_json["id"], f"I couldn't find any artist by the name {query_text}", f"The Music (Mopidy) Core couldn't find an artist named {query_text}")
+              c.publishCoreOutput(request.id, f"I couldn't find any artist by the name {query_text}", f"The Music (Mopidy) Core couldn't find an artist named {query_text}")
               query_success = False
             else:
               found_artist = mopidy_response_json['result'][0]["tracks"][0]["artists"][0]
@@ -398,37 +402,37 @@ while True:
         if query_success:
 
           # If shuffling, we first clear the tracklist before adding tracks so that we don't shuffle into previous tracks
-          if request_json["intent"] == "shuffleArtist":
+          if request.intent == "shuffleArtist":
             query_json = {"jsonrpc": "2.0", "id": 1, "method": "core.tracklist.clear"}
-            requests.post(f"{base_url}/mopidy/rpc", json=query_json)
+            mopidy_session.post(f"{base_url}/mopidy/rpc", json=query_json)
 
           ## Add tracks to the tracklist
           query_json = {"jsonrpc": "2.0", "id": 1, "method": "core.tracklist.add", "params": {"uris": [artist_uri]}}
-          artist_add_response = json.loads(requests.post(f"{base_url}/mopidy/rpc", json=query_json).text)
+          artist_add_response = json.loads(mopidy_session.post(f"{base_url}/mopidy/rpc", json=query_json).text)
 
           # If shuffling, shuffle before playing, then play track id 1 (as we earlier cleared the tracklist), else play at the ID of the added and non-shuffled songs
-          if request_json["intent"] == "shuffleArtist":
+          if request.intent == "shuffleArtist":
             query_json = {"jsonrpc": "2.0", "id": 1, "method": "core.tracklist.shuffle"}
-            requests.post(f"{base_url}/mopidy/rpc", json=query_json)            
+            mopidy_session.post(f"{base_url}/mopidy/rpc", json=query_json)            
 
             ## Play the song at the tlid (tracklist ID?) of the song(s) we just added
             query_json = {"jsonrpc": "2.0", "id": 1, "method": "core.playback.play", "params": {"tlid": 1}}
-            play_tlid_response = json.loads(requests.post(f"{base_url}/mopidy/rpc", json=query_json).text)
+            play_tlid_response = json.loads(mopidy_session.post(f"{base_url}/mopidy/rpc", json=query_json).text)
             speech_play_type = "shuffle"
           else:
             ## Play the song at the tlid (tracklist ID?) of the song(s) we just added
             query_json = {"jsonrpc": "2.0", "id": 1, "method": "core.playback.play", "params": {"tlid": artist_add_response["result"][0]["tlid"]}}
-            play_tlid_response = json.loads(requests.post(f"{base_url}/mopidy/rpc", json=query_json).text)
+            play_tlid_response = json.loads(mopidy_session.post(f"{base_url}/mopidy/rpc", json=query_json).text)
             speech_play_type = "play"
 
-          c.publishCoreOutput(request_json["id"], f"I'll {speech_play_type} the artist {artist_name}", f"The Music (Mopidy) Core started {speech_play_type}ing the artist {artist_name}")
+          c.publishCoreOutput(request.id, f"I'll {speech_play_type} the artist {artist_name}", f"The Music (Mopidy) Core started {speech_play_type}ing the artist {artist_name}")
 
   except (TimeoutError, ConnectionError):
     to_speak = "I couldn't contact the music service, check your internet connection"
     explanation = "The Music Core failed to access the mopidy server. The user's internet connection may be down, or the Mopidy server may be down"
-    c.publishCoreOutput(request_json["id"], to_speak, explanation)
+    c.publishCoreOutput(request.id, to_speak, explanation)
   except Exception as e:
     c.log(e)
     to_speak = "I couldn't access your music, and I'm not sure why"
     explanation = "The Music Core failed to access the music for an unknown reason"   
-    c.publishCoreOutput(request_json["id"], to_speak, explanation)
\ No newline at end of file
+    c.publishCoreOutput(request.id, to_speak, explanation)
\ No newline at end of file
@@ -16,7 +16,6 @@ core_dir = pathlib.Path(__file__).parents[0]
 core_id = "parrot"
 
 arguments = pybloob.coreArgParse()
-c = pybloob.Core(device_id=arguments.device_id, core_id=core_id, mqtt_host=arguments.host, mqtt_port=arguments.port, mqtt_user=arguments.user, mqtt_pass=arguments.__dict__.get("pass"))
 
 core_config = {
   "metadata": {
@@ -40,18 +39,18 @@ intents = [{
   }  
   ]
 
-c.log("Starting up...")
-
-c.publishConfig(core_config)
+c = pybloob.AsyncCore(device_id=arguments.device_id, core_id=core_id, mqtt_host=arguments.host, mqtt_port=arguments.port, mqtt_user=arguments.user, mqtt_pass=arguments.__dict__.get("pass"), core_config=core_config, intents=intents)
 
-c.publishIntents(intents)
+c.log("Starting up...")
 
-while True:
-  c.log("Waiting for input")
-  requestJson = c.waitForCoreCall()
-  repeatText = requestJson["text"]
+@c.handler("parrotSpeech")
+def parrotSpeech(request):
+  repeatText = request.text
   for parrot_word in parrot_words:
     if repeatText.startswith(parrot_word):
       repeatText = repeatText[len(parrot_word):]
   c.log(f"Parroting: {repeatText}")
-  c.publishCoreOutput(requestJson["id"], repeatText, f"The Parrot Core only wants you to output the following text, as the user asked for it to be repeated: {repeatText}")
+  return repeatText, f"The Parrot Core only wants you to output the following text, as the user asked for it to be repeated: {repeatText}"
+
+if __name__ == "__main__":
+  c.run()
@@ -8,14 +8,11 @@ Requires centralised config with key "weather" and value of an object: {"locatio
 kept to 1dp of precision, as this should be reasonable for weather requests, while not being too specific
 """
 
-from duckduckgo_search import DDGS
-
 import pybloob
 
 core_id = "search_ddg"
 
 arguments = pybloob.coreArgParse()
-c = pybloob.Core(device_id=arguments.device_id, core_id=core_id, mqtt_host=arguments.host, mqtt_port=arguments.port, mqtt_user=arguments.user, mqtt_pass=arguments.__dict__.get("pass"))
 
 core_config = {
   "metadata": {
@@ -36,19 +33,22 @@ intents = [{
     "prefixes": ["search"]
   }]
 
-c.log("Starting up...")
-
-c.publishConfig(core_config)
+# Searches can be slow, so this is an AsyncCore, which runs each search in its own thread rather than making
+# every other request wait for the one in front of it
+c = pybloob.AsyncCore(device_id=arguments.device_id, core_id=core_id, mqtt_host=arguments.host, mqtt_port=arguments.port, mqtt_user=arguments.user, mqtt_pass=arguments.__dict__.get("pass"), core_config=core_config, intents=intents)
 
-c.publishIntents(intents)
+## TODO: Add (option?) sending a link to the search and results through ntfy for getting more info
+@c.handler("search_ddg")
+def search(request):
+  # Said straight away, so there's something to hear while the search runs
+  yield "Searching."
+  # Imported on the first search rather than at startup, as it's slow to import and most runs never search
+  from duckduckgo_search import DDGS
+  result = DDGS().text(request.text[1:], max_results=1)[0]["body"]
+  # Each sentence can be spoken while the next is still being turned into speech
+  yield from pybloob.splitSentences(result)
 
-## Get device configs from central config, instantiate
-c.log("Getting Centralised Config from Orchestrator")
-central_config = c.getCentralConfig()
+c.log("Starting up...")
 
-## TODO: Add (option?) sending a link to the search and results through ntfy for getting more info
-while True:
-  request_json = c.waitForCoreCall()
-  text_to_speak = DDGS().text(request_json["text"][1:], max_results=1)[0]["body"]
-  explanation = "A DuckDuckGo search returned: " + text_to_speak
-  c.publishCoreOutput(request_json["id"], text_to_speak, explanation)
\ No newline at end of file
+if __name__ == "__main__":
+  c.run()
\ No newline at end of file
@@ -6,8 +6,7 @@ Follows the Bloob Core format for input / output
 
 Sets the volume to - or increments it by - whatever percentage you say
 """
-import subprocess
-import base64
+import asyncio
 import pathlib
 
 import pybloob
@@ -17,7 +16,6 @@ core_dir = pathlib.Path(__file__).parents[0]
 core_id = "volume_set"
 
 arguments = pybloob.coreArgParse()
-c = pybloob.Core(device_id=arguments.device_id, core_id=core_id, mqtt_host=arguments.host, mqtt_port=arguments.port, mqtt_user=arguments.user, mqtt_pass=arguments.__dict__.get("pass"))
 
 increase_words = ["up", "increase", "higher", "more"]
 decrease_words = ["down", "decrease", "lower", "less", "decreeced"]
@@ -55,50 +53,51 @@ intents = [{
   
   ]
 
-c.log("Starting up...")
-
-c.publishConfig(core_config)
+c = pybloob.AsyncCore(device_id=arguments.device_id, core_id=core_id, mqtt_host=arguments.host, mqtt_port=arguments.port, mqtt_user=arguments.user, mqtt_pass=arguments.__dict__.get("pass"), core_config=core_config, intents=intents)
 
-c.publishIntents(intents)
+c.log("Starting up...")
 
 ## Get device configs from central config, instantiate
-c.log("Getting Centralised Config from Orchestrator")
-central_config = c.getCentralConfig()
+@c.onStartup
+async def loadCentralConfig():
+  global min_bound, max_bound, audio_device
+  c.log("Getting Centralised Config from Orchestrator")
+  central_config = await c.getCentralConfig()
+
+  if central_config == {}:
+    min_bound = 0
+    max_bound = 100
+    audio_device = "Master"
+    c.log(f"No config found, assuming default audio device name ({audio_device}) and bounds ({min_bound}-{max_bound})")
 
-if central_config == {}:
-  min_bound = 0
-  max_bound = 100
-  audio_device = "Master"
-  c.log(f"No config found, assuming default audio device name ({audio_device}) and bounds ({min_bound}-{max_bound})")
-
-else:
-  min_bound = int(central_config["min_bound"])
-  max_bound = int(central_config["max_bound"])
-  audio_device = central_config["device_name"]
-  c.log(f"Config found, device name ({audio_device}) and bounds ({min_bound}-{max_bound})")
+  else:
+    min_bound = int(central_config["min_bound"])
+    max_bound = int(central_config["max_bound"])
+    audio_device = central_config["device_name"]
+    c.log(f"Config found, device name ({audio_device}) and bounds ({min_bound}-{max_bound})")
 
 with open(core_dir.joinpath("volume_change.wav"), "rb") as audio_file:
-	volume_change_audio = base64.b64encode(audio_file.read()).decode()
+	volume_change_audio = audio_file.read()
 
-while True:
-  c.log("Waiting for input...")
-  request_json = c.waitForCoreCall()
+@c.handler("set_volume", "increment_volume")
+async def setVolume(request):
   numbers = []
-  for word in request_json["text"].split(" "):
+  for word in request.text.split(" "):
     if word.isnumeric(): numbers.append(int(word))
 
   if len(numbers) == 1:
     percentage = int(min_bound+(numbers[0]*((max_bound-min_bound)/100)))
 
-    if request_json["intent"] == "set_volume":
+    if request.intent == "set_volume":
       c.log(f"Setting volume to {percentage}%")
-      subprocess.call(["amixer", "sset", audio_device, str(percentage) + "%"])
+      amixer = await asyncio.create_subprocess_exec("amixer", "sset", audio_device, str(percentage) + "%")
+      await amixer.wait()
 
       to_speak = f"Setting the volume to {percentage} percent"
       explanation = f"Volume Set Core set the volume to {percentage}%"
 
-    elif request_json["intent"] == "increment_volume":
-      if pybloob.getTextMatches(increase_words, request_json["text"]):
+    elif request.intent == "increment_volume":
+      if pybloob.getTextMatches(increase_words, request.text):
         plus_minus = "+"
         increase_decrease = "Increasing"
       else:
@@ -108,13 +107,17 @@ while True:
       to_speak = f"{increase_decrease} the volume by {percentage} percent"
       explanation = f"Volume Set Core is done {increase_decrease} the volume by {percentage}%"
       
-      subprocess.call(["amixer", "sset", audio_device, str(percentage) + "%" + plus_minus])
+      amixer = await asyncio.create_subprocess_exec("amixer", "sset", audio_device, str(percentage) + "%" + plus_minus)
+      await amixer.wait()
 
-    c.playAudioFile(volume_change_audio)
+    await c.playAudioFile(volume_change_audio)
 
   else:
     c.log(f"Got {len(numbers)} instead of 1")
     to_speak = f"You didn't say 1 number to set the volume to, you said {len(numbers)}"
     explanation = f"Setting the volume failed, as the user said {len(numbers)} volume numbers instead of 1"
 
-  c.publishCoreOutput(request_json["id"], to_speak, explanation)
\ No newline at end of file
+  return to_speak, explanation
+
+if __name__ == "__main__":
+  c.run()
@@ -17,7 +17,6 @@ import pybloob
 core_id = "weather"
 
 arguments = pybloob.coreArgParse()
-c = pybloob.Core(device_id=arguments.device_id, core_id=core_id, mqtt_host=arguments.host, mqtt_port=arguments.port, mqtt_user=arguments.user, mqtt_pass=arguments.__dict__.get("pass"))
 
 core_config = {
   "metadata": {
@@ -45,18 +44,23 @@ with open(f"{script_path}/weathercodes.json", "r") as weather_file:
   # File by Stellasphere, modified / shrunken to fit my needs
   wmo_codes = json.load(weather_file)
 
-c.log("Starting up...")
+c = pybloob.AsyncCore(device_id=arguments.device_id, core_id=core_id, mqtt_host=arguments.host, mqtt_port=arguments.port, mqtt_user=arguments.user, mqtt_pass=arguments.__dict__.get("pass"), core_config=core_config, intents=intents)
 
-c.publishConfig(core_config)
+# The weather doesn't change from one minute to the next, so repeated requests for it are answered from a cache
+http_session = c.httpClient("open_meteo", cache_ttl=300)
 
-c.publishIntents(intents)
+c.log("Starting up...")
 
 ## Get device configs from central config, instantiate
-c.log("Getting Centralised Config from Orchestrator")
-central_config = c.getCentralConfig()
-
-while True:
-  request_json = c.waitForCoreCall()
+@c.onStartup
+async def loadCentralConfig():
+  global central_config
+  c.log("Getting Centralised Config from Orchestrator")
+  central_config = await c.getCentralConfig()
+
+# Runs in AsyncCore's thread pool, since requests blocks
+@c.handler("getWeather")
+def getWeather(request):
   if central_config == {} or central_config.get("location") == None:
     c.log("No location set in config")
     to_speak = "I couldn't get the weather, as you don't have a location set up in your configuration file"
@@ -69,16 +73,17 @@ while True:
       temperature_unit = central_config["temperature_unit"]
     latlong = central_config["location"]
     try:
-      weather = requests.get(f'https://api.open-meteo.com/v1/forecast?latitude={latlong[0]}&longitude={latlong[1]}&current=temperature_2m,is_day,weathercode&temperature_unit={temperature_unit}', timeout=2).json()
+      weather = http_session.get(f'https://api.open-meteo.com/v1/forecast?latitude={latlong[0]}&longitude={latlong[1]}&current=temperature_2m,is_day,weathercode&temperature_unit={temperature_unit}', timeout=2).json()
       to_speak = f'Right now, its {weather["current"]["temperature_2m"]} degrees {temperature_unit} and {wmo_codes[str(weather["current"]["weathercode"])]["day"]["description"]}'
       explanation = f'The Weather Core got that the temperature is {weather["current"]["temperature_2m"]} degrees {temperature_unit} and the conditions are {wmo_codes[str(weather["current"]["weathercode"])]["day"]["description"]}'
-    except (TimeoutError, ConnectionError):
+    except (requests.Timeout, requests.ConnectionError):
       to_speak = "I couldn't contact the weather service, check your internet connection"
       explanation = "The Weather Core failed to get the weather due to being unable to contact the Open Meteo servers. The user's internet connection may be down, or the Open Meteo servers may be down"
     except:
       to_speak = "I couldn't get the weather, and I'm not sure why"
       explanation = "The Weather Core failed to get the weather for an unknown reason"   
 
-  c.publishCoreOutput(request_json["id"], to_speak, explanation)
-
+  return to_speak, explanation
 
+if __name__ == "__main__":
+  c.run()
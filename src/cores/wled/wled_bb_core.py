@@ -5,7 +5,7 @@ Core ID: wled
 Follows the Bloob Core format for input / output
 """
 
-import requests
+import threading
 
 import pybloob
 
@@ -15,6 +15,10 @@ core_id = "wled"
 
 c = pybloob.Core(device_id=arguments.device_id, core_id=core_id, mqtt_host=arguments.host, mqtt_port=arguments.port, mqtt_user=arguments.user, mqtt_pass=arguments.__dict__.get("pass"))
 
+# Keeps connections to the WLED devices open between commands, and records how long requests take in our metrics.
+# Setting a device's state is safe to repeat, so failed commands are retried.
+http_session = c.httpClient("wled", idempotent=True)
+
 class WledDevice:
   def __init__(self,names,ip_address):
     self.names = names
@@ -22,20 +26,20 @@ class WledDevice:
     self.ip_address = ip_address
 
   def on(self):
-    requests.post(f"http://{self.ip_address}/win&T=1")
+    http_session.post(f"http://{self.ip_address}/win&T=1")
 
   def off(self):
-    requests.post(f"http://{self.ip_address}/win&T=0")
+    http_session.post(f"http://{self.ip_address}/win&T=0")
 
   def setColour(self,rgb_list):
-    requests.post(f"http://{self.ip_address}/win&R={rgb_list[0]}&G={rgb_list[1]}&B={rgb_list[2]}")
+    http_session.post(f"http://{self.ip_address}/win&R={rgb_list[0]}&G={rgb_list[1]}&B={rgb_list[2]}")
 
   # TODO: Change percentage based on the current limit
   def setPercentage(self,percentage):
-    requests.post(f"http://{self.ip_address}/win&A={int(percentage*2.55)}")
+    http_session.post(f"http://{self.ip_address}/win&A={int(percentage*2.55)}")
 
   def get_state(self):
-    wled_json_state = requests.get(f"http://{self.ip_address}/json").json()
+    wled_json_state = http_session.get(f"http://{self.ip_address}/json").json()
     if wled_json_state["state"]["on"] == True:
       on_off = "on"
     else:
@@ -47,7 +51,7 @@ class WledDevice:
     ## a generic format that could support all states for all devices.
 
   def is_on(self):
-    wled_json_state = requests.get(f"http://{self.ip_address}/json").json()
+    wled_json_state = http_session.get(f"http://{self.ip_address}/json").json()
     if wled_json_state["state"]["on"] == True:
       return True
     else:
@@ -56,30 +60,22 @@ class WledDevice:
 c.log("Starting up...")
 
 wled_devices = []
-
-## Get device configs from central config, instantiate
-c.log("Getting Centralised Config from Orchestrator")
-device_config = c.getCentralConfig()
-if not device_config == {} and device_config.get("devices"):
-  for device in device_config["devices"]:
-    wled_devices.append(WledDevice(names=device["names"], ip_address=device["ip"]))
-
-c.log("Getting colours Collection from Orchestrator")
-## Get required "colours" Collection from central Collection list
-colours_collection = c.getCollection(collection_name="colours")
-
-c.log("Getting boolean Collection from Orchestrator")
-## Get required "boolean" Collection from central Collection list
-boolean_collection = c.getCollection(collection_name="boolean")
-
 all_device_names = []
-for device in wled_devices:
-  for name in device.names:
-    all_device_names.append(name)
-
-state_keyphrases = boolean_collection["keyphrases"] + colours_collection["keyphrases"]
-
-c.log(boolean_collection["keyphrases"])
+# Held while the device lists are swapped for new ones, or read by a request
+devices_lock = threading.Lock()
+
+# Creates the devices from the Central Config. The new lists are built first and then swapped in all at once (in place,
+# since the Intents refer to all_device_names), so a request being handled meanwhile never sees half of them
+def loadDevices(device_config):
+  new_devices = []
+  if not device_config == {} and device_config.get("devices"):
+    for device in device_config["devices"]:
+      new_devices.append(WledDevice(names=device["names"], ip_address=device["ip"]))
+  new_device_names = [name for device in new_devices for name in device.names]
+
+  with devices_lock:
+    wled_devices[:] = new_devices
+    all_device_names[:] = new_device_names
 
 core_config = {
   "metadata": {
@@ -128,6 +124,19 @@ intents = [
   }
 ]
 
+# If the Orchestrator's Central Config differs from the one we started with, reload our devices and their names
+@c.state_cache.onChange
+def reconcileState(key, value):
+  if key == "central_config":
+    c.log("Centralised Config changed, reloading devices")
+    loadDevices(value)
+    c.publishIntents(intents)
+
+## Get device configs from central config, instantiate. If we've run before, the last known config is used
+## straight away, and reconcileState sorts it out if the Orchestrator's fresh one turns out to be different
+c.log("Getting Centralised Config from Orchestrator")
+loadDevices(c.getCentralConfig(use_snapshot=True))
+
 c.publishIntents(intents)
 
 print(all_device_names)
@@ -136,21 +145,29 @@ c.publishConfig(core_config)
 
 while True:
   c.log("Waiting for input...")
-  request_json = c.waitForCoreCall()
+  request = c.waitForCoreCall()
   ## TODO: Actual stuff here, matching the right device from name, state, etc
 
-  spoken_devices = pybloob.getDeviceMatches(device_list=wled_devices, check_string=request_json["text"])
-  spoken_states = pybloob.getTextMatches(match_item=state_keyphrases, check_string=request_json["text"])
+  ## Get the required "colours" and "boolean" Collections from the central Collection list. These are kept up to date
+  ## in the background, so this only waits on the Orchestrator if neither they nor a snapshot of them have arrived yet
+  collections = c.getCollections(["colours", "boolean"], use_snapshot=True)
+  colours_collection = collections["colours"]
+  boolean_collection = collections["boolean"]
+  state_keyphrases = boolean_collection["keyphrases"] + colours_collection["keyphrases"]
+
+  with devices_lock:
+    spoken_devices = pybloob.getDeviceMatches(device_list=wled_devices, check_string=request.text)
+  spoken_states = pybloob.getTextMatches(match_item=state_keyphrases, check_string=request.text)
 
   # If there's a blank spot in the state, but there are numbers in the spoken words, do that.
   if not spoken_states:
-    for word in request_json["text"].split(" "):
+    for word in request.text.split(" "):
       if word.isnumeric():
         spoken_states.append(f"{word} percent")
   else:
     for index, state in enumerate(spoken_states):
       if not state:
-        for word in request_json["text"].split(" "):
+        for word in request.text.split(" "):
           if word.isnumeric():
             spoken_states[index] == f"{word} percent"
 
@@ -178,7 +195,7 @@ while True:
     # Set percentage of device (normally brightness, but could be anything else)
     else:
       how_many_numbers = 0
-      for word in request_json["text"].split(" "):
+      for word in request.text.split(" "):
         if word.isnumeric():
           how_many_numbers += 1
           spoken_number = int(word)
@@ -186,6 +203,6 @@ while True:
         device.setPercentage(spoken_number)
 
   c.log(f"Publishing Output, {to_speak}")
-  c.publishCoreOutput(request_json["id"], to_speak, explanation)
+  c.publishCoreOutput(request.id, to_speak, explanation)
 
 
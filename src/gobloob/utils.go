@@ -1,10 +1,16 @@
 package gobloob
 
 import (
+	"bytes"
+	"encoding/base64"
+	"encoding/binary"
 	"encoding/json"
+	"errors"
 	"fmt"
 	"log"
+	"math"
 	"strings"
+	"time"
 
 	mqtt "github.com/eclipse/paho.mqtt.golang"
 )
@@ -16,6 +22,7 @@ const IntentParseTopic string = "bloob/%s/cores/intent_parser_util/run"
 const TtsTopic string = "bloob/%s/cores/tts_util/run"
 const CoreTopic string = "bloob/%s/cores/%s/run"
 const InstantIntentTopic string = "bloob/%s/instant_intents"
+const TracesTopic string = "bloob/%s/traces"
 
 const thinkingTopic string = "bloob/%s/thinking"
 const recordingTopic string = "bloob/%s/recording"
@@ -54,6 +61,18 @@ type Collection struct {
 	Variables          map[string]interface{} `json:"variables"`
 }
 
+// Published retained to bloob/<device_id>/cores/<core_id>/intent_bundle (or collection_bundle) by Cores that send all
+// of their Intents / Collections as one message. Version is a hash of the contents, so unchanged bundles can be skipped
+type IntentBundle struct {
+	Version string   `json:"version"`
+	Intents []Intent `json:"intents"`
+}
+
+type CollectionBundle struct {
+	Version     string       `json:"version"`
+	Collections []Collection `json:"collections"`
+}
+
 type ParseRequest struct {
 	Id   string
 	Text string
@@ -81,13 +100,23 @@ type MqttConfig struct {
 }
 
 type WakewordResponse struct {
-	WakewordId string `json:"wakeword_id"`
-	Confidence string `json:"confidence"`
+	WakewordId string  `json:"wakeword_id"`
+	Confidence string  `json:"confidence"`
+	DetectedAt float64 `json:"detected_at"`
 }
 
-type AudioRecorderResponse struct {
-	Id    string `json:"id"`
-	Audio string `json:"audio"`
+// A stage of handling a request, matching pybloob's spans. Start and End are Unix timestamps in seconds.
+type Span struct {
+	Id         string                 `json:"id"`
+	CoreId     string                 `json:"core_id"`
+	Name       string                 `json:"name"`
+	Start      float64                `json:"start"`
+	End        float64                `json:"end"`
+	Attributes map[string]interface{} `json:"attributes"`
+}
+
+func UnixSeconds(t time.Time) float64 {
+	return float64(t.UnixNano()) / 1e9
 }
 
 type TranscriptionResponse struct {
@@ -95,6 +124,13 @@ type TranscriptionResponse struct {
 	Text string `json:"text"`
 }
 
+// Published to bloob/<device_id>/cores/<core_id>/dropped by Utils that drop a request without working on it (because it
+// passed its deadline, was superseded or overflowed their queue), so nothing more is coming for it
+type DroppedResponse struct {
+	Id     string `json:"id"`
+	Reason string `json:"reason"`
+}
+
 type IntentParseResponse struct {
 	Id       string `json:"id"`
 	Text     string `json:"text"`
@@ -108,9 +144,141 @@ type CoreResponse struct {
 	Explanation string `json:"explanation"`
 }
 
-type TTSResponse struct {
+// One part of a Core's output, sent before its CoreResponse so it can be spoken sooner. Index counts up from 0 within a
+// request, and the last part of a request has Final set (and no Text).
+type CoreChunk struct {
 	Id    string `json:"id"`
-	Audio string `json:"audio"`
+	Index int    `json:"index"`
+	Text  string `json:"text"`
+	Final bool   `json:"final,omitempty"`
+}
+
+// Audio is sent between Utils as a binary header followed by the raw audio, rather than base64 inside JSON. This matches
+// pybloob.AudioMessage: (big-endian) "BLBA", version, format, channels, flags, sample rate (uint32, 0 if unknown / in
+// the WAV header), audio length (uint32), id length (uint16), then the id, then the deadline (float64) and session
+// (uint16 length, then the session) if their flags are set, then the audio.
+const AudioMessageVersion uint8 = 1
+const AudioFormatWav uint8 = 0
+const AudioFormatPcm uint8 = 1  // Signed 16-bit little-endian samples, no header
+const AudioFormatOpus uint8 = 2 // 16-bit PCM compressed with Opus (see pybloob_opus)
+
+// With this flag, Audio is a descriptor of where the audio is in shared memory (for Utils on the same machine) rather
+// than the audio itself. It's passed along unchanged, so the orchestrator never needs to read it.
+const AudioFlagSharedMemory uint8 = 1
+
+// A request isn't wanted after its Deadline (Unix seconds), or once a newer request with the same Session is sent, and
+// Utils drop those without working on them
+const AudioFlagDeadline uint8 = 2
+const AudioFlagSession uint8 = 4
+
+var audioMessageMagic []byte = []byte("BLBA")
+
+const audioMessageHeaderSize int = 18
+
+type AudioMessage struct {
+	Id         string
+	Audio      []byte
+	SampleRate uint32
+	Format     uint8
+	Channels   uint8
+	Flags      uint8
+	Deadline   float64 // 0 for none
+	Session    string
+}
+
+func EncodeAudioMessage(message AudioMessage) []byte {
+	channels := message.Channels
+	if channels == 0 {
+		channels = 1
+	}
+	flags := message.Flags &^ (AudioFlagDeadline | AudioFlagSession)
+	if message.Deadline != 0 {
+		flags |= AudioFlagDeadline
+	}
+	if message.Session != "" {
+		flags |= AudioFlagSession
+	}
+	encoded := make([]byte, audioMessageHeaderSize, audioMessageHeaderSize+len(message.Id)+10+len(message.Session)+len(message.Audio))
+	copy(encoded, audioMessageMagic)
+	encoded[4] = AudioMessageVersion
+	encoded[5] = message.Format
+	encoded[6] = channels
+	encoded[7] = flags
+	binary.BigEndian.PutUint32(encoded[8:12], message.SampleRate)
+	binary.BigEndian.PutUint32(encoded[12:16], uint32(len(message.Audio)))
+	binary.BigEndian.PutUint16(encoded[16:18], uint16(len(message.Id)))
+	encoded = append(encoded, message.Id...)
+	if flags&AudioFlagDeadline != 0 {
+		encoded = binary.BigEndian.AppendUint64(encoded, math.Float64bits(message.Deadline))
+	}
+	if flags&AudioFlagSession != 0 {
+		encoded = binary.BigEndian.AppendUint16(encoded, uint16(len(message.Session)))
+		encoded = append(encoded, message.Session...)
+	}
+	return append(encoded, message.Audio...)
+}
+
+// Accepts both binary messages and the old {"id": id, "audio": base64_wav_str} JSON ones. The returned Audio is a slice
+// of the payload, not a copy.
+func DecodeAudioMessage(payload []byte) (AudioMessage, error) {
+	if !bytes.HasPrefix(payload, audioMessageMagic) {
+		var legacyMessage struct {
+			Id    string `json:"id"`
+			Audio string `json:"audio"`
+		}
+		if err := json.Unmarshal(payload, &legacyMessage); err != nil {
+			return AudioMessage{}, err
+		}
+		audio, err := base64.StdEncoding.DecodeString(legacyMessage.Audio)
+		if err != nil {
+			return AudioMessage{}, err
+		}
+		return AudioMessage{Id: legacyMessage.Id, Audio: audio, Format: AudioFormatWav, Channels: 1}, nil
+	}
+
+	if len(payload) < audioMessageHeaderSize {
+		return AudioMessage{}, errors.New("audio message is shorter than its header")
+	}
+	if payload[4] != AudioMessageVersion {
+		return AudioMessage{}, fmt.Errorf("unsupported audio message version %d", payload[4])
+	}
+	tooShort := errors.New("audio message is shorter than its header says")
+	audioLength := int(binary.BigEndian.Uint32(payload[12:16]))
+	idEnd := audioMessageHeaderSize + int(binary.BigEndian.Uint16(payload[16:18]))
+	if len(payload) < idEnd {
+		return AudioMessage{}, tooShort
+	}
+	message := AudioMessage{
+		Id:         string(payload[audioMessageHeaderSize:idEnd]),
+		SampleRate: binary.BigEndian.Uint32(payload[8:12]),
+		Format:     payload[5],
+		Channels:   payload[6],
+		Flags:      payload[7],
+	}
+	audioStart := idEnd
+	if message.Flags&AudioFlagDeadline != 0 {
+		if len(payload) < audioStart+8 {
+			return AudioMessage{}, tooShort
+		}
+		message.Deadline = math.Float64frombits(binary.BigEndian.Uint64(payload[audioStart : audioStart+8]))
+		audioStart += 8
+	}
+	if message.Flags&AudioFlagSession != 0 {
+		if len(payload) < audioStart+2 {
+			return AudioMessage{}, tooShort
+		}
+		sessionEnd := audioStart + 2 + int(binary.BigEndian.Uint16(payload[audioStart:audioStart+2]))
+		if len(payload) < sessionEnd {
+			return AudioMessage{}, tooShort
+		}
+		message.Session = string(payload[audioStart+2 : sessionEnd])
+		audioStart = sessionEnd
+	}
+	if len(payload) < audioStart+audioLength {
+		return AudioMessage{}, tooShort
+	}
+	message.Audio = payload[audioStart : audioStart+audioLength]
+	return message, nil
 }
 
 func TextMatches(text string, checks []string) map[int]string {
@@ -181,18 +349,30 @@ func (core Core) LogFatal(text string) {
 	log.Fatal(logMessage)
 }
 
-func (core Core) PlayAudioFile(audio string, requestId string) {
-	audioPlaybackMessage := map[string]string{
-		"id":    requestId,
-		"audio": audio,
+// Plays the bytes of a WAV file
+func (core Core) PlayAudioFile(audio []byte, requestId string) {
+	core.PlayAudio(AudioMessage{Audio: audio, Format: AudioFormatWav}, requestId)
+}
+
+func (core Core) PlayAudio(audio AudioMessage, requestId string) {
+	audio.Id = requestId
+	core.MqttClient.Publish(fmt.Sprintf(PlayAudioFileTopic, core.DeviceId), BloobQOS, false, EncodeAudioMessage(audio))
+}
+
+// Records how long a stage of handling requestId took, for putting together a timeline of the request
+func (core Core) PublishSpan(requestId string, name string, start time.Time, end time.Time, attributes map[string]interface{}) {
+	coreId := core.Id
+	if coreId == "" {
+		coreId = core.FriendlyName
 	}
-	audioPlaybackJson, err := json.Marshal(audioPlaybackMessage)
+	if attributes == nil {
+		attributes = map[string]interface{}{}
+	}
+	spanJson, err := json.Marshal(Span{Id: requestId, CoreId: coreId, Name: name, Start: UnixSeconds(start), End: UnixSeconds(end), Attributes: attributes})
 	if err != nil {
 		core.LogFatal(err.Error())
-
 	}
-
-	core.MqttClient.Publish(fmt.Sprintf(PlayAudioFileTopic, core.DeviceId), BloobQOS, false, audioPlaybackJson)
+	core.MqttClient.Publish(fmt.Sprintf(TracesTopic, core.DeviceId), 0, false, spanJson)
 }
 
 func (core Core) StartRecordingAudio(requestId string) {
@@ -206,18 +386,9 @@ func (core Core) StartRecordingAudio(requestId string) {
 	core.MqttClient.Publish(fmt.Sprintf(RecordSpeechTopic, core.DeviceId), BloobQOS, false, audioRecordJson)
 }
 
-func (core Core) TranscribeAudioFile(audio string, requestId string) {
-	audioTranscribeMessage := map[string]string{
-		"id":    requestId,
-		"audio": audio,
-	}
-	audioTranscribeJson, err := json.Marshal(audioTranscribeMessage)
-	if err != nil {
-		core.LogFatal(err.Error())
-
-	}
-
-	core.MqttClient.Publish(fmt.Sprintf(TranscribeAudioTopic, core.DeviceId), BloobQOS, false, audioTranscribeJson)
+func (core Core) TranscribeAudio(audio AudioMessage, requestId string) {
+	audio.Id = requestId
+	core.MqttClient.Publish(fmt.Sprintf(TranscribeAudioTopic, core.DeviceId), BloobQOS, false, EncodeAudioMessage(audio))
 }
 
 func (core Core) IntentParseText(text string, requestId string) {
@@ -248,10 +419,22 @@ func (core Core) SendIntentToCore(intent string, text string, coreId string, req
 }
 
 func (core Core) SpeakText(text string, requestId string) {
-	ttsMessage := map[string]string{
+	core.SpeakTextWithin(text, requestId, 0, "")
+}
+
+// As SpeakText, but the TTS drops the request if it's not reached before deadline (Unix seconds, 0 for none), or if
+// a newer request with the same session (if not "") arrives first
+func (core Core) SpeakTextWithin(text string, requestId string, deadline float64, session string) {
+	ttsMessage := map[string]interface{}{
 		"id":   requestId,
 		"text": text,
 	}
+	if deadline != 0 {
+		ttsMessage["deadline"] = deadline
+	}
+	if session != "" {
+		ttsMessage["session"] = session
+	}
 	ttsMessageJson, err := json.Marshal(ttsMessage)
 	if err != nil {
 		core.LogFatal(err.Error())
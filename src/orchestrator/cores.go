@@ -1,6 +1,7 @@
 package main
 
 import (
+	"bufio"
 	"fmt"
 	"io/fs"
 	"os"
@@ -12,6 +13,8 @@ import (
 type Core struct {
 	Id   string
 	Exec *exec.Cmd
+	// The pybloob_host or pybloob_zygote process which runs other Cores, and isn't a Core itself
+	IsHost bool
 }
 
 func scanForCores(paths []string) []string {
@@ -51,18 +54,42 @@ func pathIsCore(path string) (bool, error) {
 	return false, nil
 }
 
-// Starts a Core that presently only has a path
-func createCore(corePath string, coreChannel chan<- Core) {
-	orchestratorProvidedArgs := []string{"--device-id", bloobConfig["uuid"].(string), "--host", mqttConfig.Host, "--port", fmt.Sprintf("%v", mqttConfig.Port)}
+func orchestratorProvidedArgs() []string {
+	providedArgs := []string{"--device-id", bloobConfig["uuid"].(string), "--host", mqttConfig.Host, "--port", fmt.Sprintf("%v", mqttConfig.Port)}
 
 	if mqttConfig.Username != "" && mqttConfig.Password != "" {
-		orchestratorProvidedArgs = append(orchestratorProvidedArgs, "--user", mqttConfig.Username, "--pass", mqttConfig.Password)
+		providedArgs = append(providedArgs, "--user", mqttConfig.Username, "--pass", mqttConfig.Password)
 	}
+	return providedArgs
+}
 
-	fileName := filepath.Base(corePath)
+// Whether a Core is a Python script, going by its shebang
+func pathIsPythonCore(corePath string) bool {
+	coreFile, err := os.Open(corePath)
+	if err != nil {
+		return false
+	}
+	defer coreFile.Close()
+	firstLine, _ := bufio.NewReader(coreFile).ReadString('\n')
+	return strings.HasPrefix(firstLine, "#!") && strings.Contains(firstLine, "python")
+}
 
-	// Follows the naming convention where Cores are named {core_id}_bb_core
-	coreId := strings.Split(fileName, "_bb_core")[0]
+// Follows the naming convention where Cores are named {core_id}_bb_core
+func coreIdFromPath(corePath string) string {
+	return strings.Split(filepath.Base(corePath), "_bb_core")[0]
+}
+
+// Starts a Core that presently only has a path
+func createCore(corePath string, coreChannel chan<- Core) {
+	coreChannel <- Core{Id: coreIdFromPath(corePath), Exec: exec.Command(corePath, orchestratorProvidedArgs()...)}
+}
+
+// Runs several Python Cores in one process (see src/pybloob/pybloob_host.py), which share an interpreter and MQTT connection
+func createCoreHost(hostPath string, corePaths []string) Core {
+	return Core{Id: "core_host", Exec: exec.Command("python3", append(append([]string{hostPath}, orchestratorProvidedArgs()...), corePaths...)...), IsHost: true}
+}
 
-	coreChannel <- Core{Id: coreId, Exec: exec.Command(corePath, orchestratorProvidedArgs...)}
+// Forks Python Cores from one process which has already imported their shared modules (see src/pybloob/pybloob_zygote.py)
+func createCoreZygote(zygotePath string, corePaths []string) Core {
+	return Core{Id: "core_zygote", Exec: exec.Command("python3", append(append([]string{zygotePath}, orchestratorProvidedArgs()...), corePaths...)...), IsHost: true}
 }
@@ -6,6 +6,8 @@ import (
 	"log"
 	"math/rand"
 	"strings"
+	"sync"
+	"time"
 
 	bloob "blueberry/gobloob"
 
@@ -14,9 +16,6 @@ import (
 
 var wakewordReceived bloob.WakewordResponse
 
-var recordedAudio string
-var audioRecorderReceived bloob.AudioRecorderResponse
-
 var transcription string
 var transcriptionReceived bloob.TranscriptionResponse
 
@@ -24,12 +23,63 @@ var intentParserReceived bloob.IntentParseResponse
 
 var coreFinishedReceived bloob.CoreResponse
 
-var ttsReceived bloob.TTSResponse
-
 // var collectionIds []string
 
 var currentId string = ""
 
+// Held while handling a message or a request timing out, which happen on different goroutines
+var requestLock sync.Mutex
+
+// Ends the current request once requestTimeout has passed since its wakeword, in case nothing ever answers it
+var requestTimer *time.Timer
+
+// When the current request's wakeword was detected, for its "request" span covering the whole thing
+var requestStart time.Time
+
+// Requests to the STT and TTS are all in one session, so each new one supersedes any older ones still waiting, and
+// carry a deadline of requestTimeout after the wakeword (if set), after which they're dropped. The session includes
+// this device's ID, as an STT shared by several devices (see the STT's remote mode) sees all their requests.
+var requestSession string = "orchestrator"
+
+var requestTimeout time.Duration = 0
+
+func requestDeadline() float64 {
+	if requestTimeout == 0 {
+		return 0
+	}
+	return bloob.UnixSeconds(requestStart.Add(requestTimeout))
+}
+
+// When a Core streams its output (see bloob.CoreChunk), each part is spoken as it arrives rather than waiting for the
+// whole thing, and the request only ends once the final part's been received and every part's audio has come back
+var streamingId string = ""
+var chunksSpeaking int = 0
+var streamFinished bool = false
+
+func endRequest(id string, outcome string) {
+	c.PublishSpan(id, "request", requestStart, time.Now(), map[string]interface{}{"outcome": outcome})
+	currentId = ""
+	streamingId = ""
+	if requestTimer != nil {
+		requestTimer.Stop()
+		requestTimer = nil
+	}
+	c.Log("Waiting for wakeword...")
+}
+
+func timeoutRequest(id string) {
+	requestLock.Lock()
+	defer requestLock.Unlock()
+	if currentId != id {
+		return
+	}
+	c.Log(fmt.Sprintf("Request timed out after %v", requestTimeout))
+	c.SetRecording(false)
+	c.SetThinking(false)
+	c.PlayAudioFile(errorAudio, id)
+	endRequest(id, "timeout")
+}
+
 var onConnect mqtt.OnConnectHandler = func(client mqtt.Client) {
 	c.Log("Connected to MQTT broker")
 }
@@ -44,12 +94,24 @@ var remoteLogDisplay mqtt.MessageHandler = func(client mqtt.Client, message mqtt
 // Also work on not responding to a new wakeword during the processing of another request. Could use the currentIds array
 // if I remove them once done.
 var pipelineMessageHandler mqtt.MessageHandler = func(client mqtt.Client, message mqtt.Message) {
+	requestLock.Lock()
+	defer requestLock.Unlock()
+
 	if strings.Contains(message.Topic(), "wakeword_util/finished") {
 		// If a current request isn't ongoing
 		if currentId == "" {
 			newId := fmt.Sprintf("%d", rand.Uint32())
 			currentId = newId
+			wakewordReceived = bloob.WakewordResponse{}
 			json.Unmarshal(message.Payload(), &wakewordReceived)
+			requestStart = time.Now()
+			if wakewordReceived.DetectedAt != 0 {
+				requestStart = time.Unix(0, int64(wakewordReceived.DetectedAt*1e9))
+			}
+			c.PublishSpan(newId, "wakeword", requestStart, time.Now(), map[string]interface{}{"wakeword_id": wakewordReceived.WakewordId})
+			if requestTimeout != 0 {
+				requestTimer = time.AfterFunc(time.Until(requestStart.Add(requestTimeout)), func() { timeoutRequest(newId) })
+			}
 			// TODO: Add Instant Intent support
 			c.Log(fmt.Sprintf("Wakeword Received - %v (confidence %v) - recording audio", wakewordReceived.WakewordId, wakewordReceived.Confidence))
 
@@ -67,15 +129,20 @@ var pipelineMessageHandler mqtt.MessageHandler = func(client mqtt.Client, messag
 	}
 
 	if strings.Contains(message.Topic(), "audio_recorder_util/finished") {
-		json.Unmarshal(message.Payload(), &audioRecorderReceived)
+		audioRecorderReceived, err := bloob.DecodeAudioMessage(message.Payload())
+		if err != nil {
+			c.Log(fmt.Sprintf("Received invalid audio from the Audio Recorder: %s", err.Error()))
+			return
+		}
 
 		if currentId == audioRecorderReceived.Id {
 			c.SetRecording(false)
 			c.PlayAudioFile(stopListeningAudio, audioRecorderReceived.Id)
 			c.SetThinking(true)
 			c.Log("Received recording, starting transcription")
-			recordedAudio = audioRecorderReceived.Audio
-			c.TranscribeAudioFile(recordedAudio, audioRecorderReceived.Id)
+			audioRecorderReceived.Deadline = requestDeadline()
+			audioRecorderReceived.Session = requestSession
+			c.TranscribeAudio(audioRecorderReceived, audioRecorderReceived.Id)
 		}
 	}
 
@@ -104,8 +171,7 @@ var pipelineMessageHandler mqtt.MessageHandler = func(client mqtt.Client, messag
 			} else {
 				c.PlayAudioFile(errorAudio, intentParserReceived.Id)
 				c.Log("No Intent Found in speech")
-				currentId = ""
-				c.Log("Waiting for wakeword...")
+				endRequest(intentParserReceived.Id, "no_intent")
 				// speakText("I'm sorry, I don't understand what you said", intentParserReceived.Id)
 			}
 
@@ -113,6 +179,32 @@ var pipelineMessageHandler mqtt.MessageHandler = func(client mqtt.Client, messag
 
 	}
 
+	if strings.Contains(message.Topic(), "/cores") && strings.HasSuffix(message.Topic(), "/stream") {
+		var chunkReceived bloob.CoreChunk
+		json.Unmarshal(message.Payload(), &chunkReceived)
+
+		if currentId == chunkReceived.Id {
+			if streamingId != chunkReceived.Id {
+				streamingId = chunkReceived.Id
+				chunksSpeaking = 0
+				streamFinished = false
+			}
+			if chunkReceived.Text != "" {
+				c.Log(fmt.Sprintf("Core streamed the output: %v", chunkReceived.Text))
+				chunksSpeaking++
+				c.SpeakTextWithin(chunkReceived.Text, chunkReceived.Id, requestDeadline(), requestSession)
+			}
+			if chunkReceived.Final {
+				streamFinished = true
+				// Nothing was streamed, so there's nothing left to wait for
+				if chunksSpeaking == 0 {
+					c.SetThinking(false)
+					endRequest(chunkReceived.Id, "spoken")
+				}
+			}
+		}
+	}
+
 	// Specifically, here, I do not want responses from Utils, only regular Cores
 	if strings.Contains(message.Topic(), "/cores") && strings.Contains(message.Topic(), "/finished") && !strings.Contains(message.Topic(), "util") {
 		json.Unmarshal(message.Payload(), &coreFinishedReceived)
@@ -120,23 +212,56 @@ var pipelineMessageHandler mqtt.MessageHandler = func(client mqtt.Client, messag
 		if currentId == coreFinishedReceived.Id {
 			c.Log(fmt.Sprintf("Core ran with the output: %v", coreFinishedReceived.Text))
 
-			c.SpeakText(coreFinishedReceived.Text, coreFinishedReceived.Id)
+			// A streamed output's already been spoken, part by part
+			if streamingId != coreFinishedReceived.Id {
+				c.SpeakTextWithin(coreFinishedReceived.Text, coreFinishedReceived.Id, requestDeadline(), requestSession)
+			}
 		}
 
 	}
 
+	// The STT or TTS dropped (part of) the current request without working on it, so nothing more is coming for it
+	if strings.HasSuffix(message.Topic(), "/dropped") {
+		var droppedReceived bloob.DroppedResponse
+		json.Unmarshal(message.Payload(), &droppedReceived)
+
+		if currentId == droppedReceived.Id {
+			c.Log(fmt.Sprintf("%s dropped the request (%s)", strings.Split(message.Topic(), "/")[3], droppedReceived.Reason))
+			// Only one part of a streamed output was dropped, and the rest may still be spoken
+			if streamingId == droppedReceived.Id && strings.Contains(message.Topic(), "/tts_util/") {
+				chunksSpeaking--
+				if !streamFinished || chunksSpeaking > 0 {
+					return
+				}
+			} else {
+				c.PlayAudioFile(errorAudio, droppedReceived.Id)
+			}
+			c.SetThinking(false)
+			endRequest(droppedReceived.Id, "dropped")
+		}
+	}
+
 	if strings.Contains(message.Topic(), "/tts_util/finished") {
-		json.Unmarshal(message.Payload(), &ttsReceived)
+		ttsReceived, err := bloob.DecodeAudioMessage(message.Payload())
+		if err != nil {
+			c.Log(fmt.Sprintf("Received invalid audio from the TTS: %s", err.Error()))
+			return
+		}
 
 		if currentId == ttsReceived.Id {
 			c.SetThinking(false)
 			c.Log("Text Spoken")
 
-			c.PlayAudioFile(ttsReceived.Audio, ttsReceived.Id)
+			c.PlayAudio(ttsReceived, ttsReceived.Id)
 
-			// Reset the currentId to 0 so that we'll accept another wakeword
-			currentId = ""
-			c.Log("Waiting for wakeword...")
+			if streamingId == ttsReceived.Id {
+				chunksSpeaking--
+				if !streamFinished || chunksSpeaking > 0 {
+					return
+				}
+			}
+			// Reset the currentId so that we'll accept another wakeword
+			endRequest(ttsReceived.Id, "spoken")
 
 		}
 
@@ -1,13 +1,13 @@
 package main
 
 import (
-	"encoding/base64"
 	"encoding/json"
 	"errors"
 	"fmt"
 	"os"
 	"os/signal"
 	"path/filepath"
+	"slices"
 	"syscall"
 	"time"
 
@@ -16,10 +16,10 @@ import (
 	mqtt "github.com/eclipse/paho.mqtt.golang"
 )
 
-var beginListeningAudio string
-var stopListeningAudio string
-var errorAudio string
-var instantIntentAudio string
+var beginListeningAudio []byte
+var stopListeningAudio []byte
+var errorAudio []byte
+var instantIntentAudio []byte
 var bloobConfig map[string]interface{}
 
 var instantIntents map[string]string = make(map[string]string)
@@ -149,35 +149,31 @@ func main() {
 	// Load sounds into memory
 
 	{
-		beginListeningAudioBytes, err := os.ReadFile(beginListeningAudioPath)
+		beginListeningAudio, err = os.ReadFile(beginListeningAudioPath)
 		if err != nil {
 			c.LogFatal(fmt.Sprintf("Failed to read listening audio file (%v): %v", beginListeningAudioPath, err))
 		}
-		beginListeningAudio = base64.StdEncoding.EncodeToString(beginListeningAudioBytes)
 	}
 
 	{
-		stopListeningAudioBytes, err := os.ReadFile(stopListeningAudioPath)
+		stopListeningAudio, err = os.ReadFile(stopListeningAudioPath)
 		if err != nil {
 			c.LogFatal(fmt.Sprintf("Failed to read listening audio file (%v): %v", beginListeningAudioPath, err))
 		}
-		stopListeningAudio = base64.StdEncoding.EncodeToString(stopListeningAudioBytes)
 	}
 
 	{
-		errorAudioBytes, err := os.ReadFile(errorAudioPath)
+		errorAudio, err = os.ReadFile(errorAudioPath)
 		if err != nil {
 			c.LogFatal(fmt.Sprintf("Failed to read listening audio file (%v): %v", beginListeningAudioPath, err))
 		}
-		errorAudio = base64.StdEncoding.EncodeToString(errorAudioBytes)
 	}
 
 	{
-		instantIntentAudioBytes, err := os.ReadFile(instantIntentAudioPath)
+		instantIntentAudio, err = os.ReadFile(instantIntentAudioPath)
 		if err != nil {
 			c.LogFatal(fmt.Sprintf("Failed to read listening audio file (%v): %v", beginListeningAudioPath, err))
 		}
-		instantIntentAudio = base64.StdEncoding.EncodeToString(instantIntentAudioBytes)
 	}
 
 	//// Set up MQTT
@@ -204,6 +200,8 @@ func main() {
 	// Maybe better than the subscribemultiple
 	subscribeMqttTopics := map[string]byte{
 		fmt.Sprintf("bloob/%s/cores/+/finished", bloobConfig["uuid"]): bloob.BloobQOS,
+		fmt.Sprintf("bloob/%s/cores/+/stream", bloobConfig["uuid"]):   bloob.BloobQOS,
+		fmt.Sprintf("bloob/%s/cores/+/dropped", bloobConfig["uuid"]):  bloob.BloobQOS,
 	}
 
 	if token := client.Connect(); token.Wait() && token.Error() != nil {
@@ -223,9 +221,17 @@ func main() {
 		}
 	}
 
+	// With request_timeout, the STT and TTS drop work for a request that's been going on longer than that, and the
+	// request is ended then if it hasn't finished
+	if timeout, ok := bloobConfig["orchestrator"].(map[string]interface{})["request_timeout"]; ok {
+		requestTimeout = time.Duration(timeout.(float64) * float64(time.Second))
+	}
+	requestSession = fmt.Sprintf("orchestrator:%s", bloobConfig["uuid"].(string))
+
 	// c.Log now has access to MQTT logging
 	c.MqttClient = client
 	c.DeviceId = bloobConfig["uuid"].(string)
+	c.Id = "orchestrator"
 
 	//// Load Cores
 	c.Log(fmt.Sprintf("User Cores dir: %s", userCoresDir))
@@ -233,6 +239,63 @@ func main() {
 
 	var corePaths []string = scanForCores([]string{userCoresDir, installCoresDir, installUtilsDir})
 	var runningCores []Core
+
+	// Lightweight Python Cores listed in hosted_cores all run in one pybloob_host process, rather than one process each
+	var hostedCorePaths []string
+	if hostedCores, ok := bloobConfig["orchestrator"].(map[string]interface{})["hosted_cores"]; ok {
+		var hostedCoreIds []string
+		for _, hostedCoreId := range hostedCores.([]interface{}) {
+			hostedCoreIds = append(hostedCoreIds, hostedCoreId.(string))
+		}
+		var separateCorePaths []string
+		for _, corePath := range corePaths {
+			if slices.Contains(hostedCoreIds, coreIdFromPath(corePath)) {
+				hostedCorePaths = append(hostedCorePaths, corePath)
+			} else {
+				separateCorePaths = append(separateCorePaths, corePath)
+			}
+		}
+		corePaths = separateCorePaths
+	}
+	if len(hostedCorePaths) > 0 {
+		coreHost := createCoreHost(filepath.Join(installDir, "src", "pybloob", "pybloob_host.py"), hostedCorePaths)
+		err := coreHost.Exec.Start()
+		if err != nil {
+			c.LogFatal(err.Error())
+		}
+		runningCores = append(runningCores, coreHost)
+		for _, hostedCorePath := range hostedCorePaths {
+			runningCores = append(runningCores, Core{Id: coreIdFromPath(hostedCorePath), Exec: nil})
+			c.Log(fmt.Sprintf("Started %s in the Core host", coreIdFromPath(hostedCorePath)))
+		}
+	}
+
+	// With preload_python_cores, the remaining Python Cores are forked from one pybloob_zygote process, so start faster and share memory
+	if preloadPythonCores, ok := bloobConfig["orchestrator"].(map[string]interface{})["preload_python_cores"]; ok && preloadPythonCores.(bool) {
+		var pythonCorePaths []string
+		var otherCorePaths []string
+		for _, corePath := range corePaths {
+			if pathIsPythonCore(corePath) {
+				pythonCorePaths = append(pythonCorePaths, corePath)
+			} else {
+				otherCorePaths = append(otherCorePaths, corePath)
+			}
+		}
+		if len(pythonCorePaths) > 0 {
+			coreZygote := createCoreZygote(filepath.Join(installDir, "src", "pybloob", "pybloob_zygote.py"), pythonCorePaths)
+			err := coreZygote.Exec.Start()
+			if err != nil {
+				c.LogFatal(err.Error())
+			}
+			runningCores = append(runningCores, coreZygote)
+			for _, pythonCorePath := range pythonCorePaths {
+				runningCores = append(runningCores, Core{Id: coreIdFromPath(pythonCorePath), Exec: nil})
+				c.Log(fmt.Sprintf("Started %s from the Core zygote", coreIdFromPath(pythonCorePath)))
+			}
+		}
+		corePaths = otherCorePaths
+	}
+
 	coreReceiver := make(chan Core)
 	for _, corePath := range corePaths {
 		go createCore(corePath, coreReceiver)
@@ -262,6 +325,9 @@ func main() {
 	var listOfCores []string
 	var topicToPublish string = "bloob/%s/cores/%s/central_config"
 	for _, core := range runningCores {
+		if core.IsHost {
+			continue
+		}
 
 		value, ok := bloobConfig[core.Id]
 		if ok {
@@ -1,62 +1,208 @@
-import paho.mqtt.publish as publish
-import paho.mqtt.subscribe as subscribe
+import paho.mqtt.client as mqtt
 import json
 import random
+import queue
+import threading
+import atexit
+import importlib
+import functools
+import collections
+import pathlib
+import time
+import os
+import hashlib
+import struct
+import base64
+import wave
+import io
+import re
+import traceback
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
 
 bloobQOS = 1
 
-# Can be provided with a list, which should contain objects with .names, 
-# which is a list of potential different names for the device, where the first is
-# the preferred name. It'll search for any of the names in spoken_words
-# (or in the check_string arg if provided), and return those devices' objects in spoken order
-def getDeviceMatches(device_list, check_string):
-  check_string = check_string.lower()
+default_data_path = pathlib.Path.home().joinpath(".config/bloob")
+default_state_cache_path = default_data_path.joinpath("state_cache")
+
+# How long to wait to hear what's already retained before publishing Intents / Collections anyway
+retained_sync_timeout = 2
+# How long a Core waits for the broker to accept its connection (the same as paho's default keepalive)
+connect_timeout = 60
+
+log_level_debug = 10
+log_level_info = 20
+log_level_warning = 30
+log_level_error = 40
+log_level_names = {log_level_debug: "DEBUG", log_level_warning: "WARNING", log_level_error: "ERROR"}
+
+# Bigger, optional parts of pybloob live in their own modules (which may need extra packages, like aiomqtt for AsyncCore),
+# and are only imported the first time a Core actually uses them, like pybloob.AsyncCore
+lazy_attributes = {
+  "AsyncCore": "pybloob_async",
+  "SharedAudioRing": "pybloob_shared_audio",
+  "encodeOpus": "pybloob_opus",
+  "TraceCollector": "pybloob_tracing",
+  "MetricsRegistry": "pybloob_metrics",
+  "RpcClient": "pybloob_rpc",
+  "HttpClient": "pybloob_http",
+}
 
-  ## We want to return the actual device object, rather than just the text name of it.
-  name_matches = []
-  device_matches = []
+def __getattr__(name):
+  if name in lazy_attributes:
+    return getattr(importlib.import_module(lazy_attributes[name]), name)
+  raise AttributeError(f"module 'pybloob' has no attribute '{name}'")
 
-  ## Firstly, we loop over the devices, get their names, and append the found names to a list (we cannot order the devices in this step
-  ## since they would get ordered by their appearance in the main devices list, rather than in the spoken words)
-  for device in device_list:
-    for name in device.names:
-      if name.lower() in check_string:
-        name_matches.append(name)
+# paho-mqtt 2 wants to be told which callback signatures we expect, where 1.x doesn't know about that argument at all.
+# The callbacks in here are written to work with both.
+def createMqttClient(client_id: str=""):
+  if hasattr(mqtt, "CallbackAPIVersion"):
+    return mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=client_id)
+  else:
+    return mqtt.Client(client_id=client_id)
 
-  ## Sort these names by their appearance in the spoken text
-  name_matches.sort(key=lambda name: check_string.find(name.lower()))
+# Finds many phrases in some text in a single pass, however many phrases there are, rather than checking for them one by one.
+# Build it once (it's an Aho-Corasick automaton under the hood) and reuse it for every request, with each phrase
+# optionally mapped to a value (like the device object that a name belongs to), which is what gets returned.
+# If whole_words_only is True, a phrase only counts when it isn't part of a bigger word ("time" won't match "times"),
+# and multi-word phrases work too.
+class Matcher:
+  def __init__(self, phrases: list=None, whole_words_only: bool=False):
+    self.whole_words_only = whole_words_only
+    # Lowercased phrase -> index, with the values for each index kept in the same order they were added
+    self.phrase_indexes = {}
+    self.phrases = []
+    self.values = []
+    self._compiled = False
 
-  ## Go through each spoken device name in the order that it appears, find its matching device, and append it to a list.
-  for name in name_matches:
+    if phrases != None:
+      for phrase in phrases:
+        self.add(phrase)
+
+  ## Build a Matcher for a list of objects with .names (like getDeviceMatches takes), which returns the objects themselves
+  @classmethod
+  def fromDevices(cls, device_list: list, whole_words_only: bool=False):
+    matcher = cls(whole_words_only=whole_words_only)
     for device in device_list:
-      if name in device.names:
-        device_matches.append(device)
-        
-  return(device_matches)
+      for name in device.names:
+        matcher.add(name, device)
+    return matcher
+
+  ## Adds a phrase, which will return value when found (or the phrase itself if there's no value)
+  def add(self, phrase: str, value=None):
+    if phrase == "":
+      return
+    if value == None:
+      value = phrase
+    lowered_phrase = phrase.lower()
+    if lowered_phrase not in self.phrase_indexes:
+      self.phrase_indexes[lowered_phrase] = len(self.phrases)
+      self.phrases.append(lowered_phrase)
+      self.values.append([])
+    self.values[self.phrase_indexes[lowered_phrase]].append(value)
+    self._compiled = False
+
+  def _compile(self):
+    # Trie of all the phrases, where each state is a dict of character -> next state
+    self._transitions = [{}]
+    self._outputs = [[]]
+    for phrase_index, phrase in enumerate(self.phrases):
+      state = 0
+      for character in phrase:
+        if character not in self._transitions[state]:
+          self._transitions.append({})
+          self._outputs.append([])
+          self._transitions[state][character] = len(self._transitions) - 1
+        state = self._transitions[state][character]
+      self._outputs[state].append(phrase_index)
+
+    # Each state's fallback is the longest bit of the phrase so far that's also the start of another phrase, so on a
+    # mismatch we carry on from there instead of going back to the start of the text. Done breadth first, so that
+    # shorter states' fallbacks are always ready before they're needed.
+    self._fallbacks = [0] * len(self._transitions)
+    states_to_visit = collections.deque(self._transitions[0].values())
+    while states_to_visit:
+      state = states_to_visit.popleft()
+      for character, next_state in self._transitions[state].items():
+        states_to_visit.append(next_state)
+        fallback = self._fallbacks[state]
+        while fallback != 0 and character not in self._transitions[fallback]:
+          fallback = self._fallbacks[fallback]
+        self._fallbacks[next_state] = self._transitions[fallback].get(character, 0)
+        self._outputs[next_state] = self._outputs[next_state] + self._outputs[self._fallbacks[next_state]]
+
+    self._compiled = True
+
+  ## Returns (start, phrase_index) for the first place that each found phrase appears, in the order they appear
+  def find(self, check_string: str):
+    if not self._compiled:
+      self._compile()
+    check_string = check_string.lower()
+    first_positions = {}
+
+    state = 0
+    for position, character in enumerate(check_string):
+      while state != 0 and character not in self._transitions[state]:
+        state = self._fallbacks[state]
+      state = self._transitions[state].get(character, 0)
+
+      for phrase_index in self._outputs[state]:
+        if phrase_index in first_positions:
+          continue
+        start = position + 1 - len(self.phrases[phrase_index])
+        if self.whole_words_only:
+          if start > 0 and check_string[start - 1] != " ":
+            continue
+          if position + 1 < len(check_string) and check_string[position + 1] != " ":
+            continue
+        first_positions[phrase_index] = start
+
+    return sorted((start, phrase_index) for phrase_index, start in first_positions.items())
+
+  ## Returns the values of every phrase found, in spoken order
+  def match(self, check_string: str):
+    return [value for _, phrase_index in self.find(check_string) for value in self.values[phrase_index]]
+
+# getDeviceMatches and getTextMatches are normally called with the same devices / phrases for every request,
+# so the Matchers are cached rather than being rebuilt each time. Devices are cached by the objects themselves,
+# so build a new device object (or your own Matcher) rather than changing the names of an existing one.
+@functools.lru_cache(maxsize=32)
+def _cachedDeviceMatcher(devices: tuple, whole_words_only: bool):
+  return Matcher.fromDevices(devices, whole_words_only=whole_words_only)
+
+@functools.lru_cache(maxsize=64)
+def _cachedTextMatcher(phrases: tuple, whole_words_only: bool):
+  return Matcher(phrases, whole_words_only=whole_words_only)
+
+# Can be provided with a list, which should contain objects with .names, 
+# which is a list of potential different names for the device, where the first is
+# the preferred name. It'll search for any of the names in spoken_words
+# (or in the check_string arg if provided), and return those devices' objects in spoken order
+def getDeviceMatches(device_list, check_string, whole_words_only=False):
+  try:
+    matcher = _cachedDeviceMatcher(tuple(device_list), whole_words_only)
+  except TypeError:
+    # Devices that can't be hashed can't be cached either
+    matcher = Matcher.fromDevices(device_list, whole_words_only=whole_words_only)
+
+  return(matcher.match(check_string))
 
 # Can be provided with a str, or list, where it'll search for that str or 
 # each str in the list as a whole word in spoken_words (or whatever the check_string arg is)
 # and return them in spoken order
 def getTextMatches(match_item, check_string, whole_words_only=False):
-  check_string = check_string.lower()
-
   # If we're given a list, we'll check for everything in that list, and return it in the order that it was spoken
-  # We split the input string into words, so that we only match whole words
+  # With whole_words_only, phrases must be whole words (or several whole words)
   if type(match_item) is list:
-    if whole_words_only:
-      matches = [phrase for phrase in match_item if(phrase.lower() in check_string.split(" "))]
-      matches.sort(key=lambda phrase: check_string.find(phrase.lower()))
-      return(matches)
-    else:
-      matches = [phrase for phrase in match_item if(phrase.lower() in check_string)]
-      matches.sort(key=lambda phrase: check_string.find(phrase.lower()))
-      return(matches)
+    return(_cachedTextMatcher(tuple(match_item), whole_words_only).match(check_string))
   # If it's a string, check for it as a standalone word
   elif type(match_item) is str:
+    check_string = check_string.lower()
     # This converts the string into a list so that we only get whole word matches
     # Otherwise, "what's 8 times 12" would count as valid for checking the "time"
-    # TODO: In the list section, check if phrases are only a single word, and use this logic
-    # if so, otherwise use the current checking logic.
     if whole_words_only:    
       if match_item in check_string.split(" "):
         return(match_item)
@@ -161,60 +307,1310 @@ class Collection:
 
     return collection_dict
 
-class Core:
-  def __init__(self, device_id: str, core_id:str, mqtt_host: str, mqtt_port: int, mqtt_user: str=None, mqtt_pass: str=None, core_config: CoreConfig=None, intents: list=None, collections: list=None):
+# The JSON messages sent between Utils, Cores and the orchestrator, each with one way of encoding and decoding it.
+# Decoding checks the message has the fields it needs (with the right types), raising MessageError if not, so a bad
+# message is turned away where it arrives rather than breaking something further along. Uses orjson when it's
+# installed (pip install pybloob[fast]), which is several times faster than json.
+class MessageError(ValueError):
+  pass
+
+if orjson != None:
+  def encodeJson(item) -> bytes:
+    return orjson.dumps(item)
+
+  def decodeJson(payload):
+    return orjson.loads(payload)
+else:
+  def encodeJson(item) -> bytes:
+    return json.dumps(item, separators=(",", ":")).encode()
+
+  def decodeJson(payload):
+    return json.loads(payload)
+
+class Message:
+  # Field name -> (accepted type(s), whether it's required). Optional fields are None when missing.
+  fields = {}
+  __slots__ = ()
+
+  @classmethod
+  def decode(cls, payload):
+    try:
+      message_dict = decodeJson(payload)
+    except ValueError as e:
+      raise MessageError(f"{cls.__name__} isn't valid JSON: {e}")
+    if type(message_dict) != dict:
+      raise MessageError(f"{cls.__name__} should be a JSON object")
+
+    field_values = {}
+    for field_name, (field_type, required) in cls.fields.items():
+      field_value = message_dict.get(field_name)
+      if field_value == None:
+        if required:
+          raise MessageError(f"{cls.__name__} is missing \"{field_name}\"")
+      elif not isinstance(field_value, field_type):
+        field_type_names = " or ".join(accepted_type.__name__ for accepted_type in (field_type if type(field_type) == tuple else (field_type,)))
+        raise MessageError(f"{cls.__name__}'s \"{field_name}\" should be {field_type_names}, not {type(field_value).__name__}")
+      field_values[field_name] = field_value
+    return cls(**field_values)
+
+  def asdict(self):
+    message_dict = {}
+    for field_name in self.fields:
+      field_value = getattr(self, field_name)
+      if field_value != None:
+        message_dict[field_name] = field_value
+    return message_dict
+
+  def encode(self) -> bytes:
+    return encodeJson(self.asdict())
+
+  def __repr__(self):
+    return f"{type(self).__name__}({self.asdict()})"
+
+  # Read-only dict-style access to the fields (message["text"], message.get("intent")), so code written for when
+  # these were plain dicts keeps working. Optional fields that are None count as missing, as they would in the JSON.
+  def __getitem__(self, field_name: str):
+    field_value = getattr(self, field_name) if field_name in self.fields else None
+    if field_value == None:
+      raise KeyError(field_name)
+    return field_value
+
+  def get(self, field_name: str, default=None):
+    try:
+      return self[field_name]
+    except KeyError:
+      return default
+
+  def __contains__(self, field_name: str):
+    return self.get(field_name) != None
+
+  def keys(self):
+    return self.asdict().keys()
+
+  def __eq__(self, other):
+    return type(self) == type(other) and self.asdict() == other.asdict()
+
+## bloob/<device_id>/cores/<core_id>/dropped, from Utils that drop a request instead of answering it (see RequestQueue)
+class DroppedMessage(Message):
+  fields = {"id": (str, True), "reason": (str, True)}
+  __slots__ = tuple(fields)
+
+  def __init__(self, id: str, reason: str):
+    self.id = id
+    self.reason = reason
+
+## What a call (see Core.call) fails with when whoever it called drops the request, with the DroppedMessage's reason
+class DroppedError(Exception):
+  def __init__(self, request_id: str, reason: str):
+    super().__init__(f"Request {request_id} was dropped ({reason})")
+    self.request_id = request_id
+    self.reason = reason
+
+## bloob/<device_id>/cores/<core_id>/run
+class CoreRunMessage(Message):
+  fields = {"id": (str, True), "intent": (str, False), "text": (str, True), "core_id": (str, False)}
+  __slots__ = tuple(fields)
+
+  def __init__(self, id: str, text: str, intent: str=None, core_id: str=None):
+    self.id = id
+    self.text = text
+    self.intent = intent
+    self.core_id = core_id
+
+## bloob/<device_id>/cores/<core_id>/finished
+class CoreFinishedMessage(Message):
+  fields = {"id": (str, True), "text": (str, True), "explanation": (str, False), "end_type": (str, False)}
+  __slots__ = tuple(fields)
+
+  def __init__(self, id: str, text: str, explanation: str=None, end_type: str=None):
+    self.id = id
+    self.text = text
+    self.explanation = explanation
+    self.end_type = end_type
+
+## bloob/<device_id>/cores/<core_id>/stream: part of a Core's output, sent before the Core's finished so speaking can
+## start sooner (see CoreOutputStream). index counts up from 0 for each request, and the last chunk has final set (and
+## usually no text).
+class CoreChunkMessage(Message):
+  fields = {"id": (str, True), "index": (int, True), "text": (str, True), "final": (bool, False)}
+  __slots__ = tuple(fields)
+
+  def __init__(self, id: str, index: int, text: str, final: bool=None):
+    self.id = id
+    self.index = index
+    self.text = text
+    self.final = final
+
+## bloob/<device_id>/cores/wakeword_util/finished. The confidence is a str, as it's always been sent as one.
+class WakewordMessage(Message):
+  fields = {"wakeword_id": (str, True), "confidence": ((str, int, float), False), "detected_at": ((int, float), False)}
+  __slots__ = tuple(fields)
+
+  def __init__(self, wakeword_id: str, confidence: str=None, detected_at: float=None):
+    self.wakeword_id = wakeword_id
+    self.confidence = confidence
+    self.detected_at = detected_at
+
+## bloob/<device_id>/cores/audio_recorder_util/record_speech
+class RecordSpeechMessage(Message):
+  fields = {"id": (str, True)}
+  __slots__ = tuple(fields)
+
+  def __init__(self, id: str):
+    self.id = id
+
+## bloob/<device_id>/cores/stt_util/finished (and the input to the Intent Parser)
+class TranscriptMessage(Message):
+  fields = {"id": (str, True), "text": (str, True)}
+  __slots__ = tuple(fields)
+
+  def __init__(self, id: str, text: str):
+    self.id = id
+    self.text = text
+
+## bloob/<device_id>/cores/tts_util/run. deadline and session are as in AudioMessage.
+class SpeakMessage(Message):
+  fields = {"id": (str, True), "text": (str, True), "deadline": ((int, float), False), "session": (str, False)}
+  __slots__ = tuple(fields)
+
+  def __init__(self, id: str, text: str, deadline: float=None, session: str=None):
+    self.id = id
+    self.text = text
+    self.deadline = deadline
+    self.session = session
+
+## bloob/<device_id>/cores/audio_playback_util/finished
+class PlaybackFinishedMessage(Message):
+  fields = {"id": (str, True)}
+  __slots__ = tuple(fields)
+
+  def __init__(self, id: str):
+    self.id = id
+
+# Profiles are capped, so a mistyped request can't leave a Core sampling itself for hours
+profile_default_seconds = 10
+profile_max_seconds = 120
+
+## bloob/<device_id>/cores/<core_id>/debug/profile: asks a Core to sample itself for a while (see pybloob_profiling)
+class ProfileRequestMessage(Message):
+  fields = {"id": (str, True), "seconds": ((int, float), False), "interval": ((int, float), False), "format": (str, False), "include_idle": (bool, False)}
+  __slots__ = tuple(fields)
+
+  def __init__(self, id: str, seconds: float=None, interval: float=None, format: str=None, include_idle: bool=None):
+    self.id = id
+    self.seconds = seconds
+    self.interval = interval
+    self.format = format
+    self.include_idle = include_idle
+
+## bloob/<device_id>/cores/<core_id>/debug/profile/finished, with either the profile or why there isn't one
+class ProfileMessage(Message):
+  fields = {"id": (str, True), "core_id": (str, True), "format": (str, False), "seconds": ((int, float), False), "samples": (int, False), "profile": (str, False), "error": (str, False)}
+  __slots__ = tuple(fields)
+
+  def __init__(self, id: str, core_id: str, format: str=None, seconds: float=None, samples: int=None, profile: str=None, error: str=None):
+    self.id = id
+    self.core_id = core_id
+    self.format = format
+    self.seconds = seconds
+    self.samples = samples
+    self.profile = profile
+    self.error = error
+
+## Profiles this process as asked by request, returning the ProfileMessage to reply with. Blocks while sampling.
+def runProfile(request: ProfileRequestMessage, core_id: str):
+  profile_start = time.monotonic()
+  try:
+    profile, samples = importlib.import_module("pybloob_profiling").profile(request)
+  except Exception as e:
+    return ProfileMessage(request.id, core_id, request.format, error=repr(e))
+  return ProfileMessage(request.id, core_id, request.format or "collapsed", round(time.monotonic() - profile_start, 2), samples, profile)
+
+## bloob/<device_id>/cores/<core_id>/debug/memory: asks a Core which lines of code are allocating the most memory, by
+## tracing allocations for a while (see pybloob_memory.topAllocations)
+class MemoryRequestMessage(Message):
+  fields = {"id": (str, True), "seconds": ((int, float), False), "limit": (int, False)}
+  __slots__ = tuple(fields)
+
+  def __init__(self, id: str, seconds: float=None, limit: int=None):
+    self.id = id
+    self.seconds = seconds
+    self.limit = limit
+
+## bloob/<device_id>/cores/<core_id>/debug/memory/finished, with the Core's memory report (see pybloob_memory.MemoryMonitor)
+## and top allocations, or why there aren't any
+class MemoryMessage(Message):
+  fields = {"id": (str, True), "core_id": (str, True), "seconds": ((int, float), False), "report": (dict, False), "allocations": (list, False), "error": (str, False)}
+  __slots__ = tuple(fields)
+
+  def __init__(self, id: str, core_id: str, seconds: float=None, report: dict=None, allocations: list=None, error: str=None):
+    self.id = id
+    self.core_id = core_id
+    self.seconds = seconds
+    self.report = report
+    self.allocations = allocations
+    self.error = error
+
+## Traces this process's allocations as asked by request, returning the MemoryMessage to reply with. Blocks while tracing.
+def runMemoryRequest(request: MemoryRequestMessage, core_id: str, memory):
+  seconds = min(request.seconds or profile_default_seconds, profile_max_seconds)
+  try:
+    allocations = importlib.import_module("pybloob_memory").topAllocations(seconds, request.limit or 20)
+  except Exception as e:
+    return MemoryMessage(request.id, core_id, error=repr(e))
+  return MemoryMessage(request.id, core_id, seconds, memory.report(), allocations)
+
+## Sets memory's budget from the "memory_budget" (in MB) in central_config, if it has one
+def updateMemoryBudget(memory, central_config):
+  if type(central_config) == dict and isinstance(central_config.get("memory_budget"), (int, float)):
+    memory.setBudget(central_config["memory_budget"])
+
+# Audio is sent between Utils (recorder -> STT, TTS -> playback) as a small binary header followed by the raw audio,
+# rather than base64 inside JSON, which made every message a third bigger and needed decoding / encoding at each step.
+#
+# Header (big-endian): b"BLBA", version, format, channels, flags, sample rate (u32, 0 if unknown / in the WAV
+# header), audio length in bytes (u32), id length in bytes (u16), then the id (UTF-8), then the deadline and session if
+# their flags are set, then the audio.
+audio_message_magic = b"BLBA"
+audio_message_version = 1
+audio_message_header = struct.Struct("!4sBBBBIIH")
+
+# With this flag, rather than the audio, the message holds a descriptor of where to find it in shared memory
+# (see pybloob_shared_audio), which only works between Utils on the same machine
+audio_flag_shared_memory = 1
+# A request can say when it's no longer wanted: after its deadline (Unix time, an f64), or once a newer request with the
+# same session (u16 length, then UTF-8) arrives. Utils drop these before spending any time on them (see RequestQueue).
+audio_flag_deadline = 2
+audio_flag_session = 4
+audio_message_deadline = struct.Struct("!d")
+audio_message_session_length = struct.Struct("!H")
+
+audio_format_wav = 0
+audio_format_pcm = 1 # Signed 16-bit little-endian samples, no header
+audio_format_opus = 2 # 16-bit PCM compressed with Opus, see pybloob_opus (which needs opuslib and numpy)
+
+class AudioMessage:
+  def __init__(self, id: str, audio, sample_rate: int=0, format: int=audio_format_wav, channels: int=1, deadline: float=None, session: str=None):
+    self.id = id
+    # Any bytes-like object. Decoded messages hold a memoryview into the received payload rather than a copy of it.
+    self.audio = audio
+    self.sample_rate = sample_rate
+    self.format = format
+    self.channels = channels
+    self.deadline = deadline
+    self.session = session
+    # Whether the audio was read from shared memory, rather than being in the message itself
+    self.shared = False
+
+  ## Always includes the audio itself, see Core.encodeAudio for sending it through shared memory when possible
+  def encode(self) -> bytes:
+    return self._encode(self.audio)
+
+  def _encode(self, audio, flags: int=0) -> bytes:
+    id_bytes = self.id.encode()
+    extra_fields = []
+    if self.deadline != None:
+      flags |= audio_flag_deadline
+      extra_fields.append(audio_message_deadline.pack(self.deadline))
+    if self.session != None:
+      flags |= audio_flag_session
+      session_bytes = self.session.encode()
+      extra_fields += [audio_message_session_length.pack(len(session_bytes)), session_bytes]
+    header = audio_message_header.pack(audio_message_magic, audio_message_version, self.format, self.channels, flags, self.sample_rate, len(audio), len(id_bytes))
+    return b"".join([header, id_bytes] + extra_fields + [audio])
+
+  ## Accepts both binary messages and the old {"id": id, "audio": base64_wav_str} JSON ones, and reads the audio
+  ## from shared memory if that's where it was sent. Raises MessageError if the message is broken, and ValueError if
+  ## the shared audio can't be read.
+  @classmethod
+  def decode(cls, payload: bytes):
+    if payload[:4] != audio_message_magic:
+      try:
+        message_json = decodeJson(payload)
+        return cls(message_json["id"], base64.b64decode(message_json["audio"]))
+      except (ValueError, TypeError, KeyError) as e:
+        raise MessageError(f"Audio message is neither binary nor valid JSON: {repr(e)}")
+
+    if len(payload) < audio_message_header.size:
+      raise MessageError("Audio message is shorter than its header")
+    magic, version, format, channels, flags, sample_rate, audio_length, id_length = audio_message_header.unpack_from(payload)
+    if version != audio_message_version:
+      raise MessageError(f"Unsupported audio message version {version}")
+    id_start = audio_message_header.size
+    audio_start = id_start + id_length
+    payload_view = memoryview(payload)
+    deadline = session = None
+    try:
+      if flags & audio_flag_deadline:
+        deadline = audio_message_deadline.unpack_from(payload, audio_start)[0]
+        audio_start += audio_message_deadline.size
+      if flags & audio_flag_session:
+        session_length = audio_message_session_length.unpack_from(payload, audio_start)[0]
+        audio_start += audio_message_session_length.size
+        session = bytes(payload_view[audio_start:audio_start + session_length]).decode()
+        audio_start += session_length
+    except struct.error:
+      raise MessageError("Audio message is shorter than its header says")
+    if len(payload) < audio_start + audio_length:
+      raise MessageError("Audio message is shorter than its header says")
+    audio = payload_view[audio_start:audio_start + audio_length]
+    if flags & audio_flag_shared_memory:
+      try:
+        audio = importlib.import_module("pybloob_shared_audio").readSharedAudio(audio)
+      except ValueError as e:
+        raise MessageError(f"Couldn't read shared audio: {e}")
+    audio_message = cls(bytes(payload_view[id_start:id_start + id_length]).decode(), audio, sample_rate, format, channels, deadline, session)
+    audio_message.shared = bool(flags & audio_flag_shared_memory)
+    return audio_message
+
+  ## The audio as 16-bit PCM (decompressing it if needed), or None for WAVs
+  def asPcm(self):
+    if self.format == audio_format_opus:
+      return importlib.import_module("pybloob_opus").decodeOpusPcm(self.audio, self.sample_rate, self.channels)
+    elif self.format == audio_format_pcm:
+      return self.audio
+    return None
+
+  ## The audio as a numpy float32 array between -1 and 1 (channels interleaved), like Whisper wants, or None for WAVs.
+  ## Opus is decoded straight into the array.
+  def asFloat32(self):
+    if self.format == audio_format_opus:
+      return importlib.import_module("pybloob_opus").decodeOpus(self.audio, self.sample_rate, self.channels)
+    elif self.format == audio_format_pcm:
+      numpy = importlib.import_module("numpy")
+      return numpy.frombuffer(self.audio, dtype=numpy.int16).astype(numpy.float32) / 32768
+    return None
+
+  ## Writes the audio as a WAV file, to a path or file object
+  def writeWav(self, file):
+    if self.format == audio_format_wav:
+      if isinstance(file, (str, pathlib.Path)):
+        with open(file, "wb") as wav_file:
+          wav_file.write(self.audio)
+      else:
+        file.write(self.audio)
+    else:
+      with wave.open(file if not isinstance(file, pathlib.Path) else str(file), "wb") as wav_file:
+        wav_file.setnchannels(self.channels)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(self.sample_rate)
+        wav_file.writeframes(self.asPcm())
+
+  ## The audio as a WAV file's bytes (which is just the audio itself, if it's already a WAV)
+  def asWav(self):
+    if self.format == audio_format_wav:
+      return self.audio
+    wav_file = io.BytesIO()
+    self.writeWav(wav_file)
+    return wav_file.getbuffer()
+
+@functools.lru_cache(maxsize=1)
+def opusAvailable():
+  try:
+    importlib.import_module("pybloob_opus")
+    return True
+  # opuslib raises a plain Exception if it can't find libopus itself
+  except Exception:
+    return False
+
+## What this process can accept as a consumer of audio, published by Core.publishAudioCapabilities
+def audioCapabilities():
+  host_id = importlib.import_module("pybloob_shared_audio").sharedAudioHostId()
+  return {"host": host_id, "shared_memory": host_id != None, "formats": ["wav", "pcm", "opus"] if opusAvailable() else ["wav", "pcm"]}
+
+## Whether audio can be sent through shared memory to a consumer which published these capabilities
+def canShareAudio(capabilities: dict):
+  if type(capabilities) != dict or not capabilities.get("shared_memory"):
+    return False
+  host_id = importlib.import_module("pybloob_shared_audio").sharedAudioHostId()
+  return host_id != None and capabilities.get("host") == host_id
+
+## Whether PCM audio should be Opus compressed for a consumer which published these capabilities. Only worth it when
+## the audio's going to another machine, since encoding it takes a little time.
+def shouldCompressAudio(audio_message: AudioMessage, capabilities: dict):
+  if type(capabilities) != dict or "opus" not in capabilities.get("formats", []) or audio_message.format != audio_format_pcm:
+    return False
+  if capabilities.get("host") == importlib.import_module("pybloob_shared_audio").sharedAudioHostId():
+    return False
+  return opusAvailable() and audio_message.sample_rate in importlib.import_module("pybloob_opus").opus_sample_rates
+
+# Each stage of handling a request (recording, transcribing, running a Core, speaking...) records a span of when it
+# started and finished (Unix timestamps, so they line up between processes / machines), published with the request's id
+# to bloob/<device_id>/traces. pybloob_tracing's TraceCollector puts these back together into a timeline of the request.
+#
+# with c.span(request_id, "transcribe", model=model_name):
+#   transcription = transcribe(audio)
+class Span:
+  def __init__(self, core, request_id: str, name: str, attributes: dict=None):
+    self.core = core
+    self.request_id = request_id
+    self.name = name
+    self.attributes = attributes or {}
+    self.start = None
+    self.end = None
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, exception_type, exception, traceback):
+    self.end = time.time()
+    if exception != None:
+      self.attributes["error"] = repr(exception)
+    self.core.publishSpan(self.request_id, self.name, self.start, self.end, self.attributes)
+
+def spanDict(request_id: str, core_id: str, name: str, start: float, end: float, attributes: dict=None):
+  return {"id": request_id, "core_id": core_id, "name": name, "start": start, "end": end, "attributes": attributes or {}}
+
+# Lets a Core send its output in parts as they're ready, like a quick "Searching" and then the answer sentence by
+# sentence, so the TTS can start on the first part while the Core's still working on the rest. Each part is published
+# to bloob/<device_id>/cores/<core_id>/stream (see CoreChunkMessage), and finishing also publishes the whole text as the
+# Core's usual output, for anything that doesn't read the stream.
+#
+# with c.streamCoreOutput(request.id) as output:
+#   output.send("Searching")
+#   for sentence in pybloob.splitSentences(slowSearch(request.text)):
+#     output.send(sentence)
+class CoreOutputStream:
+  def __init__(self, core, request_id: str):
+    self.core = core
+    self.request_id = request_id
+    self.texts = []
+    self.finished = False
+
+  ## Sends the next part of the output. Blank parts are skipped.
+  def send(self, text: str):
+    if self.finished:
+      raise ValueError("Can't send more output after finishing")
+    text = text.strip()
+    if text == "":
+      return
+    self.core._publish(self.core.stream_topic, CoreChunkMessage(self.request_id, len(self.texts), text).encode(), qos=bloobQOS)
+    self.texts.append(text)
+
+  ## Marks the output as complete, then publishes all of it as the Core's output, with the explanation if given (or
+  ## the whole text if not). Run automatically at the end of a with block.
+  def finish(self, explanation: str=None):
+    if self.finished:
+      return
+    self.finished = True
+    self.core._publish(self.core.stream_topic, CoreChunkMessage(self.request_id, len(self.texts), "", True).encode(), qos=bloobQOS)
+    self.core.publishCoreOutput(self.request_id, " ".join(self.texts), explanation or " ".join(self.texts))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exception_type, exception, traceback):
+    self.finish()
+
+sentence_end = re.compile(r"(?<=[.!?])\s+")
+
+## Splits text into sentences, for streaming it a sentence at a time
+def splitSentences(text: str):
+  return [sentence for sentence in sentence_end.split(text.strip()) if sentence != ""]
+
+# Utils doing slow work (transcribing, speaking) take requests from one of these, rather than straight off MQTT, so when
+# requests pile up, the ones nobody's waiting for any more are dropped before any time's spent on them: those past their
+# deadline, and those superseded by a newer request from the same session. When full, the oldest waiting request is
+# dropped to make room. With metrics (a MetricsRegistry), drops are counted in requests_dropped_total, by reason.
+# on_drop is called with each dropped request and the reason, so whoever sent it can be told not to wait for a reply
+# (see Core.publishDropped). It's called with the queue locked, so it shouldn't block.
+#
+# requests = pybloob.RequestQueue(metrics=c.metrics, log=c.log, on_drop=lambda request, reason: c.publishDropped(request.id, reason))
+# requests.put(pybloob.SpeakMessage.decode(message.payload))  # As messages arrive
+# request = requests.get()  # In the thread doing the work
+class RequestQueue:
+  def __init__(self, max_size: int=8, metrics=None, log=None, on_drop=None):
+    self.max_size = max_size
+    self.metrics = metrics
+    self.log = log
+    self.on_drop = on_drop
+    self.requests = collections.deque()
+    # Session -> id of its newest request
+    self.latest_requests = {}
+    self._condition = threading.Condition()
+
+  ## Takes anything with .id, .deadline and .session (like AudioMessage and SpeakMessage)
+  def put(self, request):
+    with self._condition:
+      if request.session != None:
+        self.latest_requests[request.session] = request.id
+        # Parts of the same request (like a Core's streamed output) don't supersede each other
+        for waiting_request in [waiting_request for waiting_request in self.requests if waiting_request.session == request.session and waiting_request.id != request.id]:
+          self.requests.remove(waiting_request)
+          self.drop(waiting_request, "superseded")
+      if len(self.requests) >= self.max_size:
+        self.drop(self.requests.popleft(), "overflow")
+      self.requests.append(request)
+      self._updateQueued()
+      self._condition.notify()
+
+  ## Blocks until there's a request that's still wanted, and returns it
+  def get(self):
+    with self._condition:
+      while True:
+        while len(self.requests) > 0:
+          request = self.requests.popleft()
+          stale_reason = self.staleReason(request)
+          if stale_reason == None:
+            self._updateQueued()
+            return request
+          self.drop(request, stale_reason)
+        self._updateQueued()
+        self._condition.wait()
+
+  ## Why a request is no longer wanted ("expired" or "superseded"), or None if it still is. Worth checking again right
+  ## before anything expensive, if there's other slow work between getting a request and that.
+  def staleReason(self, request):
+    if request.deadline != None and time.time() > request.deadline:
+      return "expired"
+    if request.session != None and self.latest_requests.get(request.session, request.id) != request.id:
+      return "superseded"
+    return None
+
+  ## Counts (and logs) a request as dropped, for the reason given, and passes it to on_drop
+  def drop(self, request, reason: str):
+    if self.metrics != None:
+      self.metrics.counter("requests_dropped_total", {"reason": reason}).inc()
+    if self.log != None:
+      self.log(f"Dropping request {request.id} ({reason})", log_level_debug)
+    if self.on_drop != None:
+      self.on_drop(request, reason)
+
+  def _updateQueued(self):
+    if self.metrics != None:
+      self.metrics.gauge("requests_queued").set(len(self.requests))
+
+# Intents and Collections are published as canonical JSON (sorted keys, no spaces), so the same content always
+# produces the same bytes, and the same content hash
+def canonicalJson(item) -> bytes:
+  return json.dumps(item, sort_keys=True, separators=(",", ":")).encode()
+
+def contentHash(payload: bytes) -> str:
+  return hashlib.sha256(payload).hexdigest()
+
+# Turns "bloob/<device_id>/collections/colours" into "collections/colours", and a Central Config topic into "central_config".
+# Collection bundles become "cores/<core_id>/collection_bundle", which StateCache unpacks into their Collections' keys.
+def stateCacheKey(topic: str, device_id: str):
+  if topic.endswith("/central_config"):
+    return "central_config"
+  return topic.removeprefix(f"bloob/{device_id}/")
+
+# Holds the latest retained value (JSON decoded) of the topics a Core cares about, like its Central Config and Collections,
+# which the Core's MQTT client keeps up to date in the background. Getting things from it is then just a dict lookup,
+# or a wait for them to arrive if they haven't yet.
+# If given a snapshot_path, every value received is also saved there, so that after a restart the Core can choose to use
+# the last known values straight away (use_snapshot=True), rather than waiting on the broker. Functions registered with
+# onChange are called when a received value differs from what was held before (including what came from the snapshot),
+# so the Core can reconcile anything that it set up from old values. Collections published as part of a bundle are held
+# just as if they'd been published on their own, under collections/<collection_id>. They're called one at a time on their own thread
+# rather than the one calling update (the MQTT network thread), so they're free to publish and wait on replies.
+class StateCache:
+  def __init__(self, snapshot_path: pathlib.Path=None, snapshot_delay: float=1):
+    self.snapshot_path = snapshot_path
+    self.snapshot_delay = snapshot_delay
+    self.values = {}
+    self.snapshot = {}
+    self.change_callbacks = []
+    # (key, value) for each change, for the callback thread (started by the first onChange)
+    self._changes = queue.Queue()
+    self._callback_thread = None
+    # Bundle key -> keys of the Collections its last bundle held, so ones left out of the next are removed
+    self.bundle_keys = {}
+    self._condition = threading.Condition()
+    self._snapshot_timer = None
+
+    if self.snapshot_path != None and self.snapshot_path.exists():
+      try:
+        with open(self.snapshot_path, "r") as snapshot_file:
+          self.snapshot = json.load(snapshot_file)
+      except (OSError, json.decoder.JSONDecodeError):
+        self.snapshot = {}
+
+  def onChange(self, callback):
+    self.change_callbacks.append(callback)
+    if self._callback_thread == None:
+      self._callback_thread = threading.Thread(target=self._runCallbacks, name="state_cache_callbacks", daemon=True)
+      self._callback_thread.start()
+    return callback
+
+  def _runCallbacks(self):
+    while True:
+      key, value = self._changes.get()
+      for callback in self.change_callbacks:
+        try:
+          callback(key, value)
+        except Exception:
+          traceback.print_exc()
+
+  ## Called with the raw payload whenever a message for key arrives. Blank payloads mean the topic was cleared.
+  def update(self, key: str, payload: bytes):
+    value = None
+    if payload != b"":
+      try:
+        value = json.loads(payload.decode())
+      except (json.decoder.JSONDecodeError, UnicodeDecodeError):
+        return
+
+    if key.endswith("/collection_bundle"):
+      self._updateBundle(key, value)
+    else:
+      self._set(key, value)
+
+  def _updateBundle(self, key: str, bundle):
+    collections = {}
+    if type(bundle) == dict and type(bundle.get("collections")) == list:
+      collections = {f"collections/{collection['id']}": collection for collection in bundle["collections"] if type(collection) == dict and "id" in collection}
+    for removed_key in self.bundle_keys.get(key, set()) - collections.keys():
+      self._set(removed_key, None)
+    self.bundle_keys[key] = set(collections)
+    for collection_key, collection in collections.items():
+      self._set(collection_key, collection)
+
+  # Sets key's value, where None removes it
+  def _set(self, key: str, value):
+    if value == None:
+      with self._condition:
+        self.values.pop(key, None)
+      return
+
+    with self._condition:
+      previous_value = self.values.get(key, self.snapshot.get(key))
+      self.values[key] = value
+      if self.snapshot.get(key) != value:
+        self.snapshot[key] = value
+        self._scheduleSnapshot()
+      self._condition.notify_all()
+
+    if previous_value != None and previous_value != value and len(self.change_callbacks) > 0:
+      self._changes.put((key, value))
+
+  ## Returns a dict of key -> value for all of the keys, waiting for any that haven't arrived yet.
+  ## Raises TimeoutError if they haven't all arrived within timeout seconds (None waits forever).
+  def get(self, keys: list, timeout: float=None, use_snapshot: bool=False):
+    deadline = None if timeout == None else time.monotonic() + timeout
+    with self._condition:
+      while True:
+        missing_keys = [key for key in keys if key not in self.values and not (use_snapshot and key in self.snapshot)]
+        if len(missing_keys) == 0:
+          return {key: self.values[key] if key in self.values else self.snapshot[key] for key in keys}
+
+        remaining_time = None if deadline == None else deadline - time.monotonic()
+        if remaining_time != None and remaining_time <= 0:
+          raise TimeoutError(f"Timed out waiting for {missing_keys}")
+        self._condition.wait(remaining_time)
+
+  # Values tend to arrive in bursts (every Collection at once on startup), so the snapshot is written once things settle
+  def _scheduleSnapshot(self):
+    if self.snapshot_path == None or self._snapshot_timer != None:
+      return
+    self._snapshot_timer = threading.Timer(self.snapshot_delay, self.saveSnapshot)
+    self._snapshot_timer.daemon = True
+    self._snapshot_timer.start()
+
+  def saveSnapshot(self):
+    with self._condition:
+      self._snapshot_timer = None
+      snapshot_json = json.dumps(self.snapshot)
+    try:
+      self.snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+      # Write then rename, so a Core killed halfway through never leaves a broken snapshot behind
+      temp_snapshot_path = self.snapshot_path.with_suffix(".tmp")
+      with open(temp_snapshot_path, "w") as snapshot_file:
+        snapshot_file.write(snapshot_json)
+      os.replace(temp_snapshot_path, self.snapshot_path)
+    except OSError:
+      pass
+
+# Logging from the audio and inference loops shouldn't wait on the broker (or even the terminal), so log lines are
+# buffered and printed / published in batches (joined by newlines) from a background thread. The same line logged
+# again within repeat_interval seconds is only counted, then logged once more with how many times it was repeated.
+def formatLogLine(core_id: str, text_to_log, level: int=log_level_info):
+  if level in log_level_names:
+    return f"[{core_id}] {log_level_names[level]}: {text_to_log}"
+  return f"[{core_id}] {text_to_log}"
+
+class BufferedLogger:
+  ## publish(text) is called from the logging thread, and any exceptions it raises are ignored
+  def __init__(self, publish, level: int=log_level_debug, flush_interval: float=0.25, repeat_interval: float=10, buffer_size: int=1000):
+    self.publish = publish
+    self.level = level
+    self.flush_interval = flush_interval
+    self.repeat_interval = repeat_interval
+    self.buffer_size = buffer_size
+
+    self.lines = collections.deque()
+    self.dropped_lines = 0
+    # Line -> [when it was last logged, times it's been repeated since]
+    self.repeats = {}
+    self._lock = threading.Lock()
+    self._flush_now = threading.Event()
+    self._thread = None
+
+  ## Never blocks on anything but the buffer's lock. Past buffer_size waiting lines, new ones are dropped (and counted).
+  def log(self, line: str, level: int=log_level_info):
+    if level < self.level:
+      return
+    now = time.monotonic()
+    with self._lock:
+      repeat = self.repeats.get(line)
+      if repeat != None and now - repeat[0] < self.repeat_interval:
+        repeat[1] += 1
+        return
+      self.repeats[line] = [now, 0]
+      if len(self.lines) >= self.buffer_size:
+        self.dropped_lines += 1
+      else:
+        self.lines.append(line)
+
+      if self._thread == None:
+        self._thread = threading.Thread(target=self._flushLoop, daemon=True, name="logging")
+        self._thread.start()
+    # Errors go out straight away, in case they're the last thing the program does
+    if level >= log_level_error:
+      self._flush_now.set()
+
+  def _flushLoop(self):
+    while True:
+      self._flush_now.wait(self.flush_interval)
+      self._flush_now.clear()
+      self.flush()
+
+  ## Prints and publishes everything waiting. Run automatically every flush_interval, and when the Core disconnects.
+  def flush(self):
+    now = time.monotonic()
+    with self._lock:
+      for line, repeat in list(self.repeats.items()):
+        if now - repeat[0] >= self.repeat_interval:
+          if repeat[1] > 0:
+            self.lines.append(f"{line} (repeated {repeat[1]} more times)")
+          del self.repeats[line]
+      lines = list(self.lines)
+      self.lines.clear()
+      if self.dropped_lines > 0:
+        lines.append(f"({self.dropped_lines} log lines were dropped)")
+        self.dropped_lines = 0
+
+    if len(lines) == 0:
+      return
+    text = "\n".join(lines)
+    print(text)
+    try:
+      self.publish(text)
+    except Exception:
+      pass
+
+# Where a Core's startup time goes, split into phases: "imports" (everything from the process starting until the Core
+# is created, which is almost all importing), "mqtt_connect", "config_fetch", "collections_fetch", "registration"
+# (publishing the Core Config, Intents, Collections and audio capabilities), and any the Core records itself, like
+# "model_load". Once the Core's ready, the breakdown is logged and published, retained, to bloob/<device_id>/startup/<core_id>.
+#
+# with c.startup.phase("model_load"):
+#   model = WhisperModel(...)
+
+# When this process started (or was forked from pybloob_zygote), in time.monotonic() seconds, falling back to when
+# pybloob was imported where /proc isn't available
+def _processStartTime():
+  try:
+    with open("/proc/self/stat", "r") as stat_file:
+      # The process' name can contain spaces (and brackets), so fields are counted from after its last bracket
+      start_ticks = int(stat_file.read().rsplit(")", 1)[1].split()[19])
+    return time.monotonic() - (time.clock_gettime(time.CLOCK_BOOTTIME) - start_ticks / os.sysconf("SC_CLK_TCK"))
+  except (OSError, ValueError, IndexError, AttributeError):
+    return time.monotonic()
+
+startup_origin = _processStartTime()
+# Module name -> seconds spent importing it, filled in when a Core's run through pybloob_startup
+import_times = {}
+
+class StartupProfiler:
+  def __init__(self, origin: float=None):
+    self.origin = origin if origin != None else startup_origin
+    # [name, start, end] in time.monotonic() seconds, in the order they started
+    self.phases = []
+    self.finished = None
+    self._open_phases = set()
+
+  ## Context manager recording how long its block took as part of the named phase. Does nothing once startup has
+  ## finished, or inside another block for the same phase (so publishAll doesn't count publishConfig twice).
+  def phase(self, name: str):
+    return _StartupPhase(self, name)
+
+  def add(self, name: str, start: float, end: float):
+    if self.finished == None:
+      self.phases.append([name, start, end])
+
+  def finish(self):
+    if self.finished == None:
+      self.finished = time.monotonic()
+
+  ## Seconds spent in each phase (phases that happened more than once are added up), and anything not in a phase as "other"
+  def report(self, core_id: str):
+    end = self.finished if self.finished != None else time.monotonic()
+    phases = {}
+    for name, start, phase_end in self.phases:
+      phases[name] = phases.get(name, 0) + (phase_end - start)
+    total = end - self.origin
+    slowest_imports = sorted(import_times.items(), key=lambda import_time: import_time[1], reverse=True)[:10]
+    return {"core_id": core_id, "total": total, "phases": phases, "other": max(total - sum(phases.values()), 0), "slowest_imports": slowest_imports}
+
+class _StartupPhase:
+  def __init__(self, profiler: StartupProfiler, name: str):
+    self.profiler = profiler
+    self.name = name
+    self.recording = False
+
+  def __enter__(self):
+    self.recording = self.profiler.finished == None and self.name not in self.profiler._open_phases
+    if self.recording:
+      self.profiler._open_phases.add(self.name)
+      self.start = time.monotonic()
+    return self
+
+  def __exit__(self, exception_type, exception, traceback):
+    if self.recording:
+      self.profiler._open_phases.discard(self.name)
+      self.profiler.add(self.name, self.start, time.monotonic())
+
+# For Core methods that count towards a startup phase whenever they're run during startup
+def startupPhase(name: str):
+  def decorate(method):
+    @functools.wraps(method)
+    def timedMethod(self, *args, **kwargs):
+      with self.startup.phase(name):
+        return method(self, *args, **kwargs)
+    return timedMethod
+  return decorate
+
+def formatStartupReport(report: dict):
+  phases = [f"{name} {seconds:.2f} s" for name, seconds in report["phases"].items()] + [f"other {report['other']:.2f} s"]
+  text = f"Started in {report['total']:.2f} s ({', '.join(phases)})"
+  # Anything quicker than 10ms isn't worth mentioning
+  slow_imports = [f"{name} {seconds:.2f} s" for name, seconds in report["slowest_imports"] if seconds >= 0.01]
+  if len(slow_imports) > 0:
+    text += f", slowest imports: {', '.join(slow_imports)}"
+  return text
+
+# Everything pybloob.Core and pybloob_async.AsyncCore share that doesn't depend on how they talk to the broker: topic
+# names, the logger, metrics, memory monitor, StateCache and startup profiler, working out which retained messages have
+# changed, and encoding audio. Subclasses do the MQTT side, including _publishLogs, _publishMetrics and _publishMemory,
+# which are called from the logging, metrics and memory threads.
+class CoreBase:
+  def __init__(self, device_id: str, core_id: str, core_config: CoreConfig=None, intents: list=None, collections: list=None, state_snapshot: bool=True, shared_audio: bool=True, opus_audio: bool=True, metrics_interval: float=30, memory_interval: float=60, memory_budget: float=None, log_level: int=log_level_debug):
+    self.startup = StartupProfiler()
+    self.startup.add("imports", self.startup.origin, time.monotonic())
+
     self.device_id = device_id
     self.core_id = core_id
     self.core_config = core_config
     self.intents = intents
-    self.collections = intents
-    self.mqtt_host = mqtt_host
-    self.mqtt_port = mqtt_port
-    self.mqtt_auth = {'username':mqtt_user, 'password':mqtt_pass} if mqtt_user != None else None
+    self.collections = collections
+
+    self.run_topic = f"bloob/{self.device_id}/cores/{self.core_id}/run"
+    self.finished_topic = f"bloob/{self.device_id}/cores/{self.core_id}/finished"
+    self.dropped_topic = f"bloob/{self.device_id}/cores/{self.core_id}/dropped"
+    self.config_topic = f"bloob/{self.device_id}/cores/{self.core_id}/config"
+    self.collections_topic = f"bloob/{self.device_id}/collections/"
+    self.central_config_topic = f"bloob/{self.device_id}/cores/{self.core_id}/central_config"
+    self.intents_topic = f"bloob/{self.device_id}/cores/{self.core_id}/intents/"
+    self.intent_bundle_topic = f"bloob/{self.device_id}/cores/{self.core_id}/intent_bundle"
+    self.collection_bundle_topic = f"bloob/{self.device_id}/cores/{self.core_id}/collection_bundle"
+    # Every Core's Collection bundles, which are unpacked into the StateCache like Collections published on their own
+    self.collection_bundles_topic = f"bloob/{self.device_id}/cores/+/collection_bundle"
+    self.sync_topic = f"bloob/{self.device_id}/cores/{self.core_id}/sync"
+    self.audio_capabilities_topic = f"bloob/{self.device_id}/audio_capabilities/"
+    self.traces_topic = f"bloob/{self.device_id}/traces"
+    self.logs_topic = f"bloob/{self.device_id}/logs"
+    self.startup_topic = f"bloob/{self.device_id}/startup/{self.core_id}"
+    self.stream_topic = f"bloob/{self.device_id}/cores/{self.core_id}/stream"
+    self.profile_topic = f"bloob/{self.device_id}/cores/{self.core_id}/debug/profile"
+    self.memory_debug_topic = f"bloob/{self.device_id}/cores/{self.core_id}/debug/memory"
+    self.memory_topic = f"bloob/{self.device_id}/memory/{self.core_id}"
+
+    self.logger = BufferedLogger(self._publishLogs, log_level)
+
+    # Reports this process's memory use, and keeps it under memory_budget (in MB, which the Central Config's
+    # "memory_budget" overrides) where it can. See pybloob_memory. Subclasses start it once connected.
+    self.memory = importlib.import_module("pybloob_memory").MemoryMonitor(self.core_id, self._publishMemory, memory_interval, memory_budget, self.log)
+
+    # Created the first time the Core records a metric (see the metrics property)
+    self.metrics_topic = f"bloob/{self.device_id}/metrics/{self.core_id}"
+    self.metrics_interval = metrics_interval
+    self._metrics = None
+
+    # Audio sent to Utils on this machine goes through this (created when first needed) rather than the broker
+    self.shared_audio = shared_audio
+    self._shared_audio_ring = None
+    # And audio sent to other machines is Opus compressed, if they can take it (and opuslib is installed)
+    self.opus_audio = opus_audio
+    # Devices whose Utils' audio capabilities we're subscribed to
+    self.audio_capabilities_devices = [self.device_id]
+
+    # Topic -> content hash of what's currently retained there, for the Intent and Collection topics. Only things that
+    # have changed get published, so restarting a Core with the same Intents and Collections costs the broker and
+    # Intent Parser nothing.
+    self.retained_hashes = {}
+
+    # Collections and this Core's Central Config are subscribed to for as long as the Core runs, so they're always ready
+    self.state_cache = StateCache(default_state_cache_path.joinpath(f"{self.device_id}_{self.core_id}.json") if state_snapshot else None)
+
+    # Debug topic -> (request Message class, reply Message class, function taking the request and returning the reply).
+    # These take a while, so subclasses run them off the network thread / event loop, one at a time per topic.
+    self.debug_handlers = {
+      self.profile_topic: (ProfileRequestMessage, ProfileMessage, lambda request: runProfile(request, self.core_id)),
+      self.memory_debug_topic: (MemoryRequestMessage, MemoryMessage, lambda request: runMemoryRequest(request, self.core_id, self.memory)),
+    }
+    self._debugging = set()
 
-  def log(self, text_to_log):
-    message_to_log = f"[{self.core_id}] {text_to_log}"
-    publish.single(f"bloob/{self.device_id}/logs", payload=message_to_log, hostname=self.mqtt_host, port=self.mqtt_port, qos=bloobQOS, auth=self.mqtt_auth)
-    print(message_to_log)
+  # The topics every Core subscribes to on each (re)connect
+  def _subscriptions(self):
+    return [self.run_topic, self.collections_topic + "+", self.central_config_topic, self.intents_topic + "+", self.intent_bundle_topic, self.collection_bundles_topic, self.sync_topic] + list(self.debug_handlers) + [f"bloob/{device_id}/audio_capabilities/+" for device_id in self.audio_capabilities_devices]
 
-  ## Provide the collection_name and core_mqtt_info, and this will return a JSON decoded version of the collection.
-  ## IF THE COLLECTION DOES NOT EXIST, THIS WILL BLOCK FOREVER!
-  def getCollection(self, collection_name: str):
-    return json.loads(subscribe.simple(f"bloob/{self.device_id}/collections/{collection_name}", hostname=self.mqtt_host, port=self.mqtt_port, auth=self.mqtt_auth).payload.decode())
+  # For Collections, Collection bundles, the Central Config and audio capabilities
+  def _onStatePayload(self, topic: str, payload: bytes):
+    self.state_cache.update(stateCacheKey(topic, self.device_id), payload)
+    if topic == self.central_config_topic:
+      updateMemoryBudget(self.memory, self.state_cache.values.get("central_config"))
+    self._onRetainedPayload(topic, payload)
 
-  def getCentralConfig(self):
-    return json.loads(subscribe.simple(f"bloob/{self.device_id}/cores/{self.core_id}/central_config", hostname=self.mqtt_host, port=self.mqtt_port, auth=self.mqtt_auth).payload.decode())
+  def _onRetainedPayload(self, topic: str, payload: bytes):
+    if payload == b"":
+      self.retained_hashes.pop(topic, None)
+    else:
+      self.retained_hashes[topic] = contentHash(payload)
+
+  # Returns the payload to retain on topic for item, or None if that's already what's retained there
+  def _changedPayload(self, topic: str, item):
+    payload = canonicalJson(item)
+    payload_hash = contentHash(payload)
+    if self.retained_hashes.get(topic) == payload_hash:
+      return None
+    self.retained_hashes[topic] = payload_hash
+    return payload
 
-  ## Takes either a list of dicts or a list of Intents which will be turned into dicts
-  def publishIntents(self, intents: list=None):
+  # (topic, item) for each retained message publishIntents puts out, with bundle meaning one versioned message
+  def _intentItems(self, intents: list=None, bundle: bool=False):
     if intents != None:
       self.intents = intents
 
-    for intent in self.intents:
-      if type(intent) == dict:
-        publish.single(topic=f"bloob/{self.device_id}/cores/{self.core_id}/intents/{intent['id']}", payload=json.dumps(intent), qos=bloobQOS, retain=True, hostname=self.mqtt_host, port=self.mqtt_port, auth=self.mqtt_auth)
-      elif type(intent) == Intent:
-        publish.single(topic=f"bloob/{self.device_id}/cores/{self.core_id}/intents/{intent.id}", payload=json.dumps(intent.asdict()), qos=bloobQOS, retain=True, hostname=self.mqtt_host, port=self.mqtt_port, auth=self.mqtt_auth)
+    intent_dicts = [intent.asdict() if type(intent) == Intent else intent for intent in self.intents if type(intent) in [dict, Intent]]
+    if bundle:
+      return [(self.intent_bundle_topic, {"version": contentHash(canonicalJson(intent_dicts)), "intents": intent_dicts})]
+    return [(f"{self.intents_topic}{intent['id']}", intent) for intent in intent_dicts]
 
-  def publishCollections(self, collections: list=None):
+  # As _intentItems, for publishCollections
+  def _collectionItems(self, collections: list=None, bundle: bool=False):
     if collections != None:
       self.collections = collections
 
-    for collection in self.collections:
-      if type(collection) == dict:
-        publish.single(f"bloob/{self.device_id}/collections/{collection['id']}", json.dumps(collection), bloobQOS, True, self.mqtt_host, port=self.mqtt_port, auth=self.mqtt_auth)
-      elif type(collection) == Collection:
-        publish.single(f"bloob/{self.device_id}/collections/{collection.id}", json.dumps(collection.asdict()), bloobQOS, True, self.mqtt_host, port=self.mqtt_port, auth=self.mqtt_auth)
+    collection_dicts = [collection.asdict() if type(collection) == Collection else collection for collection in self.collections if type(collection) in [dict, Collection]]
+    if bundle:
+      return [(self.collection_bundle_topic, {"version": contentHash(canonicalJson(collection_dicts)), "collections": collection_dicts})]
+    return [(f"{self.collections_topic}{collection['id']}", collection) for collection in collection_dicts]
 
-  def publishConfig(self, core_config: dict=None):
+  # The Core Config as JSON for publishConfig, or None if there isn't one
+  def _configPayload(self, core_config: dict=None):
     if core_config != None:
       self.core_config = core_config
     if type(self.core_config) == dict:
-      publish.single(topic=f"bloob/{self.device_id}/cores/{self.core_id}/config", payload=json.dumps(self.core_config), retain=True, hostname=self.mqtt_host, port=self.mqtt_port, auth=self.mqtt_auth)
+      return json.dumps(self.core_config)
     elif type(self.core_config) == CoreConfig:
-      publish.single(topic=f"bloob/{self.device_id}/cores/{self.core_id}/config", payload=json.dumps(self.core_config.asdict()), retain=True, hostname=self.mqtt_host, port=self.mqtt_port, auth=self.mqtt_auth)
+      return json.dumps(self.core_config.asdict())
+    return None
+
+  # Finishes the startup profile and logs it, returning the report to publish, or None if startup had already finished
+  def _finishStartupReport(self):
+    if self.startup.finished != None:
+      return None
+    self.startup.finish()
+    report = self.startup.report(self.core_id)
+    self.log(formatStartupReport(report))
+    return report
+
+  # Decodes a request to one of debug_handlers' topics, logging and returning None if it's broken
+  def _decodeDebugRequest(self, debug_topic: str, payload: bytes):
+    try:
+      return self.debug_handlers[debug_topic][0].decode(payload)
+    except MessageError as e:
+      self.log(f"Ignoring a broken request on {debug_topic}: {e}", log_level_warning)
+      return None
+
+  ## Returns straight away, with the line printed and published shortly after by the logger's thread (see BufferedLogger).
+  ## Lines below the Core's log_level are skipped. Before connecting, lines are only printed.
+  def log(self, text_to_log, level: int=log_level_info):
+    self.logger.log(formatLogLine(self.core_id, text_to_log, level), level)
+
+  ## This Core's MetricsRegistry (see pybloob_metrics), which is published every metrics_interval seconds once used.
+  ## Can be used from any thread.
+  @property
+  def metrics(self):
+    if self._metrics == None:
+      self._metrics = importlib.import_module("pybloob_metrics").MetricsRegistry()
+      self._metrics.startPublishing(self._publishMetrics, self.metrics_interval)
+    return self._metrics
+
+  ## Serves this Core's metrics in Prometheus' text format on http://127.0.0.1:<port>/metrics
+  def serveMetrics(self, port: int, host: str="127.0.0.1"):
+    return self.metrics.serve(port, host)
+
+  ## A pooled, retrying HTTP client (see pybloob_http.HttpClient) for talking to service, recording its requests in
+  ## this Core's metrics. Options (like timeout, idempotent or cache_ttl) are passed on to HttpClient. It blocks, so
+  ## AsyncCores should only use it from handlers that run in the thread pool.
+  def httpClient(self, service: str, **options):
+    http_client = importlib.import_module("pybloob_http").HttpClient(service, self.metrics, **options)
+    self.memory.onPressure(http_client.clearCache)
+    return http_client
+
+  ## Encodes audio_message for sending to the consumer Util (like "stt_util") on consumer_device (by default, this
+  ## device). If that Util says it's on this machine, the audio goes through shared memory, and if it's on another
+  ## machine and accepts Opus, PCM audio is compressed. Otherwise, the audio goes in the message as it is.
+  def encodeAudio(self, audio_message: AudioMessage, consumer: str=None, consumer_device: str=None) -> bytes:
+    if consumer == None:
+      return audio_message.encode()
+    capabilities = self.state_cache.values.get(stateCacheKey(f"bloob/{consumer_device or self.device_id}/audio_capabilities/{consumer}", self.device_id))
+
+    if self.shared_audio and canShareAudio(capabilities):
+      try:
+        if self._shared_audio_ring == None:
+          self._shared_audio_ring = importlib.import_module("pybloob_shared_audio").SharedAudioRing(f"{self.device_id}_{self.core_id}")
+        return audio_message._encode(self._shared_audio_ring.write(audio_message.audio), audio_flag_shared_memory)
+      except (OSError, ValueError) as e:
+        self.log(f"Couldn't use shared memory for audio, sending it through MQTT: {repr(e)}")
+
+    if self.opus_audio and shouldCompressAudio(audio_message, capabilities):
+      compressed_audio = importlib.import_module("pybloob_opus").encodeOpus(audio_message.audio, audio_message.sample_rate, audio_message.channels)
+      return AudioMessage(audio_message.id, compressed_audio, audio_message.sample_rate, audio_format_opus, audio_message.channels, audio_message.deadline, audio_message.session).encode()
+
+    return audio_message.encode()
+
+class Core(CoreBase):
+  def __init__(self, device_id: str, core_id:str, mqtt_host: str, mqtt_port: int, mqtt_user: str=None, mqtt_pass: str=None, core_config: CoreConfig=None, intents: list=None, collections: list=None, state_snapshot: bool=True, shared_audio: bool=True, opus_audio: bool=True, metrics_interval: float=30, memory_interval: float=60, memory_budget: float=None, log_level: int=log_level_debug):
+    super().__init__(device_id, core_id, core_config, intents, collections, state_snapshot, shared_audio, opus_audio, metrics_interval, memory_interval, memory_budget, log_level)
+
+    self.mqtt_host = mqtt_host
+    self.mqtt_port = mqtt_port
+    self.mqtt_auth = {'username':mqtt_user, 'password':mqtt_pass} if mqtt_user != None else None
+
+    # Request id -> when waitForCoreCall returned it, so publishCoreOutput can record how long the Core took
+    self._call_start_times = {}
+
+    # Other topics subscribed to with subscribe, which are subscribed to again on every reconnect
+    self.subscribed_topics = []
+
+    # Set once every retained message from when we subscribed has arrived (see _publishIfChanged)
+    self._retained_synced = threading.Event()
+
+    # Incoming /run calls are put here by the MQTT network thread as soon as they arrive, so none are
+    # missed while the Core is still busy with the last one. waitForCoreCall just takes the next one out.
+    self.core_calls = queue.Queue()
+
+    self._connected = threading.Event()
+    self._connect_result = None
+    # The thread running paho's network loop, which must never wait on anything only it can deliver
+    self._network_thread = None
+    self._last_publish = None
+
+    # For calling other Cores and Utils and waiting on their replies (see the rpc property)
+    self._rpc = None
+    # Debug requests are each run in their own thread
+    self._debugging_lock = threading.Lock()
+    # For timing publishes, message id -> when it was published (or acknowledged, if that happened first)
+    self._publish_times = {}
+    self._publish_acks = {}
+    self._publish_times_lock = threading.Lock()
+
+    ## One long-lived connection for everything this Core does, with its network loop on a background thread
+    self.mqtt_client = createMqttClient()
+    if self.mqtt_auth != None:
+      self.mqtt_client.username_pw_set(mqtt_user, mqtt_pass)
+    self.mqtt_client.on_connect = self._onConnect
+    self.mqtt_client.on_publish = self._onPublish
+    self.mqtt_client.message_callback_add(self.run_topic, self._onCoreCall)
+    self.mqtt_client.message_callback_add(self.collections_topic + "+", self._onStateMessage)
+    self.mqtt_client.message_callback_add(self.central_config_topic, self._onStateMessage)
+    self.mqtt_client.message_callback_add(self.audio_capabilities_topic + "+", self._onStateMessage)
+    self.mqtt_client.message_callback_add(self.intents_topic + "+", self._onRetainedMessage)
+    self.mqtt_client.message_callback_add(self.intent_bundle_topic, self._onRetainedMessage)
+    self.mqtt_client.message_callback_add(self.collection_bundles_topic, self._onStateMessage)
+    self.mqtt_client.message_callback_add(self.sync_topic, self._onSync)
+    for debug_topic in self.debug_handlers:
+      self.mqtt_client.message_callback_add(debug_topic, self._onDebugRequest)
+    with self.startup.phase("mqtt_connect"):
+      self.mqtt_client.connect(self.mqtt_host, self.mqtt_port)
+      self.mqtt_client.loop_start()
+      connected = self._connected.wait(connect_timeout)
+    if not connected:
+      self.mqtt_client.loop_stop()
+      raise ConnectionError(f"MQTT broker at {self.mqtt_host}:{self.mqtt_port} didn't accept the connection within {connect_timeout} s")
+    if self._connect_result != 0:
+      self.mqtt_client.loop_stop()
+      raise ConnectionError(f"MQTT broker at {self.mqtt_host}:{self.mqtt_port} refused the connection ({self._connect_result})")
+
+    # Make sure that anything published just before the Core exits (like retained Collections) actually gets sent
+    atexit.register(self.disconnect)
+    self.memory.start()
+
+  # Called on every (re)connect, so the /run subscription survives the broker going away for a bit
+  def _onConnect(self, client, userdata, flags, reason_code, properties=None):
+    self._network_thread = threading.current_thread()
+    self._connect_result = reason_code if type(reason_code) == int else reason_code.value
+    if self._connect_result == 0:
+      client.subscribe([(topic, bloobQOS) for topic in self._subscriptions() + self.subscribed_topics])
+      # The broker sends retained messages for a subscription before handling anything else we send it, so once this
+      # comes back to us, we've seen everything that was retained
+      client.publish(self.sync_topic, str(random.randint(1,30000)), qos=bloobQOS)
+      if self._rpc != None:
+        self._rpc.resubscribe()
+    self._connected.set()
+
+  def _onDebugRequest(self, client, userdata, message):
+    request_class, reply_class, run = self.debug_handlers[message.topic]
+    request = self._decodeDebugRequest(message.topic, message.payload)
+    if request == None:
+      return
+    with self._debugging_lock:
+      busy = message.topic in self._debugging
+      self._debugging.add(message.topic)
+    if busy:
+      self._publish(message.topic + "/finished", reply_class(request.id, self.core_id, error="Already running").encode(), qos=bloobQOS)
+      return
+    threading.Thread(target=self._debug, args=(message.topic, request, run), name="debug", daemon=True).start()
+
+  def _debug(self, debug_topic: str, request, run):
+    try:
+      self.log(f"Running {debug_topic.split('/')[-1]} for {request.seconds or profile_default_seconds} s")
+      self._publish(debug_topic + "/finished", run(request).encode(), qos=bloobQOS)
+    finally:
+      with self._debugging_lock:
+        self._debugging.discard(debug_topic)
+
+  def _onCoreCall(self, client, userdata, message):
+    self.core_calls.put(message)
+    if self._metrics != None:
+      self._metrics.gauge("core_calls_queued").set(self.core_calls.qsize())
 
-  def publishAll(self):
+  # Called once a message is acknowledged by the broker (QOS 1), or sent (QOS 0)
+  def _onPublish(self, client, userdata, mid, reason_code=None, properties=None):
+    if self._metrics == None:
+      return
+    with self._publish_times_lock:
+      publish_time = self._publish_times.pop(mid, None)
+      if publish_time == None:
+        self._publish_acks[mid] = time.perf_counter()
+        return
+    self._metrics.histogram("mqtt_publish_seconds").observe(time.perf_counter() - publish_time)
+
+  def _onStateMessage(self, client, userdata, message):
+    self._onStatePayload(message.topic, message.payload)
+
+  def _onRetainedMessage(self, client, userdata, message):
+    self._onRetainedPayload(message.topic, message.payload)
+
+  def _onSync(self, client, userdata, message):
+    self._retained_synced.set()
+
+  def _publish(self, topic: str, payload, qos: int=0, retain: bool=False):
+    publish_time = time.perf_counter()
+    self._last_publish = self.mqtt_client.publish(topic, payload, qos=qos, retain=retain)
+    if self._metrics != None:
+      # The acknowledgement can beat us here, in which case _onPublish has left when it arrived
+      with self._publish_times_lock:
+        ack_time = self._publish_acks.pop(self._last_publish.mid, None)
+        if ack_time == None:
+          self._publish_times[self._last_publish.mid] = publish_time
+      if ack_time != None:
+        self._metrics.histogram("mqtt_publish_seconds").observe(ack_time - publish_time)
+    return self._last_publish
+
+  # Called from the logging, metrics and memory threads
+  def _publishLogs(self, text: str):
+    self._publish(self.logs_topic, text, qos=bloobQOS)
+
+  def _publishMetrics(self, snapshot_json: str):
+    self._publish(self.metrics_topic, snapshot_json, retain=True)
+
+  def _publishMemory(self, report_json: str):
+    self._publish(self.memory_topic, report_json, retain=True)
+
+  ## This Core's RpcClient (see pybloob_rpc), sharing its connection
+  @property
+  def rpc(self):
+    if self._rpc == None:
+      self._rpc = importlib.import_module("pybloob_rpc").RpcClient(self.mqtt_client, publish=self._publish, log=self.log)
+    return self._rpc
+
+  ## Publishes payload to topic, returning a Future for the reply to it on reply_topic (the first whose decoded .id is
+  ## request_id), which fails with TimeoutError if there's none within timeout seconds. Cancel the Future to stop waiting.
+  ## With dropped_topic, it fails with DroppedError as soon as the request's dropped there (see publishDropped).
+  def call(self, topic: str, payload, reply_topic: str, request_id: str, decode, timeout: float=None, dropped_topic: str=None):
+    return self.rpc.call(topic, payload, reply_topic, request_id, decode, timeout, dropped_topic)
+
+  # Publishes item (retained) only if it differs from what's already retained on that topic
+  def _publishIfChanged(self, topic: str, item, qos: int=bloobQOS):
+    # If we never hear back about what's retained, just carry on and publish everything. The sync marker is delivered by
+    # the network thread, so waiting for it there would only stall every other message until the timeout.
+    if threading.current_thread() != self._network_thread:
+      self._retained_synced.wait(retained_sync_timeout)
+    elif not self._retained_synced.is_set():
+      self.log("Publishing from the MQTT network thread before retained messages have synced, so everything is republished", log_level_warning)
+    payload = self._changedPayload(topic, item)
+    if payload == None:
+      return None
+    return self._publish(topic, payload, qos=qos, retain=True)
+
+  ## Waits for everything already published to be sent, then closes the connection. Run automatically on exit.
+  def disconnect(self, timeout: float=5):
+    if not self.mqtt_client.is_connected():
+      return
+    self.logger.flush()
+    if self._rpc != None:
+      self._rpc.cancelAll()
+    if self._last_publish != None:
+      try:
+        self._last_publish.wait_for_publish(timeout)
+      except (ValueError, RuntimeError):
+        pass
+    self.mqtt_client.disconnect()
+    self.mqtt_client.loop_stop()
+
+  ## Provide the collection_name, and this will return a JSON decoded version of the collection.
+  ## IF THE COLLECTION DOES NOT EXIST AND THERE'S NO TIMEOUT, THIS WILL BLOCK FOREVER! Otherwise, raises TimeoutError.
+  ## With use_snapshot, the Collection from the last time this Core ran is returned if a fresh one hasn't arrived yet.
+  def getCollection(self, collection_name: str, timeout: float=None, use_snapshot: bool=False):
+    return self.getCollections([collection_name], timeout, use_snapshot)[collection_name]
+
+  ## Gets several Collections at once, as a dict of collection_name -> Collection, waiting (up to timeout) for all of them together
+  @startupPhase("collections_fetch")
+  def getCollections(self, collection_names: list, timeout: float=None, use_snapshot: bool=False):
+    collections = self.state_cache.get([f"collections/{collection_name}" for collection_name in collection_names], timeout, use_snapshot)
+    return {collection_name: collections[f"collections/{collection_name}"] for collection_name in collection_names}
+
+  @startupPhase("config_fetch")
+  def getCentralConfig(self, timeout: float=None, use_snapshot: bool=False):
+    return self.state_cache.get(["central_config"], timeout, use_snapshot)["central_config"]
+
+  ## Takes either a list of dicts or a list of Intents which will be turned into dicts.
+  ## Only Intents that differ from what's already retained get published. With bundle, they're all published
+  ## as a single versioned message instead, to bloob/<device-id>/cores/<core-id>/intent_bundle
+  @startupPhase("registration")
+  def publishIntents(self, intents: list=None, bundle: bool=False):
+    for topic, intent in self._intentItems(intents, bundle):
+      self._publishIfChanged(topic, intent)
+
+  ## As with publishIntents, but bundles go to bloob/<device-id>/cores/<core-id>/collection_bundle
+  @startupPhase("registration")
+  def publishCollections(self, collections: list=None, bundle: bool=False):
+    for topic, collection in self._collectionItems(collections, bundle):
+      self._publishIfChanged(topic, collection)
+
+  @startupPhase("registration")
+  def publishConfig(self, core_config: dict=None):
+    payload = self._configPayload(core_config)
+    if payload != None:
+      self._publish(self.config_topic, payload, retain=True)
+
+  @startupPhase("registration")
+  def publishAll(self, bundle: bool=False):
     if self.core_config == None:
       self.log("No Core Config, can't publish")
     else:
@@ -222,20 +1618,93 @@ class Core:
 
       if self.intents != None:
         self.log("Publishing Intents")
-        self.publishIntents()
+        self.publishIntents(bundle=bundle)
 
       if self.collections != None:
         self.log("Publishing Collections")
-        self.publishCollections()
+        self.publishCollections(bundle=bundle)
 
-  def waitForCoreCall(self):
-    return json.loads(subscribe.simple(f"bloob/{self.device_id}/cores/{self.core_id}/run", hostname=self.mqtt_host, port=self.mqtt_port, auth=self.mqtt_auth).payload.decode())
+  ## Blocks until the next call to this Core arrives (or returns straight away if one is already waiting), returning
+  ## it as a CoreRunMessage (with .id, .intent and .text, which can also be read like the dict this used to return,
+  ## as request["text"] or request.get("intent")). Broken calls are logged and skipped.
+  def waitForCoreCall(self) -> CoreRunMessage:
+    self.finishStartup()
+    while True:
+      message = self.core_calls.get()
+      if self._metrics != None:
+        self._metrics.gauge("core_calls_queued").set(self.core_calls.qsize())
+      try:
+        request = CoreRunMessage.decode(message.payload)
+      except MessageError as e:
+        self.log(f"Ignoring a broken call: {e}", log_level_warning)
+        continue
+      self._call_start_times[request.id] = time.time()
+      return request
+
+  ## Marks the Core as ready, logging and publishing where its startup time went (see StartupProfiler). Only needed by
+  ## Cores with their own loop, as waitForCoreCall calls it the first time. Does nothing after the first call.
+  def finishStartup(self):
+    report = self._finishStartupReport()
+    if report != None:
+      self._publish(self.startup_topic, encodeJson(report), qos=bloobQOS, retain=True)
 
   def publishCoreOutput(self, id: str, text: str, explanation: str):
-    publish.single(topic=f"bloob/{self.device_id}/cores/{self.core_id}/finished", payload=json.dumps({"id": id, "text": text, "explanation": explanation}), hostname=self.mqtt_host, port=self.mqtt_port, auth=self.mqtt_auth)
+    self._publish(self.finished_topic, CoreFinishedMessage(id, text, explanation).encode())
+    if id in self._call_start_times:
+      self.publishSpan(id, "core", self._call_start_times.pop(id), time.time())
+
+  ## Tells whoever sent request_id (like the Orchestrator) that it was dropped without being worked on, for reason
+  def publishDropped(self, request_id: str, reason: str):
+    self._publish(self.dropped_topic, DroppedMessage(request_id, reason).encode(), qos=bloobQOS)
+
+  ## For sending the output to a call in parts, as they're ready (see CoreOutputStream)
+  def streamCoreOutput(self, id: str) -> CoreOutputStream:
+    return CoreOutputStream(self, id)
+
+  ## Returns a context manager that records how long its block took as part of handling request_id (see Span)
+  def span(self, request_id: str, name: str, **attributes):
+    return Span(self, request_id, name, attributes)
+
+  ## For when a stage's start and end don't fit in one block of code
+  def publishSpan(self, request_id: str, name: str, start: float, end: float, attributes: dict=None):
+    self._publish(self.traces_topic, encodeJson(spanDict(request_id, self.core_id, name, start, end, attributes)))
+
+  ## Publishes an AudioMessage (see above) in its binary form
+  ## Consumers of audio (like the STT and audio playback) publish what they can accept, so producers can tell whether
+  ## they're on the same machine, and if so, send audio through shared memory instead of the broker
+  @startupPhase("registration")
+  def publishAudioCapabilities(self):
+    self._publish(self.audio_capabilities_topic + self.core_id, json.dumps(audioCapabilities()), qos=bloobQOS, retain=True)
+
+  ## Publishes payload to topic over this Core's connection
+  def publish(self, topic: str, payload, qos: int=bloobQOS, retain: bool=False):
+    return self._publish(topic, payload, qos=qos, retain=retain)
+
+  ## Calls callback (a paho-mqtt message callback, run on the network thread) for every message on topic, over this
+  ## Core's connection, so nothing's missed between messages and the broker's auth is used. Kept through reconnects.
+  def subscribe(self, topic: str, callback):
+    if topic not in self.subscribed_topics:
+      self.subscribed_topics.append(topic)
+    self.mqtt_client.message_callback_add(topic, callback)
+    self.mqtt_client.subscribe(topic, bloobQOS)
+
+  ## Subscribes to the audio capabilities of another device's Utils, for sending them audio (see encodeAudio)
+  def watchAudioCapabilities(self, device_id: str):
+    if device_id not in self.audio_capabilities_devices:
+      self.audio_capabilities_devices.append(device_id)
+      self.mqtt_client.message_callback_add(f"bloob/{device_id}/audio_capabilities/+", self._onStateMessage)
+      self.mqtt_client.subscribe(f"bloob/{device_id}/audio_capabilities/+", bloobQOS)
+
+  ## Publishes an AudioMessage (see above) in its binary form, for the consumer Util if given (see encodeAudio)
+  def publishAudio(self, topic: str, audio_message: AudioMessage, qos: int=bloobQOS, consumer: str=None, consumer_device: str=None):
+    return self._publish(topic, self.encodeAudio(audio_message, consumer, consumer_device), qos=qos)
 
-  def playAudioFile(self, audio_wav_b64_str: str, id: str=None):
+  ## Takes the bytes of a WAV file (or raw PCM, if format is pybloob.audio_format_pcm), or a base64 encoded WAV str
+  ## like this used to take
+  def playAudioFile(self, audio, id: str=None, sample_rate: int=0, format: int=audio_format_wav):
     # Allow choosing the ID, but generally use a random one if it's not the same request as the main speech (like playing the volume change sound)
     if id == None:
       id = str(random.randint(1,30000))
-    publish.single(topic=f"bloob/{self.device_id}/cores/audio_playback_util/play_file", payload=json.dumps({"id": id, "audio": audio_wav_b64_str}), hostname=self.mqtt_host, port=self.mqtt_port, auth=self.mqtt_auth)
\ No newline at end of file
+    if type(audio) == str:
+      audio = base64.b64decode(audio)
+    self.publishAudio(f"bloob/{self.device_id}/cores/audio_playback_util/play_file", AudioMessage(id, audio, sample_rate, format), consumer="audio_playback_util")
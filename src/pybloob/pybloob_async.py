@@ -0,0 +1,432 @@
+import asyncio
+import json
+import random
+import concurrent.futures
+import functools
+import inspect
+import base64
+import time
+
+import aiomqtt
+
+import pybloob
+
+# An asyncio version of pybloob.Core. Rather than a `while True: c.waitForCoreCall()` loop, you register a function for
+# each of your Intents, and they're run as calls come in, several at once if several calls arrive together, so one slow
+# request doesn't hold up every other one behind it. Regular (non-async) functions are run in a thread pool, so you can
+# still just use requests or anything else that blocks.
+#
+# c = pybloob.AsyncCore(device_id=..., core_id=core_id, ..., core_config=core_config, intents=intents)
+#
+# @c.handler("getWeather")
+# def getWeather(request):
+#   return "It's sunny", "The Weather Core got that it's sunny"
+#
+# c.run()
+# As pybloob.startupPhase, for coroutines
+def startupPhase(name: str):
+  def decorate(method):
+    @functools.wraps(method)
+    async def timedMethod(self, *args, **kwargs):
+      with self.startup.phase(name):
+        return await method(self, *args, **kwargs)
+    return timedMethod
+  return decorate
+
+class AsyncCore(pybloob.CoreBase):
+  def __init__(self, device_id: str, core_id: str, mqtt_host: str, mqtt_port: int, mqtt_user: str=None, mqtt_pass: str=None, core_config: pybloob.CoreConfig=None, intents: list=None, collections: list=None, max_concurrent_calls: int=4, max_threads: int=None, reconnect_interval: float=5, state_snapshot: bool=True, shared_audio: bool=True, opus_audio: bool=True, metrics_interval: float=30, memory_interval: float=60, memory_budget: float=None, log_level: int=pybloob.log_level_debug):
+    super().__init__(device_id, core_id, core_config, intents, collections, state_snapshot, shared_audio, opus_audio, metrics_interval, memory_interval, memory_budget, log_level)
+
+    self.mqtt_host = mqtt_host
+    self.mqtt_port = mqtt_port
+    self.mqtt_user = mqtt_user
+    self.mqtt_pass = mqtt_pass
+    self.max_concurrent_calls = max_concurrent_calls
+    self.max_threads = max_threads
+    self.reconnect_interval = reconnect_interval
+
+    # Intent ID -> function, with None being the function for any Intent that doesn't have its own
+    self.handlers = {}
+    self.startup_functions = []
+
+    # Set once every retained message from when we subscribed has arrived, as in pybloob.Core
+    self._retained_synced = None
+
+    self.mqtt_client = None
+    self.loop = None
+    self.thread_pool = None
+    self._started = False
+    self._call_limit = None
+    self._running_calls = set()
+    # For call: reply topic -> function decoding its replies, and (reply topic, request id) -> asyncio.Future, with
+    # calls' dropped topics counting as reply topics (see pybloob_rpc)
+    self.reply_decoders = {}
+    self.pending_calls = {}
+    self.dropped_topics = set()
+    # Debug requests (see pybloob.CoreBase.debug_handlers) are run in the loop's default executor rather than the thread
+    # pool, so they don't take threads from the handlers
+    self._debug_tasks = set()
+
+  ## Decorator that registers a function to run when this Core is called with any of the given Intents, or
+  ## for all Intents that don't have a handler of their own if none are given. The function is given the received
+  ## request (a pybloob.CoreRunMessage, with .id, .intent and .text), and can return (text_to_speak, explanation) to publish as the
+  ## Core's output, or None if it has nothing to say / publishes its own output. A handler can instead yield its output
+  ## in parts (like a quick acknowledgement, then the answer sentence by sentence), which are each sent as they come, so
+  ## speech can start before the handler's done.
+  def handler(self, *intent_ids: str):
+    def register(function):
+      if len(intent_ids) == 0:
+        self.handlers[None] = function
+      for intent_id in intent_ids:
+        self.handlers[intent_id] = function
+      return function
+    return register
+
+  ## Decorator for functions to run once connected, but before the Core Config, Intents and Collections get published.
+  ## Useful for getting the Central Config and working out your Intents from it.
+  def onStartup(self, function):
+    self.startup_functions.append(function)
+    return function
+
+  def run(self):
+    asyncio.run(self.main())
+
+  async def main(self):
+    self._prepare()
+
+    while True:
+      try:
+        connect_start = time.monotonic()
+        async with aiomqtt.Client(hostname=self.mqtt_host, port=self.mqtt_port, username=self.mqtt_user, password=self.mqtt_pass) as client:
+          self.startup.add("mqtt_connect", connect_start, time.monotonic())
+          message_reader = asyncio.create_task(self._readMessages(client))
+          await self._onConnected(client)
+          await message_reader
+      except aiomqtt.MqttError:
+        self.mqtt_client = None
+        print(f"[{self.core_id}] Lost connection to the MQTT broker, reconnecting in {self.reconnect_interval}s")
+        await asyncio.sleep(self.reconnect_interval)
+
+  # The parts of main that pybloob_host.CoreHost also uses, to run several AsyncCores on one event loop and one MQTT
+  # connection: _prepare once the loop's running, _onConnected on every (re)connect, and _onMessage for each message
+  # that _handlesTopic says is for this Core.
+  def _prepare(self, thread_pool: concurrent.futures.ThreadPoolExecutor=None):
+    self.loop = asyncio.get_running_loop()
+    self.thread_pool = thread_pool or concurrent.futures.ThreadPoolExecutor(max_workers=self.max_threads, thread_name_prefix=self.core_id)
+    self._call_limit = asyncio.Semaphore(self.max_concurrent_calls)
+
+  def _subscriptions(self):
+    return super()._subscriptions() + list(self.reply_decoders.keys())
+
+  def _handlesTopic(self, topic: aiomqtt.Topic):
+    return any(topic.matches(subscription) for subscription in self._subscriptions())
+
+  async def _onConnected(self, client: aiomqtt.Client):
+    self.mqtt_client = client
+    self._retained_synced = asyncio.Event()
+    await client.subscribe([(topic, pybloob.bloobQOS) for topic in self._subscriptions()])
+    await client.publish(self.sync_topic, str(random.randint(1,30000)), qos=pybloob.bloobQOS)
+
+    if not self._started:
+      for function in self.startup_functions:
+        await self._callFunction(function)
+      self._started = True
+      self.memory.start()
+
+    await self.publishAll()
+    await self.finishStartup()
+
+  # Runs async functions directly, and anything else in the thread pool so it can't block the event loop
+  async def _callFunction(self, function, *args):
+    if asyncio.iscoroutinefunction(function):
+      return await function(*args)
+    else:
+      return await self.loop.run_in_executor(self.thread_pool, function, *args)
+
+  async def _readMessages(self, client: aiomqtt.Client):
+    async for message in client.messages:
+      self._onMessage(message)
+
+  def _onMessage(self, message: aiomqtt.Message):
+    if message.topic.matches(self.run_topic):
+      # Keep a reference to the task, otherwise it may be garbage collected before finishing
+      call = asyncio.create_task(self._handleCoreCall(message))
+      self._running_calls.add(call)
+      call.add_done_callback(self._callFinished)
+      if self._metrics != None:
+        self._metrics.gauge("core_calls_running").set(len(self._running_calls))
+    elif message.topic.matches(self.sync_topic):
+      self._retained_synced.set()
+    elif message.topic.value in self.reply_decoders:
+      self._onReply(message)
+    elif message.topic.value in self.debug_handlers:
+      debug = asyncio.create_task(self._handleDebugRequest(message))
+      self._debug_tasks.add(debug)
+      debug.add_done_callback(self._debug_tasks.discard)
+    elif message.topic.matches(self.collections_topic + "+") or message.topic.matches(self.collection_bundles_topic) or message.topic.matches(self.central_config_topic) or message.topic.matches("bloob/+/audio_capabilities/+"):
+      self._onStatePayload(message.topic.value, message.payload)
+    else:
+      self._onRetainedPayload(message.topic.value, message.payload)
+
+  # When hosted, these look at the whole process (every hosted Core)
+  async def _handleDebugRequest(self, message: aiomqtt.Message):
+    debug_topic = message.topic.value
+    request_class, reply_class, run = self.debug_handlers[debug_topic]
+    request = self._decodeDebugRequest(debug_topic, message.payload)
+    if request == None:
+      return
+    if debug_topic in self._debugging:
+      reply = reply_class(request.id, self.core_id, error="Already running")
+    else:
+      self._debugging.add(debug_topic)
+      try:
+        self.log(f"Running {debug_topic.split('/')[-1]} for {request.seconds or pybloob.profile_default_seconds} s")
+        reply = await self.loop.run_in_executor(None, run, request)
+      finally:
+        self._debugging.discard(debug_topic)
+    await self._publish(debug_topic + "/finished", reply.encode(), qos=pybloob.bloobQOS)
+
+  def _onReply(self, message: aiomqtt.Message):
+    try:
+      reply = self.reply_decoders[message.topic.value](message.payload)
+    except ValueError as e:
+      self.log(f"Ignoring a broken reply on {message.topic.value}: {e}", pybloob.log_level_warning)
+      return
+    future = self.pending_calls.pop((message.topic.value, reply.id), None)
+    if future != None and not future.done():
+      if message.topic.value in self.dropped_topics:
+        future.set_exception(pybloob.DroppedError(reply.id, reply.reason))
+      else:
+        future.set_result(reply)
+
+  def _callFinished(self, call):
+    self._running_calls.discard(call)
+    if self._metrics != None:
+      self._metrics.gauge("core_calls_running").set(len(self._running_calls))
+
+  async def _handleCoreCall(self, message):
+    try:
+      request = pybloob.CoreRunMessage.decode(message.payload)
+    except pybloob.MessageError as e:
+      self.log(f"Ignoring a broken call: {e}", pybloob.log_level_warning)
+      return
+
+    function = self.handlers.get(request.intent, self.handlers.get(None))
+    if function == None:
+      self.log(f"No handler for the Intent {request.intent}")
+      return
+
+    async with self._call_limit:
+      call_start = time.time()
+      if inspect.isgeneratorfunction(function) or inspect.isasyncgenfunction(function):
+        await self._streamFunction(function, request)
+        output = None
+      else:
+        try:
+          output = await self._callFunction(function, request)
+        except Exception as e:
+          self.log(f"Handling {request.intent} failed: {repr(e)}")
+          output = ("Sorry, something went wrong", f"The {self.core_id} Core failed to handle the Intent {request.intent}: {repr(e)}")
+
+    if output != None:
+      await self.publishCoreOutput(request.id, output[0], output[1])
+    await self.publishSpan(request.id, "core", call_start, time.time(), {"intent": request.intent})
+
+  # Handlers that yield their output (generators, async or not) have each part streamed as it's yielded. Regular
+  # generators are stepped through in the thread pool, so they can block between parts.
+  async def _streamFunction(self, function, request):
+    output = self.streamCoreOutput(request.id)
+    try:
+      if inspect.isasyncgenfunction(function):
+        async for text in function(request):
+          await output.send(text)
+      else:
+        parts = function(request)
+        finished = object()
+        while (text := await self.loop.run_in_executor(self.thread_pool, next, parts, finished)) is not finished:
+          await output.send(text)
+    except Exception as e:
+      self.log(f"Handling {request.intent} failed: {repr(e)}")
+      await output.send("Sorry, something went wrong")
+      await output.finish(f"The {self.core_id} Core failed to handle the Intent {request.intent}: {repr(e)}")
+    await output.finish()
+
+  async def _publish(self, topic: str, payload, qos: int=0, retain: bool=False):
+    if self._metrics == None:
+      await self.mqtt_client.publish(topic, payload, qos=qos, retain=retain)
+    else:
+      # aiomqtt waits for the broker's acknowledgement of QOS 1 messages before returning
+      with self._metrics.histogram("mqtt_publish_seconds").time():
+        await self.mqtt_client.publish(topic, payload, qos=qos, retain=retain)
+
+  # Called from the metrics thread
+  def _publishMetrics(self, snapshot_json: str):
+    if self.mqtt_client != None and self.loop != None:
+      asyncio.run_coroutine_threadsafe(self._publish(self.metrics_topic, snapshot_json, retain=True), self.loop)
+
+  # Called from the memory thread
+  def _publishMemory(self, report_json: str):
+    if self.mqtt_client != None and self.loop != None:
+      asyncio.run_coroutine_threadsafe(self._publish(self.memory_topic, report_json, retain=True), self.loop)
+
+  # Publishes item (retained) only if it differs from what's already retained on that topic
+  async def _publishIfChanged(self, topic: str, item, qos: int=pybloob.bloobQOS):
+    try:
+      await asyncio.wait_for(self._retained_synced.wait(), pybloob.retained_sync_timeout)
+    except asyncio.TimeoutError:
+      pass
+    payload = self._changedPayload(topic, item)
+    if payload != None:
+      await self._publish(topic, payload, qos=qos, retain=True)
+
+  # The StateCache waits on a threading.Condition, so waiting for it happens off the event loop
+  async def _getState(self, keys: list, timeout: float=None, use_snapshot: bool=False):
+    return await self.loop.run_in_executor(None, functools.partial(self.state_cache.get, keys, timeout, use_snapshot))
+
+  # Called from the logging thread. Before connecting, logs are only printed.
+  def _publishLogs(self, text: str):
+    if self.mqtt_client != None and self.loop != None:
+      asyncio.run_coroutine_threadsafe(self._publish(self.logs_topic, text, qos=pybloob.bloobQOS), self.loop)
+
+  async def getCollection(self, collection_name: str, timeout: float=None, use_snapshot: bool=False):
+    return (await self.getCollections([collection_name], timeout, use_snapshot))[collection_name]
+
+  @startupPhase("collections_fetch")
+  async def getCollections(self, collection_names: list, timeout: float=None, use_snapshot: bool=False):
+    collections = await self._getState([f"collections/{collection_name}" for collection_name in collection_names], timeout, use_snapshot)
+    return {collection_name: collections[f"collections/{collection_name}"] for collection_name in collection_names}
+
+  @startupPhase("config_fetch")
+  async def getCentralConfig(self, timeout: float=None, use_snapshot: bool=False):
+    return (await self._getState(["central_config"], timeout, use_snapshot))["central_config"]
+
+  @startupPhase("registration")
+  async def publishConfig(self, core_config: dict=None):
+    payload = self._configPayload(core_config)
+    if payload != None:
+      await self._publish(self.config_topic, payload, retain=True)
+
+  ## Only publishes what's changed, and with bundle, publishes everything as one versioned message (see pybloob.Core)
+  @startupPhase("registration")
+  async def publishIntents(self, intents: list=None, bundle: bool=False):
+    for topic, intent in self._intentItems(intents, bundle):
+      await self._publishIfChanged(topic, intent)
+
+  @startupPhase("registration")
+  async def publishCollections(self, collections: list=None, bundle: bool=False):
+    for topic, collection in self._collectionItems(collections, bundle):
+      await self._publishIfChanged(topic, collection)
+
+  @startupPhase("registration")
+  async def publishAll(self, bundle: bool=False):
+    if self.core_config == None:
+      self.log("No Core Config, can't publish")
+    else:
+      await self.publishConfig()
+
+      if self.intents != None:
+        self.log("Publishing Intents")
+        await self.publishIntents(bundle=bundle)
+
+      if self.collections != None:
+        self.log("Publishing Collections")
+        await self.publishCollections(bundle=bundle)
+
+  ## Each handled call gets a "core" span recorded automatically, this is for anything more detailed
+  ## Publishes payload to topic, then waits for (and returns) the reply to it on reply_topic: the first whose decoded .id
+  ## is request_id. Raises TimeoutError if there's none within timeout seconds, and cancelling the task stops waiting.
+  ## With dropped_topic, raises pybloob.DroppedError as soon as the request's dropped there.
+  ## The reply topic is subscribed to before publishing, so fast replies can't be missed (see pybloob_rpc).
+  async def call(self, topic: str, payload, reply_topic: str, request_id: str, decode, timeout: float=None, dropped_topic: str=None):
+    call_keys = [(reply_topic, request_id)]
+    await self._subscribeReplies(reply_topic, decode)
+    if dropped_topic != None:
+      call_keys.append((dropped_topic, request_id))
+      await self._subscribeReplies(dropped_topic, pybloob.DroppedMessage.decode)
+      self.dropped_topics.add(dropped_topic)
+
+    future = self.loop.create_future()
+    for call_key in call_keys:
+      previous_call = self.pending_calls.pop(call_key, None)
+      if previous_call != None:
+        previous_call.cancel()
+      self.pending_calls[call_key] = future
+    try:
+      await self._publish(topic, payload, qos=pybloob.bloobQOS)
+      return await asyncio.wait_for(future, timeout)
+    finally:
+      for call_key in call_keys:
+        if self.pending_calls.get(call_key) is future:
+          del self.pending_calls[call_key]
+
+  async def _subscribeReplies(self, reply_topic: str, decode):
+    if reply_topic not in self.reply_decoders:
+      self.reply_decoders[reply_topic] = decode
+      await self.mqtt_client.subscribe(reply_topic, qos=pybloob.bloobQOS)
+
+  ## As pybloob.Core.finishStartup, and called automatically once the Core has connected and published everything
+  async def finishStartup(self):
+    report = self._finishStartupReport()
+    if report != None:
+      await self._publish(self.startup_topic, pybloob.encodeJson(report), qos=pybloob.bloobQOS, retain=True)
+
+  async def publishSpan(self, request_id: str, name: str, start: float, end: float, attributes: dict=None):
+    await self._publish(self.traces_topic, pybloob.encodeJson(pybloob.spanDict(request_id, self.core_id, name, start, end, attributes)))
+
+  ## For sending the output to a call in parts, as they're ready (see pybloob.CoreOutputStream). Handlers can also just
+  ## yield each part.
+  def streamCoreOutput(self, id: str):
+    return AsyncCoreOutputStream(self, id)
+
+  async def publishCoreOutput(self, id: str, text: str, explanation: str):
+    await self._publish(self.finished_topic, pybloob.CoreFinishedMessage(id, text, explanation).encode())
+
+  @startupPhase("registration")
+  async def publishAudioCapabilities(self):
+    await self._publish(self.audio_capabilities_topic + self.core_id, json.dumps(pybloob.audioCapabilities()), qos=pybloob.bloobQOS, retain=True)
+
+  async def watchAudioCapabilities(self, device_id: str):
+    if device_id not in self.audio_capabilities_devices:
+      self.audio_capabilities_devices.append(device_id)
+      await self.mqtt_client.subscribe(f"bloob/{device_id}/audio_capabilities/+", qos=pybloob.bloobQOS)
+
+  async def publishAudio(self, topic: str, audio_message: pybloob.AudioMessage, qos: int=pybloob.bloobQOS, consumer: str=None, consumer_device: str=None):
+    await self._publish(topic, self.encodeAudio(audio_message, consumer, consumer_device), qos=qos)
+
+  async def playAudioFile(self, audio, id: str=None, sample_rate: int=0, format: int=pybloob.audio_format_wav):
+    # Allow choosing the ID, but generally use a random one if it's not the same request as the main speech (like playing the volume change sound)
+    if id == None:
+      id = str(random.randint(1,30000))
+    if type(audio) == str:
+      audio = base64.b64decode(audio)
+    await self.publishAudio(f"bloob/{self.device_id}/cores/audio_playback_util/play_file", pybloob.AudioMessage(id, audio, sample_rate, format), consumer="audio_playback_util")
+
+# As pybloob.CoreOutputStream, with send and finish to be awaited, and async with instead of with
+class AsyncCoreOutputStream:
+  def __init__(self, core: AsyncCore, request_id: str):
+    self.core = core
+    self.request_id = request_id
+    self.texts = []
+    self.finished = False
+
+  async def send(self, text: str):
+    if self.finished:
+      raise ValueError("Can't send more output after finishing")
+    text = text.strip()
+    if text == "":
+      return
+    await self.core._publish(self.core.stream_topic, pybloob.CoreChunkMessage(self.request_id, len(self.texts), text).encode(), qos=pybloob.bloobQOS)
+    self.texts.append(text)
+
+  async def finish(self, explanation: str=None):
+    if self.finished:
+      return
+    self.finished = True
+    await self.core._publish(self.core.stream_topic, pybloob.CoreChunkMessage(self.request_id, len(self.texts), "", True).encode(), qos=pybloob.bloobQOS)
+    await self.core.publishCoreOutput(self.request_id, " ".join(self.texts), explanation or " ".join(self.texts))
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, exception_type, exception, traceback):
+    await self.finish()
@@ -0,0 +1,195 @@
+#!/bin/env python3
+""" Archives real requests into a local corpus: the recording, what the STT heard, which Intent and Core it went to,
+what was answered, and how long each stage took (from the spans on bloob/<device_id>/traces). Replay it through the
+Utils and Cores later with src/benchmarks/corpus_replay.py, to compare builds on real voices, noise and phrasing.
+
+Nothing is recorded unless this is running, only requests that started with a wakeword are kept (so benchmarks and
+replays aren't), and the oldest requests are deleted once the corpus is over its size cap. Recordings are stored
+compressed with Opus where pybloob_opus can be used.
+
+Run with: python src/pybloob/pybloob_corpus.py --device-id test --max-mb 500
+"""
+import argparse
+import importlib
+import io
+import json
+import os
+import pathlib
+import threading
+import time
+import wave
+
+import pybloob
+import pybloob_tracing
+
+default_corpus_path = pybloob.default_data_path.joinpath("corpus")
+
+# A directory of recordings (<id>.audio, each an encoded pybloob.AudioMessage), with one JSON line per request in
+# index.jsonl: {"id", "time", "audio_file", "audio_bytes", "transcript", "intent_id", "core_id", "output", "timings"},
+# where timings is span name -> seconds spent in it, along with total_time and time_to_first_audio (see
+# pybloob_tracing.TraceCollector.timeline). Once over max_bytes, the oldest requests are deleted.
+class Corpus:
+  def __init__(self, path=default_corpus_path, max_bytes: int=None):
+    self.path = pathlib.Path(path)
+    self.max_bytes = max_bytes
+    self.index_path = self.path.joinpath("index.jsonl")
+    self.path.mkdir(parents=True, exist_ok=True)
+    self.entries = []
+    if self.index_path.exists():
+      self.entries = [json.loads(line) for line in self.index_path.read_text().splitlines() if line.strip() != ""]
+    self._lock = threading.Lock()
+
+  ## Bytes used by every recording and the index
+  def size(self):
+    return sum(entry["audio_bytes"] for entry in self.entries) + (self.index_path.stat().st_size if self.index_path.exists() else 0)
+
+  ## Saves a request, given its entry (without audio_file and audio_bytes, which are filled in) and its recording
+  def add(self, entry: dict, audio: pybloob.AudioMessage):
+    encoded_audio = audio.encode()
+    entry = {**entry, "audio_file": f"{entry['id']}.audio", "audio_bytes": len(encoded_audio)}
+    with self._lock:
+      self.path.joinpath(entry["audio_file"]).write_bytes(encoded_audio)
+      with open(self.index_path, "a") as index_file:
+        index_file.write(json.dumps(entry) + "\n")
+      self.entries.append(entry)
+      self._trim()
+    return entry
+
+  ## The recording for an entry, as a pybloob.AudioMessage
+  def audio(self, entry: dict):
+    return pybloob.AudioMessage.decode(self.path.joinpath(entry["audio_file"]).read_bytes())
+
+  # Deletes the oldest requests until the corpus fits in max_bytes
+  def _trim(self):
+    if self.max_bytes == None or self.size() <= self.max_bytes:
+      return
+    total = self.size()
+    while len(self.entries) > 0 and total > self.max_bytes:
+      entry = self.entries.pop(0)
+      total -= entry["audio_bytes"]
+      try:
+        os.remove(self.path.joinpath(entry["audio_file"]))
+      except FileNotFoundError:
+        pass
+    # Written to the side and moved over, so a crash part way through can't lose the whole index
+    new_index_path = self.index_path.with_suffix(".tmp")
+    new_index_path.write_text("".join(json.dumps(entry) + "\n" for entry in self.entries))
+    os.replace(new_index_path, self.index_path)
+
+## A copy of a recording (so none of it's left pointing at shared memory), in the most compact form it can be stored
+## in if compress is set, which is Opus if it's 16-bit audio and Opus is available
+def compactAudio(audio: pybloob.AudioMessage, compress: bool=True):
+  copied_audio = pybloob.AudioMessage(audio.id, bytes(audio.audio), audio.sample_rate, audio.format, audio.channels)
+  if not compress or audio.format == pybloob.audio_format_opus or not pybloob.opusAvailable():
+    return copied_audio
+
+  pcm, sample_rate, channels = audio.audio, audio.sample_rate, audio.channels
+  if audio.format == pybloob.audio_format_wav:
+    try:
+      with wave.open(io.BytesIO(audio.audio), "rb") as wav_file:
+        if wav_file.getsampwidth() != 2:
+          return copied_audio
+        pcm, sample_rate, channels = wav_file.readframes(wav_file.getnframes()), wav_file.getframerate(), wav_file.getnchannels()
+    except (wave.Error, EOFError):
+      return copied_audio
+  try:
+    encoded = importlib.import_module("pybloob_opus").encodeOpus(pcm, sample_rate, channels)
+  # Like a sample rate Opus doesn't support
+  except Exception:
+    return copied_audio
+  return pybloob.AudioMessage(audio.id, encoded, sample_rate, pybloob.audio_format_opus, channels)
+
+# Listens in on requests as they go through the Utils and Cores, adding each to a Corpus once it's finished (once
+# settle_time seconds pass without any new spans for it, see pybloob_tracing.TraceCollector)
+class CorpusRecorder:
+  def __init__(self, corpus: Corpus, device_id: str, settle_time: float=3, compress: bool=True):
+    self.corpus = corpus
+    self.device_id = device_id
+    self.compress = compress
+    self.collector = pybloob_tracing.TraceCollector(settle_time)
+    # Request ID -> what's been seen of it so far, along with "updated", when it was last added to
+    self.requests = {}
+    self._lock = threading.Lock()
+
+  def topics(self):
+    return [f"bloob/{self.device_id}/traces", f"bloob/{self.device_id}/cores/+/finished"]
+
+  ## For use as a paho-mqtt message callback
+  def onMessage(self, client, userdata, message):
+    if message.topic.endswith("/traces"):
+      self.collector.onMessage(client, userdata, message)
+      return
+    core_id = message.topic.split("/")[-2]
+    try:
+      if core_id == "audio_recorder_util":
+        audio = pybloob.AudioMessage.decode(message.payload)
+        self._update(audio.id, audio=compactAudio(audio, self.compress))
+      elif core_id == "stt_util":
+        transcript = pybloob.TranscriptMessage.decode(message.payload)
+        self._update(transcript.id, transcript=transcript.text)
+      elif core_id == "intent_parser_util":
+        parse = pybloob.decodeJson(message.payload)
+        self._update(parse["id"], intent_id=parse.get("intent_id"), core_id=parse.get("core_id"))
+      # Like the Orchestrator, only Cores' outputs count, not Utils'
+      elif "util" not in core_id:
+        output = pybloob.CoreFinishedMessage.decode(message.payload)
+        self._update(output.id, output=output.text)
+    except (pybloob.MessageError, ValueError, KeyError, TypeError):
+      pass
+
+  def _update(self, request_id: str, **values):
+    with self._lock:
+      self.requests.setdefault(request_id, {}).update(values, updated=time.monotonic())
+
+  ## Saves the requests that have finished, returning their entries. Requests without a recording, or that didn't start
+  ## with a wakeword, are forgotten, as is anything not heard about for a minute without any spans.
+  def flush(self):
+    saved = []
+    for timeline in self.collector.completed():
+      with self._lock:
+        request = self.requests.pop(timeline["id"], None)
+      span_names = [span["name"] for span in timeline["spans"]]
+      if request == None or "audio" not in request or "wakeword" not in span_names:
+        continue
+      timings = {}
+      for span in timeline["spans"]:
+        timings[span["name"]] = timings.get(span["name"], 0) + span["duration"]
+      timings["total_time"] = timeline["total_time"]
+      timings["time_to_first_audio"] = timeline["time_to_first_audio"]
+      entry = {"id": timeline["id"], "time": timeline["spans"][0]["start"], "transcript": request.get("transcript"), "intent_id": request.get("intent_id"), "core_id": request.get("core_id"), "output": request.get("output"), "timings": timings}
+      saved.append(self.corpus.add(entry, request["audio"]))
+
+    stale_time = time.monotonic() - max(60, self.collector.settle_time * 10)
+    with self._lock:
+      for request_id in [request_id for request_id, request in self.requests.items() if request["updated"] < stale_time]:
+        self.requests.pop(request_id)
+    return saved
+
+if __name__ == "__main__":
+  arg_parser = argparse.ArgumentParser()
+  arg_parser.add_argument('--host', default="localhost")
+  arg_parser.add_argument('--port', default=1883, type=int)
+  arg_parser.add_argument('--user')
+  arg_parser.add_argument('--pass')
+  arg_parser.add_argument('--device-id', default="test")
+  arg_parser.add_argument('--path', default=str(default_corpus_path), help="Directory to keep the corpus in")
+  arg_parser.add_argument('--max-mb', default=500, type=float, help="Size cap, over which the oldest requests are deleted")
+  arg_parser.add_argument('--no-compress', action="store_true", help="Keep recordings as they were sent, rather than as Opus")
+  arguments = arg_parser.parse_args()
+
+  corpus = Corpus(arguments.path, int(arguments.max_mb * 1048576))
+  recorder = CorpusRecorder(corpus, arguments.device_id, compress=not arguments.no_compress)
+
+  client = pybloob.createMqttClient()
+  if arguments.user != None:
+    client.username_pw_set(arguments.user, arguments.__dict__.get("pass"))
+  client.on_message = recorder.onMessage
+  client.connect(arguments.host, arguments.port)
+  client.subscribe([(topic, pybloob.bloobQOS) for topic in recorder.topics()])
+  client.loop_start()
+
+  print(f"Recording requests to {corpus.path} ({len(corpus.entries)} so far, {corpus.size() / 1048576:.1f} MB)")
+  while True:
+    time.sleep(0.5)
+    for entry in recorder.flush():
+      print(f"Recorded \"{entry['transcript']}\" ({entry['audio_bytes'] / 1024:.0f} kB)")
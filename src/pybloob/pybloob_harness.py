@@ -0,0 +1,527 @@
+#!/bin/env python3
+""" Runs a Core in this process against an in-memory stand-in for the MQTT broker, so its throughput and latency can be
+measured without a broker, an Orchestrator or any Utils, and without the network getting in the way. The Core's
+Central Config and any Collections it needs are retained before it starts, as the Orchestrator would, then calls are
+sent straight to its /run topic, and everything it publishes is kept.
+
+Run with: python src/pybloob/pybloob_harness.py src/cores/calc/calc_bb_core.py --intent calc --text "what's 5 plus 5" --calls 1000
+(add --save-outputs outputs.jsonl to keep what it answered, and --expect-outputs outputs.jsonl on a later run to check
+that a change didn't alter its answers)
+
+Cores are run as if they'd been run directly (`__name__` is `"__main__"`), from a thread, so one harness can be
+running at a time per process.
+"""
+import argparse
+import json
+import pathlib
+import queue
+import runpy
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+import pybloob
+from pybloob_zygote import coreIdFromPath
+
+try:
+  import aiomqtt
+except ImportError:
+  aiomqtt = None
+
+def _payloadBytes(payload):
+  if payload == None:
+    return b""
+  if isinstance(payload, str):
+    return payload.encode()
+  if isinstance(payload, (int, float)):
+    return str(payload).encode()
+  return bytes(payload)
+
+class FakeMessage:
+  def __init__(self, topic, payload: bytes, qos: int=0, retain: bool=False, mid: int=0):
+    self.topic = topic
+    self.payload = payload
+    self.qos = qos
+    self.retain = retain
+    self.mid = mid
+
+# Keeps retained messages and passes each message published on to every client subscribed to it (once per client,
+# however many of its subscriptions match), like a real broker would. Every publish is also kept in published, as
+# (time.perf_counter(), topic, payload, retain).
+class FakeBroker:
+  def __init__(self):
+    self.retained = {}
+    self.published = []
+    # Client -> topic filters it's subscribed to
+    self.subscriptions = {}
+    self.closed = False
+    self._lock = threading.RLock()
+
+  def subscribe(self, client, topic_filter: str):
+    with self._lock:
+      self.subscriptions.setdefault(client, set()).add(topic_filter)
+      retained = [(topic, payload) for topic, payload in self.retained.items() if mqtt.topic_matches_sub(topic_filter, topic)]
+    for topic, payload in retained:
+      client._deliver(topic, payload, True)
+
+  def unsubscribe(self, client, topic_filter: str):
+    with self._lock:
+      self.subscriptions.get(client, set()).discard(topic_filter)
+
+  def disconnect(self, client):
+    with self._lock:
+      self.subscriptions.pop(client, None)
+
+  def publish(self, topic: str, payload, retain: bool=False):
+    payload = _payloadBytes(payload)
+    with self._lock:
+      if self.closed:
+        return
+      self.published.append((time.perf_counter(), topic, payload, retain))
+      if retain:
+        if payload == b"":
+          self.retained.pop(topic, None)
+        else:
+          self.retained[topic] = payload
+      subscribers = [client for client, topic_filters in self.subscriptions.items() if any(mqtt.topic_matches_sub(topic_filter, topic) for topic_filter in topic_filters)]
+    for client in subscribers:
+      client._deliver(topic, payload, False)
+
+  ## Stops delivering anything, leaving the clients waiting for messages that won't come
+  def close(self):
+    with self._lock:
+      self.closed = True
+      clients = list(self.subscriptions)
+      self.subscriptions.clear()
+    for client in clients:
+      client._close()
+
+class FakeMessageInfo:
+  def __init__(self, mid: int):
+    self.mid = mid
+    self.rc = 0
+
+  def wait_for_publish(self, timeout: float=None):
+    pass
+
+  def is_published(self):
+    return True
+
+# The parts of paho's mqtt.Client that pybloob uses, with callbacks run on a thread of its own (started by loop_start)
+# just as paho's network loop would
+class FakeMqttClient:
+  def __init__(self, broker: FakeBroker, client_id: str=""):
+    self.broker = broker
+    self.client_id = client_id
+    self.on_connect = None
+    self.on_message = None
+    self.on_publish = None
+    self.on_disconnect = None
+    self.userdata = None
+    # Topic filter -> callback, checked in the order they were added
+    self.callbacks = {}
+    self.connected = False
+    self._mid = 0
+    self._mid_lock = threading.Lock()
+    self._queue = queue.Queue()
+    self._thread = None
+
+  def username_pw_set(self, username, password=None):
+    pass
+
+  def connect(self, host, port=1883, keepalive=60, **kwargs):
+    self.connected = True
+    self._queue.put(("connect", None))
+    return 0
+
+  def is_connected(self):
+    return self.connected
+
+  def disconnect(self, *args, **kwargs):
+    self.connected = False
+    self.broker.disconnect(self)
+    return 0
+
+  def loop_start(self):
+    if self._thread == None:
+      self._thread = threading.Thread(target=self.loop_forever, daemon=True, name=f"fake_mqtt_{self.client_id}")
+      self._thread.start()
+    return 0
+
+  def loop_stop(self):
+    if self._thread != None:
+      self._queue.put(None)
+      if self._thread != threading.current_thread():
+        self._thread.join()
+      self._thread = None
+    return 0
+
+  def loop_forever(self, *args, **kwargs):
+    while True:
+      item = self._queue.get()
+      if item == None:
+        return 0
+      self._dispatch(*item)
+
+  def message_callback_add(self, sub: str, callback):
+    self.callbacks[sub] = callback
+
+  def message_callback_remove(self, sub: str):
+    self.callbacks.pop(sub, None)
+
+  def subscribe(self, topic, qos: int=0, **kwargs):
+    topic_filters = [topic] if isinstance(topic, str) else [topic_filter for topic_filter, _ in topic]
+    for topic_filter in topic_filters:
+      self.broker.subscribe(self, topic_filter)
+    return 0, self._nextMid()
+
+  def unsubscribe(self, topic, **kwargs):
+    for topic_filter in [topic] if isinstance(topic, str) else topic:
+      self.broker.unsubscribe(self, topic_filter)
+    return 0, self._nextMid()
+
+  def publish(self, topic: str, payload=None, qos: int=0, retain: bool=False, **kwargs):
+    mid = self._nextMid()
+    self.broker.publish(topic, payload, retain)
+    self._queue.put(("published", mid))
+    return FakeMessageInfo(mid)
+
+  def _nextMid(self):
+    with self._mid_lock:
+      self._mid += 1
+      return self._mid
+
+  def _deliver(self, topic: str, payload: bytes, retain: bool):
+    self._queue.put(("message", FakeMessage(topic, payload, retain=retain)))
+
+  def _close(self):
+    self._queue.put(None)
+
+  def _dispatch(self, kind: str, value):
+    if kind == "connect":
+      if self.on_connect != None:
+        self.on_connect(self, self.userdata, {}, 0, None)
+    elif kind == "published":
+      if self.on_publish != None:
+        self.on_publish(self, self.userdata, value, 0, None)
+    else:
+      matched = False
+      for sub, callback in list(self.callbacks.items()):
+        if mqtt.topic_matches_sub(sub, value.topic):
+          callback(self, self.userdata, value)
+          matched = True
+      if not matched and self.on_message != None:
+        self.on_message(self, self.userdata, value)
+
+# The parts of aiomqtt.Client that pybloob_async uses, with messages handed to the event loop the client was entered on
+class FakeAsyncClient:
+  def __init__(self, broker: FakeBroker, *args, **kwargs):
+    self.broker = broker
+    self.loop = None
+    self._queue = None
+    self._mid = 0
+
+  async def __aenter__(self):
+    import asyncio
+    if self.broker.closed:
+      # Like a broker that's gone away and isn't coming back, without making the Core keep trying to reconnect
+      await asyncio.Event().wait()
+    self.loop = asyncio.get_running_loop()
+    self._queue = asyncio.Queue()
+    return self
+
+  async def __aexit__(self, *exc_info):
+    self.broker.disconnect(self)
+
+  async def subscribe(self, topic, qos: int=0, **kwargs):
+    for topic_filter in [topic] if isinstance(topic, str) else [topic_filter for topic_filter, _ in topic]:
+      self.broker.subscribe(self, topic_filter)
+
+  async def unsubscribe(self, topic, **kwargs):
+    for topic_filter in [topic] if isinstance(topic, str) else topic:
+      self.broker.unsubscribe(self, topic_filter)
+
+  async def publish(self, topic: str, payload=None, qos: int=0, retain: bool=False, **kwargs):
+    self.broker.publish(topic, payload, retain)
+
+  @property
+  def messages(self):
+    return self._messages()
+
+  async def _messages(self):
+    while True:
+      yield await self._queue.get()
+
+  def _deliver(self, topic: str, payload: bytes, retain: bool):
+    self._mid += 1
+    message = FakeMessage(aiomqtt.Topic(topic), payload, retain=retain, mid=self._mid)
+    try:
+      self.loop.call_soon_threadsafe(self._queue.put_nowait, message)
+    except RuntimeError:
+      # The event loop's closed
+      pass
+
+  def _close(self):
+    pass
+
+# How quickly a Core answered a run of calls, and what it answered (as (intent, text, pybloob.CoreFinishedMessage))
+class BenchmarkResult:
+  def __init__(self, seconds: float, latencies: list, outputs: list):
+    self.seconds = seconds
+    self.latencies = sorted(latencies)
+    self.outputs = outputs
+
+  @property
+  def throughput(self):
+    return len(self.latencies) / self.seconds if self.seconds > 0 else 0
+
+  ## The latency (in seconds) that percentile% of calls were answered within
+  def percentile(self, percentile: float):
+    if len(self.latencies) == 0:
+      return None
+    return self.latencies[min(int(len(self.latencies) * percentile / 100), len(self.latencies) - 1)]
+
+  def report(self):
+    return {"calls": len(self.latencies), "seconds": self.seconds, "throughput": self.throughput, "p50": self.percentile(50), "p95": self.percentile(95), "p99": self.percentile(99), "max": self.latencies[-1] if self.latencies else None}
+
+  def summary(self):
+    report = self.report()
+    if report["calls"] == 0:
+      return "No calls were answered"
+    return f"{report['calls']} calls in {report['seconds']:.3f} s ({report['throughput']:.1f}/s), latency p50 {report['p50'] * 1000:.2f} ms, p95 {report['p95'] * 1000:.2f} ms, p99 {report['p99'] * 1000:.2f} ms, max {report['max'] * 1000:.2f} ms"
+
+# Runs the Core at core_path against a FakeBroker, with central_config and collections (Collection ID -> Collection)
+# retained for it first. Start it, then use call for single calls, or benchmark to measure throughput and latency.
+# Everything published (by the Core or the harness) is in harness.broker.published, or use harness.published(topic_filter).
+#
+# with pybloob_harness.CoreTestHarness("src/cores/calc/calc_bb_core.py") as harness:
+#   print(harness.call("calc", "what's 5 plus 5").text)
+#   print(harness.benchmark([("calc", "what's 5 plus 5")], calls=1000, concurrency=4).summary())
+class CoreTestHarness:
+  _running = None
+
+  def __init__(self, core_path, device_id: str="test", core_id: str=None, central_config: dict=None, collections: dict=None, core_arguments: list=[]):
+    self.core_path = pathlib.Path(core_path)
+    self.device_id = device_id
+    # Only needed before the Core starts (for its Central Config), after which it's taken from what the Core reports
+    self.core_id = core_id or coreIdFromPath(self.core_path)
+    self.central_config = central_config
+    self.collections = collections or {}
+    self.core_arguments = core_arguments
+    self.broker = FakeBroker()
+    # Why the Core exited, if it did
+    self.error = None
+
+    self.client = FakeMqttClient(self.broker, "harness")
+    self.client.message_callback_add(f"bloob/{self.device_id}/startup/+", self._onStartup)
+    self.client.message_callback_add(f"bloob/{self.device_id}/cores/+/finished", self._onFinished)
+    # Call ID -> (when it was sent, intent, text, function given the finish time and pybloob.CoreFinishedMessage)
+    self._pending = {}
+    self._pending_lock = threading.Lock()
+    self._call_count = 0
+    self._started = threading.Event()
+    self._patched = {}
+    self._state_cache_dir = None
+    self._thread = None
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, *exc_info):
+    self.stop()
+
+  ## Starts the Core, returning once it's ready for calls (or raising RuntimeError if it exits or takes over timeout seconds)
+  def start(self, timeout: float=30):
+    if CoreTestHarness._running != None:
+      raise RuntimeError("Only one CoreTestHarness can be running at a time")
+    CoreTestHarness._running = self
+    self._patch()
+
+    if self.central_config != None:
+      self.broker.publish(f"bloob/{self.device_id}/cores/{self.core_id}/central_config", pybloob.encodeJson(self.central_config), retain=True)
+    for collection_id, collection in self.collections.items():
+      self.broker.publish(f"bloob/{self.device_id}/collections/{collection_id}", pybloob.encodeJson(collection), retain=True)
+
+    self.client.connect("harness")
+    self.client.subscribe([(f"bloob/{self.device_id}/startup/+", 0), (f"bloob/{self.device_id}/cores/+/finished", 0)])
+    self.client.loop_start()
+
+    argv = sys.argv
+    sys.argv = [str(self.core_path), "--device-id", self.device_id, "--host", "harness", "--port", "1883"] + self.core_arguments
+    try:
+      self._thread = threading.Thread(target=self._runCore, daemon=True, name=f"harness_{self.core_id}")
+      self._thread.start()
+      deadline = time.monotonic() + timeout
+      while not self._started.wait(0.05):
+        if not self._thread.is_alive():
+          self.stop()
+          raise RuntimeError(f"{self.core_path.name} exited before it was ready: {self.error}")
+        if time.monotonic() > deadline:
+          self.stop()
+          raise RuntimeError(f"{self.core_path.name} wasn't ready after {timeout} s")
+    finally:
+      sys.argv = argv
+
+  ## Stops delivering messages (which leaves the Core waiting forever on a daemon thread), and undoes the patching
+  def stop(self):
+    self.broker.close()
+    self._unpatch()
+    if CoreTestHarness._running == self:
+      CoreTestHarness._running = None
+
+  ## Sends one call, returning the pybloob.CoreFinishedMessage it's answered with
+  def call(self, intent: str, text: str, timeout: float=30):
+    finished = threading.Event()
+    outputs = []
+    def onFinished(finish_time, output):
+      outputs.append(output)
+      finished.set()
+    call_id = self._send(intent, text, onFinished)
+    if not finished.wait(timeout):
+      with self._pending_lock:
+        self._pending.pop(call_id, None)
+      raise TimeoutError(f"{self.core_id} didn't answer within {timeout} s")
+    return outputs[0]
+
+  ## Sends calls calls, going through calls_to_send (a list of (intent, text)) in turn, with up to concurrency waiting
+  ## on an answer at once. Raises TimeoutError if any call takes longer than timeout seconds.
+  def benchmark(self, calls_to_send: list, calls: int=None, concurrency: int=1, timeout: float=30):
+    calls = calls or len(calls_to_send)
+    slots = threading.Semaphore(concurrency)
+    all_finished = threading.Event()
+    latencies = []
+    outputs = []
+    results_lock = threading.Lock()
+
+    def onFinished(send_time, intent, text):
+      def recordFinish(finish_time, output):
+        with results_lock:
+          latencies.append(finish_time - send_time)
+          outputs.append((intent, text, output))
+          if len(latencies) == calls:
+            all_finished.set()
+        slots.release()
+      return recordFinish
+
+    start_time = time.perf_counter()
+    for call_index in range(calls):
+      if not slots.acquire(timeout=timeout):
+        raise TimeoutError(f"{self.core_id} didn't answer a call within {timeout} s")
+      intent, text = calls_to_send[call_index % len(calls_to_send)]
+      self._send(intent, text, onFinished(time.perf_counter(), intent, text))
+    if not all_finished.wait(timeout):
+      raise TimeoutError(f"{self.core_id} didn't answer a call within {timeout} s")
+    return BenchmarkResult(time.perf_counter() - start_time, latencies, outputs)
+
+  ## Everything published to topics matching topic_filter so far, as (time.perf_counter(), topic, payload, retain)
+  def published(self, topic_filter: str="#"):
+    return [message for message in self.broker.published if mqtt.topic_matches_sub(topic_filter, message[1])]
+
+  def _send(self, intent: str, text: str, on_finished):
+    with self._pending_lock:
+      self._call_count += 1
+      call_id = f"harness_{self._call_count}"
+      self._pending[call_id] = on_finished
+    self.client.publish(f"bloob/{self.device_id}/cores/{self.core_id}/run", pybloob.CoreRunMessage(call_id, text, intent).encode())
+    return call_id
+
+  def _onFinished(self, client, userdata, message):
+    finish_time = time.perf_counter()
+    if message.topic != f"bloob/{self.device_id}/cores/{self.core_id}/finished":
+      return
+    try:
+      output = pybloob.CoreFinishedMessage.decode(message.payload)
+    except pybloob.MessageError:
+      return
+    with self._pending_lock:
+      on_finished = self._pending.pop(output.id, None)
+    if on_finished != None:
+      on_finished(finish_time, output)
+
+  def _onStartup(self, client, userdata, message):
+    self.core_id = message.topic.split("/")[-1]
+    self._started.set()
+
+  def _runCore(self):
+    try:
+      runpy.run_path(str(self.core_path), run_name="__main__")
+    except SystemExit as e:
+      self.error = f"exited with {e.code}"
+    except BaseException as e:
+      self.error = repr(e)
+
+  # Points pybloob (and aiomqtt) at the FakeBroker, and keeps the Core's state cache out of the real one
+  def _patch(self):
+    self._state_cache_dir = tempfile.TemporaryDirectory()
+    self._patched = {(pybloob, "createMqttClient"): pybloob.createMqttClient, (pybloob, "default_state_cache_path"): pybloob.default_state_cache_path, (signal, "signal"): signal.signal}
+    pybloob.createMqttClient = lambda client_id="": FakeMqttClient(self.broker, client_id)
+    pybloob.default_state_cache_path = pathlib.Path(self._state_cache_dir.name)
+    # Cores running from the main thread may set signal handlers, which can only be done from there
+    original_signal = signal.signal
+    def setSignal(signal_number, handler):
+      if threading.current_thread() == threading.main_thread():
+        return original_signal(signal_number, handler)
+    signal.signal = setSignal
+    if aiomqtt != None:
+      self._patched[(aiomqtt, "Client")] = aiomqtt.Client
+      aiomqtt.Client = lambda *args, **kwargs: FakeAsyncClient(self.broker)
+
+  def _unpatch(self):
+    for (module, name), value in self._patched.items():
+      setattr(module, name, value)
+    self._patched = {}
+    if self._state_cache_dir != None:
+      self._state_cache_dir.cleanup()
+      self._state_cache_dir = None
+
+## What a run answered, as one JSON line per distinct call: {"intent", "text", "output", "explanation"}
+def outputLines(result: BenchmarkResult):
+  seen = {}
+  for intent, text, output in result.outputs:
+    seen.setdefault((intent, text), {"intent": intent, "text": text, "output": output.text, "explanation": output.explanation})
+  return [json.dumps(line) for line in seen.values()]
+
+if __name__ == "__main__":
+  arg_parser = argparse.ArgumentParser()
+  arg_parser.add_argument('core_path')
+  arg_parser.add_argument('--device-id', default="test")
+  arg_parser.add_argument('--core-id', help="Defaults to the Core's filename without _bb_core, only used for --central-config")
+  arg_parser.add_argument('--intent', required=True)
+  arg_parser.add_argument('--text', action="append", required=True, help="Can be given more than once, with calls going through them in turn")
+  arg_parser.add_argument('--calls', default=100, type=int)
+  arg_parser.add_argument('--concurrency', default=1, type=int, help="How many calls can be waiting on an answer at once")
+  arg_parser.add_argument('--warmup', default=10, type=int, help="Calls to send (and not measure) first")
+  arg_parser.add_argument('--central-config', help="Path to a JSON file with the Core's Central Config")
+  arg_parser.add_argument('--collections', help="Path to a JSON file of Collection ID -> Collection")
+  arg_parser.add_argument('--save-outputs', help="Path to save what the Core answered to, as JSON lines")
+  arg_parser.add_argument('--expect-outputs', help="Path to answers saved by --save-outputs, exiting with 1 if any differ")
+  arguments = arg_parser.parse_args()
+
+  central_config = json.loads(pathlib.Path(arguments.central_config).read_text()) if arguments.central_config != None else None
+  core_collections = json.loads(pathlib.Path(arguments.collections).read_text()) if arguments.collections != None else None
+  calls_to_send = [(arguments.intent, text) for text in arguments.text]
+
+  with CoreTestHarness(arguments.core_path, arguments.device_id, arguments.core_id, central_config, core_collections) as harness:
+    if arguments.warmup > 0:
+      harness.benchmark(calls_to_send, arguments.warmup, arguments.concurrency)
+    result = harness.benchmark(calls_to_send, arguments.calls, arguments.concurrency)
+  print(result.summary())
+
+  lines = outputLines(result)
+  if arguments.save_outputs != None:
+    pathlib.Path(arguments.save_outputs).write_text("\n".join(lines) + "\n")
+  if arguments.expect_outputs != None:
+    expected = {(line["intent"], line["text"]): line for line in map(json.loads, pathlib.Path(arguments.expect_outputs).read_text().splitlines()) if line}
+    differences = 0
+    for line in map(json.loads, lines):
+      expected_line = expected.get((line["intent"], line["text"]))
+      if expected_line != None and (expected_line["output"], expected_line["explanation"]) != (line["output"], line["explanation"]):
+        differences += 1
+        print(f"\"{line['text']}\" was answered with \"{line['output']}\", expected \"{expected_line['output']}\"", file=sys.stderr)
+    if differences > 0:
+      sys.exit(1)
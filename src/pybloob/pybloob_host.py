@@ -0,0 +1,149 @@
+#!/bin/env python3
+""" Runs several lightweight Python Cores in one process, sharing one event loop and one MQTT connection, rather than
+each paying for its own interpreter, imports and connections. Each Core still has its own ID, Core Config, Intents and
+Central Config.
+
+Run with: python src/pybloob/pybloob_host.py --device-id test src/cores/calc/calc_bb_core.py src/cores/parrot/parrot_bb_core.py
+(or list their IDs in the Orchestrator's "hosted_cores" to have it do this for you)
+
+Hosted Cores must be AsyncCores that only call c.run() under `if __name__ == "__main__":`, so that importing them
+just sets them up. A Core that fails to load, or fails while starting up, is logged and left out, and the rest carry on.
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import importlib.machinery
+import importlib.util
+import pathlib
+import sys
+import time
+
+import aiomqtt
+
+import pybloob
+import pybloob_async
+
+class CoreHost:
+  def __init__(self, device_id: str, mqtt_host: str, mqtt_port: int, mqtt_user: str=None, mqtt_pass: str=None, reconnect_interval: float=5, max_threads: int=None):
+    self.device_id = device_id
+    self.mqtt_host = mqtt_host
+    self.mqtt_port = mqtt_port
+    self.mqtt_user = mqtt_user
+    self.mqtt_pass = mqtt_pass
+    self.reconnect_interval = reconnect_interval
+    self.max_threads = max_threads
+
+    self.cores = []
+    # Core path -> why it couldn't be hosted
+    self.failed_cores = {}
+
+    self.mqtt_client = None
+    self.loop = None
+    self.logs_topic = f"bloob/{self.device_id}/logs"
+    self.logger = pybloob.BufferedLogger(self._publishLogs)
+
+  def log(self, text_to_log, level: int=pybloob.log_level_info):
+    self.logger.log(pybloob.formatLogLine("core_host", text_to_log, level), level)
+
+  def _publishLogs(self, text: str):
+    if self.mqtt_client != None and self.loop != None:
+      asyncio.run_coroutine_threadsafe(self.mqtt_client.publish(self.logs_topic, text, qos=pybloob.bloobQOS), self.loop)
+
+  def _fail(self, core_path, reason: str):
+    self.failed_cores[str(core_path)] = reason
+    self.log(f"Not hosting {core_path}, as it {reason}", pybloob.log_level_error)
+
+  ## Imports the Core at core_path, returning the AsyncCores it set up (normally one). Anything going wrong is logged
+  ## and recorded in failed_cores rather than raised, so one broken Core can't stop the others from loading.
+  def load(self, core_path):
+    core_path = pathlib.Path(core_path)
+    module_name = core_path.name.split(".")[0]
+
+    # Hosted Cores parse the same arguments that the Orchestrator would've given them on their own
+    core_arguments = ["--device-id", self.device_id, "--host", self.mqtt_host, "--port", str(self.mqtt_port)]
+    if self.mqtt_user != None:
+      core_arguments += ["--user", self.mqtt_user, "--pass", self.mqtt_pass]
+    host_argv = sys.argv
+    sys.argv = [str(core_path)] + core_arguments
+    try:
+      loader = importlib.machinery.SourceFileLoader(module_name, str(core_path))
+      module = importlib.util.module_from_spec(importlib.util.spec_from_loader(module_name, loader))
+      loader.exec_module(module)
+    except (Exception, SystemExit) as e:
+      self._fail(core_path, f"failed to load: {repr(e)}")
+      return []
+    finally:
+      sys.argv = host_argv
+
+    cores = [value for value in vars(module).values() if isinstance(value, pybloob_async.AsyncCore)]
+    if len(cores) == 0:
+      self._fail(core_path, "doesn't set up an AsyncCore")
+    self.cores += cores
+    return cores
+
+  def run(self):
+    asyncio.run(self.main())
+
+  async def main(self):
+    self.loop = asyncio.get_running_loop()
+    # Blocking handlers from every Core share one thread pool, rather than each Core having its own
+    thread_pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_threads, thread_name_prefix="core_host")
+    for core in self.cores:
+      core._prepare(thread_pool)
+
+    while True:
+      try:
+        connect_start = time.monotonic()
+        async with aiomqtt.Client(hostname=self.mqtt_host, port=self.mqtt_port, username=self.mqtt_user, password=self.mqtt_pass) as client:
+          self.mqtt_client = client
+          for core in self.cores:
+            core.startup.add("mqtt_connect", connect_start, time.monotonic())
+          message_reader = asyncio.create_task(self._readMessages(client))
+          await asyncio.gather(*[self._connectCore(core, client) for core in list(self.cores)])
+          self.log(f"Hosting {', '.join(core.core_id for core in self.cores)}")
+          await message_reader
+      except aiomqtt.MqttError:
+        self.mqtt_client = None
+        for core in self.cores:
+          core.mqtt_client = None
+        print(f"[core_host] Lost connection to the MQTT broker, reconnecting in {self.reconnect_interval}s")
+        await asyncio.sleep(self.reconnect_interval)
+
+  # A Core whose startup functions or publishing fail is dropped, rather than taking the others down with it
+  async def _connectCore(self, core: pybloob_async.AsyncCore, client: aiomqtt.Client):
+    try:
+      await core._onConnected(client)
+    except aiomqtt.MqttError:
+      raise
+    except Exception as e:
+      self.cores.remove(core)
+      self._fail(core.core_id, f"failed to start: {repr(e)}")
+
+  async def _readMessages(self, client: aiomqtt.Client):
+    async for message in client.messages:
+      for core in self.cores:
+        if not core._handlesTopic(message.topic):
+          continue
+        try:
+          core._onMessage(message)
+        except Exception as e:
+          self.log(f"{core.core_id} failed to handle a message on {message.topic.value}: {repr(e)}", pybloob.log_level_error)
+
+if __name__ == "__main__":
+  arg_parser = argparse.ArgumentParser()
+  arg_parser.add_argument('--host', default="localhost")
+  arg_parser.add_argument('--port', default=1883, type=int)
+  arg_parser.add_argument('--user')
+  arg_parser.add_argument('--pass')
+  arg_parser.add_argument('--device-id', default="test")
+  arg_parser.add_argument('cores', nargs="+", help="Paths of the Cores to host")
+  arguments = arg_parser.parse_args()
+
+  host = CoreHost(arguments.device_id, arguments.host, arguments.port, arguments.user, arguments.__dict__.get("pass"))
+  for core_path in arguments.cores:
+    host.load(core_path)
+  if len(host.cores) == 0:
+    host.log("No Cores could be loaded, exiting", pybloob.log_level_error)
+    host.logger.flush()
+    sys.exit(1)
+  host.run()
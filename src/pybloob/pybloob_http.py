@@ -0,0 +1,87 @@
+import collections
+import re
+import threading
+import time
+
+import requests
+import requests.adapters
+import urllib3.util.retry
+
+# An HTTP client for Cores talking to web services and devices, so each command doesn't pay for a new connection. It's
+# a requests.Session (so it's used just the same: .get, .post, .json() and so on), which keeps connections to each host
+# open between requests (pool_size per host), and adds:
+# * A default timeout (a requests-style (connect, read) pair, in seconds) for any request not given its own
+# * Retries (up to retries times, backing off from backoff seconds) when connecting fails, or the server's briefly
+#   unavailable. Only requests that are safe to repeat are retried after they may have been received, which with
+#   idempotent=True includes POSTs (like setting a light's state)
+# * With cache_ttl, a cache of GET responses, each kept for cache_ttl seconds, or as long as the response's
+#   Cache-Control max-age says. Responses with Cache-Control no-store or no-cache aren't kept.
+# * With metrics (a MetricsRegistry), request latency and errors by service (see MetricsRegistry.httpResponseHook),
+#   and cache hits in http_cache_hits_total
+#
+# http_session = c.httpClient("wled", idempotent=True)
+# http_session.post(f"http://{ip_address}/win&T=1")
+class HttpClient(requests.Session):
+  def __init__(self, service: str=None, metrics=None, timeout=(3.05, 10), retries: int=2, backoff: float=0.2, idempotent: bool=False, pool_size: int=4, cache_ttl: float=None, max_cached: int=128):
+    super().__init__()
+    self.service = service
+    self.metrics = metrics
+    self.timeout = timeout
+    self.cache_ttl = cache_ttl
+    self.max_cached = max_cached
+    # (url, headers) -> (expiry time, response), oldest first
+    self.cache = collections.OrderedDict()
+    self._cache_lock = threading.Lock()
+
+    retry = urllib3.util.retry.Retry(total=retries, backoff_factor=backoff, status_forcelist=(502, 503, 504),
+      allowed_methods=None if idempotent else urllib3.util.retry.Retry.DEFAULT_ALLOWED_METHODS, raise_on_status=False)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    self.mount("http://", adapter)
+    self.mount("https://", adapter)
+
+    if metrics != None:
+      self.hooks["response"].append(metrics.httpResponseHook(service))
+
+  def request(self, method, url, **kwargs):
+    if kwargs.get("timeout") == None:
+      kwargs["timeout"] = self.timeout
+    return super().request(method, url, **kwargs)
+
+  def send(self, request, **kwargs):
+    if self.cache_ttl == None or request.method != "GET" or kwargs.get("stream"):
+      return super().send(request, **kwargs)
+
+    cache_key = (request.url, tuple(sorted(request.headers.items())))
+    with self._cache_lock:
+      cached = self.cache.get(cache_key)
+      if cached != None and cached[0] > time.monotonic():
+        if self.metrics != None:
+          self.metrics.counter("http_cache_hits_total", {"service": self.service}).inc()
+        return cached[1]
+      self.cache.pop(cache_key, None)
+
+    response = super().send(request, **kwargs)
+    ttl = self._cacheTtl(response)
+    if ttl > 0:
+      with self._cache_lock:
+        self.cache[cache_key] = (time.monotonic() + ttl, response)
+        while len(self.cache) > self.max_cached:
+          self.cache.popitem(last=False)
+    return response
+
+  ## Forgets every cached response
+  def clearCache(self):
+    with self._cache_lock:
+      self.cache.clear()
+
+  # How long a response can be reused for, with 0 meaning it can't
+  def _cacheTtl(self, response):
+    if response.status_code != 200:
+      return 0
+    cache_control = response.headers.get("Cache-Control", "").lower()
+    if "no-store" in cache_control or "no-cache" in cache_control:
+      return 0
+    max_age = re.search(r"max-age=(\d+)", cache_control)
+    if max_age != None:
+      return int(max_age.group(1))
+    return self.cache_ttl
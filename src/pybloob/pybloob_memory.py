@@ -0,0 +1,165 @@
+import contextlib
+import gc
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+import pybloob
+
+page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+## This process's resident set size in bytes (cheap enough to call often), or None if it can't be read
+def rss():
+  try:
+    with open("/proc/self/statm", "r") as statm_file:
+      return int(statm_file.read().split()[1]) * page_size
+  except (OSError, ValueError, IndexError):
+    return None
+
+## Resident and proportional set sizes (in bytes) of a process. PSS splits shared pages between the processes sharing
+## them, so it's what shows the savings from sharing preloaded modules. Either is None if it can't be read.
+def memoryUsage(pid: int):
+  rss = pss = None
+  try:
+    with open(f"/proc/{pid}/smaps_rollup", "r") as smaps_file:
+      for line in smaps_file:
+        if line.startswith("Rss:"):
+          rss = int(line.split()[1]) * 1024
+        elif line.startswith("Pss:"):
+          pss = int(line.split()[1]) * 1024
+  except OSError:
+    pass
+  return rss, pss
+
+## The most memory this process has had resident at once, in bytes
+def peakRss():
+  try:
+    with open("/proc/self/status", "r") as status_file:
+      for line in status_file:
+        if line.startswith("VmHWM:"):
+          return int(line.split()[1]) * 1024
+  except OSError:
+    pass
+  return None
+
+_libc = None
+
+## Hands memory that Python's freed but glibc's still holding back to the kernel, returning whether it could
+def mallocTrim():
+  global _libc
+  if _libc == None:
+    import ctypes, ctypes.util
+    libc_name = ctypes.util.find_library("c")
+    _libc = ctypes.CDLL(libc_name) if libc_name != None else False
+  if _libc == False or not hasattr(_libc, "malloc_trim"):
+    return False
+  return _libc.malloc_trim(0) == 1
+
+_tracing_lock = threading.Lock()
+
+## Traces every allocation for seconds (or, if something's already tracing, looks at what it's seen), returning the
+## lines of code holding the most memory allocated in that time as [{"line": "file.py:123", "size": bytes, "count": blocks}]
+def topAllocations(seconds: float=10, limit: int=20):
+  # One trace at a time, so Cores hosted together can't stop each other's
+  with _tracing_lock:
+    started = not tracemalloc.is_tracing()
+    if started:
+      tracemalloc.start()
+      time.sleep(seconds)
+    try:
+      snapshot = tracemalloc.take_snapshot()
+    finally:
+      if started:
+        tracemalloc.stop()
+  snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")])
+  return [{"line": f"{os.path.basename(statistic.traceback[0].filename)}:{statistic.traceback[0].lineno}", "size": statistic.size, "count": statistic.count} for statistic in snapshot.statistics("lineno")[:limit]]
+
+# Keeps track of how much memory a Core's process is using, and what for. Every interval seconds, it publishes a report
+# (see report) and, if there's a budget (in MB) and the process is over it, tries to get back under it: running the
+# functions registered with onPressure (which should drop whatever caches they can), collecting garbage, and handing
+# freed memory back to the kernel. If that isn't enough, it logs a warning, once each time the budget's crossed.
+#
+# The process is what's measured, so Cores hosted together (see pybloob_host) all see the memory of the whole host.
+class MemoryMonitor:
+  def __init__(self, core_id: str, publish=None, interval: float=60, budget: float=None, log=None):
+    self.core_id = core_id
+    self.publish = publish
+    self.interval = interval
+    self.budget = budget
+    self.log = log
+    # Model name -> bytes it added when loaded
+    self.models = {}
+    self.pressure_callbacks = []
+    self.over_budget = False
+    self._thread = None
+
+  ## Decorator for functions to call when over budget, to free what they can
+  def onPressure(self, callback):
+    self.pressure_callbacks.append(callback)
+    return callback
+
+  def setBudget(self, budget: float):
+    self.budget = budget
+
+  ## This process's resident set size in bytes, for giving to addModel later
+  def rss(self):
+    return rss()
+
+  ## Records a model as taking up however much the process has grown since rss_start (from rss())
+  def addModel(self, name: str, rss_start: int):
+    rss_end = rss()
+    if rss_start != None and rss_end != None:
+      self.models[name] = max(rss_end - rss_start, 0)
+
+  ## Context manager recording how much its block (like loading a model) grew the process by, as model name
+  @contextlib.contextmanager
+  def model(self, name: str):
+    rss_start = rss()
+    yield
+    self.addModel(name, rss_start)
+
+  def report(self):
+    process_rss, process_pss = memoryUsage(os.getpid())
+    if process_rss == None:
+      process_rss = rss()
+    return {"core_id": self.core_id, "time": time.time(), "rss": process_rss, "pss": process_pss, "peak_rss": peakRss(), "models": self.models, "budget": self.budget, "over_budget": self.over_budget}
+
+  ## Tries to get back under budget if over it, returning the resident set size afterwards
+  def check(self):
+    process_rss = rss()
+    if self.budget == None or process_rss == None or process_rss <= self.budget * 1048576:
+      self.over_budget = False
+      return process_rss
+
+    for callback in self.pressure_callbacks:
+      try:
+        callback()
+      except Exception as e:
+        if self.log != None:
+          self.log(f"Freeing memory with {callback.__name__} failed: {repr(e)}", pybloob.log_level_warning)
+    gc.collect()
+    mallocTrim()
+    freed_rss = rss()
+
+    if freed_rss > self.budget * 1048576:
+      if not self.over_budget and self.log != None:
+        self.log(f"Using {freed_rss / 1048576:.0f} MB, over the {self.budget:.0f} MB memory budget even after freeing what could be freed (from {process_rss / 1048576:.0f} MB)", pybloob.log_level_warning)
+      self.over_budget = True
+    else:
+      self.over_budget = False
+    return freed_rss
+
+  ## Checks and publishes a report every interval seconds from a background thread (and once straight away)
+  def start(self):
+    if self._thread != None:
+      return
+    def monitorLoop():
+      while True:
+        self.check()
+        if self.publish != None:
+          self.publish(json.dumps(self.report()))
+        time.sleep(self.interval)
+    self._thread = threading.Thread(target=monitorLoop, daemon=True, name="memory")
+    self._thread.start()
@@ -0,0 +1,196 @@
+import bisect
+import http.server
+import json
+import threading
+import time
+
+# Rolling counters, gauges and latency histograms for watching Cores and Utils over time (where traces are for looking
+# at single requests). Recording a value is a lock and some arithmetic, so it's fine to do every frame in the wakeword
+# loop. pybloob.Core.metrics gives each Core a registry, which it publishes a snapshot of, retained, to
+# bloob/<device_id>/metrics/<core_id> every so often, and which can also be served in Prometheus' text format.
+#
+# c.metrics.histogram("stt_inference_seconds").observe(inference_time)
+# with c.metrics.histogram("tts_synthesis_seconds").time():
+#   speak(text)
+
+# In seconds, from 1ms up to 30s, for latencies
+default_buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+def _labelsKey(labels: dict):
+  return tuple(sorted(labels.items())) if labels else ()
+
+def _prometheusName(name: str, labels: tuple, extra_labels: tuple=()):
+  all_labels = labels + extra_labels
+  if len(all_labels) == 0:
+    return name
+  return name + "{" + ",".join(f'{key}="{str(value)}"' for key, value in all_labels) + "}"
+
+class Counter:
+  def __init__(self):
+    self.value = 0
+    self._lock = threading.Lock()
+
+  def inc(self, amount: float=1):
+    with self._lock:
+      self.value += amount
+
+  def snapshot(self):
+    return {"value": self.value}
+
+class Gauge:
+  def __init__(self):
+    self.value = 0
+
+  def set(self, value: float):
+    self.value = value
+
+  def snapshot(self):
+    return {"value": self.value}
+
+class Histogram:
+  def __init__(self, buckets: list=None):
+    self.buckets = sorted(buckets or default_buckets)
+    # One more than the buckets, for values above the highest one
+    self.bucket_counts = [0] * (len(self.buckets) + 1)
+    self.count = 0
+    self.sum = 0
+    self._lock = threading.Lock()
+
+  def observe(self, value: float):
+    bucket_index = bisect.bisect_left(self.buckets, value)
+    with self._lock:
+      self.bucket_counts[bucket_index] += 1
+      self.count += 1
+      self.sum += value
+
+  ## Context manager which observes how long its block took
+  def time(self):
+    return _HistogramTimer(self)
+
+  ## Estimates the given quantile (0-1) from the buckets, as the upper bound of the bucket it falls in
+  def quantile(self, quantile: float):
+    if self.count == 0:
+      return None
+    target = quantile * self.count
+    cumulative_count = 0
+    for bucket_index, bucket_count in enumerate(self.bucket_counts):
+      cumulative_count += bucket_count
+      if cumulative_count >= target:
+        return self.buckets[bucket_index] if bucket_index < len(self.buckets) else float("inf")
+    return float("inf")
+
+  def snapshot(self):
+    with self._lock:
+      snapshot = {"count": self.count, "sum": self.sum, "buckets": dict(zip([str(bucket) for bucket in self.buckets] + ["+Inf"], self.bucket_counts))}
+    for quantile in [0.5, 0.95, 0.99]:
+      snapshot[f"p{int(quantile * 100)}"] = self.quantile(quantile)
+    return snapshot
+
+class _HistogramTimer:
+  def __init__(self, histogram: Histogram):
+    self.histogram = histogram
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, exception_type, exception, traceback):
+    self.histogram.observe(time.perf_counter() - self.start)
+
+class MetricsRegistry:
+  def __init__(self):
+    # (type, name) -> labels key -> metric
+    self.metrics = {}
+    self._lock = threading.Lock()
+    self._publish_thread = None
+    self._server = None
+
+  def _get(self, metric_class, name: str, labels: dict, *args):
+    family = self.metrics.get((metric_class, name))
+    labels_key = _labelsKey(labels)
+    if family != None and labels_key in family:
+      return family[labels_key]
+    with self._lock:
+      family = self.metrics.setdefault((metric_class, name), {})
+      if labels_key not in family:
+        family[labels_key] = metric_class(*args)
+      return family[labels_key]
+
+  ## These return the existing metric with that name and labels, or create it. Keep hold of the result in hot loops.
+  def counter(self, name: str, labels: dict=None) -> Counter:
+    return self._get(Counter, name, labels)
+
+  def gauge(self, name: str, labels: dict=None) -> Gauge:
+    return self._get(Gauge, name, labels)
+
+  def histogram(self, name: str, labels: dict=None, buckets: list=None) -> Histogram:
+    return self._get(Histogram, name, labels, buckets)
+
+  ## A requests response hook (session.hooks["response"].append(...)) that records HTTP latency
+  def httpResponseHook(self, service: str):
+    def observeResponse(response, *args, **kwargs):
+      self.histogram("http_request_seconds", {"service": service}).observe(response.elapsed.total_seconds())
+      if response.status_code >= 400:
+        self.counter("http_errors_total", {"service": service}).inc()
+    return observeResponse
+
+  def snapshot(self):
+    with self._lock:
+      families = list(self.metrics.items())
+    snapshot = []
+    for (metric_class, name), family in families:
+      for labels_key, metric in list(family.items()):
+        snapshot.append({"name": name, "type": metric_class.__name__.lower(), "labels": dict(labels_key), **metric.snapshot()})
+    return {"time": time.time(), "metrics": snapshot}
+
+  def prometheusText(self):
+    with self._lock:
+      families = list(self.metrics.items())
+    lines = []
+    for (metric_class, name), family in families:
+      lines.append(f"# TYPE {name} {metric_class.__name__.lower()}")
+      for labels_key, metric in list(family.items()):
+        if metric_class == Histogram:
+          snapshot = metric.snapshot()
+          cumulative_count = 0
+          for bucket, bucket_count in snapshot["buckets"].items():
+            cumulative_count += bucket_count
+            lines.append(f"{_prometheusName(name + '_bucket', labels_key, (('le', bucket),))} {cumulative_count}")
+          lines.append(f"{_prometheusName(name + '_sum', labels_key)} {snapshot['sum']}")
+          lines.append(f"{_prometheusName(name + '_count', labels_key)} {snapshot['count']}")
+        else:
+          lines.append(f"{_prometheusName(name, labels_key)} {metric.value}")
+    return "\n".join(lines) + "\n"
+
+  ## Calls publish(snapshot_json) every interval seconds from a background thread
+  def startPublishing(self, publish, interval: float=30):
+    if self._publish_thread != None:
+      return
+    def publishLoop():
+      while True:
+        time.sleep(interval)
+        publish(json.dumps(self.snapshot()))
+    self._publish_thread = threading.Thread(target=publishLoop, daemon=True, name="metrics")
+    self._publish_thread.start()
+
+  ## Serves the metrics in Prometheus' text format at http://<host>:<port>/metrics, by default only to this machine
+  def serve(self, port: int, host: str="127.0.0.1"):
+    registry = self
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.path != "/metrics":
+          self.send_error(404)
+          return
+        body = registry.prometheusText().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args):
+        pass
+
+    self._server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=self._server.serve_forever, daemon=True, name="metrics_server").start()
+    return self._server
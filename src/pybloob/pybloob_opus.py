@@ -0,0 +1,73 @@
+import struct
+
+import numpy as np
+import opuslib
+
+# Opus compression of 16-bit PCM audio, for sending it between devices (like a satellite's recordings to a remote STT),
+# where it's around a tenth of the size. pybloob.Core decides when to use it, based on the consumer's published audio
+# capabilities, and pybloob.AudioMessage decodes it, so Utils don't deal with this directly.
+#
+# Encoded audio is the number of samples (per channel, u32), then each 20ms Opus packet prefixed with its length (u16).
+# The last frame is padded with silence, which the sample count lets us trim back off.
+opus_sample_rates = [8000, 12000, 16000, 24000, 48000]
+opus_bitrate = 24000
+frame_duration_ms = 20
+
+encoded_header = struct.Struct("!I")
+packet_header = struct.Struct("!H")
+
+def frameSize(sample_rate: int):
+  return sample_rate * frame_duration_ms // 1000
+
+def encodeOpus(pcm, sample_rate: int, channels: int=1) -> bytes:
+  if sample_rate not in opus_sample_rates:
+    raise ValueError(f"Opus doesn't support a sample rate of {sample_rate}")
+  encoder = opuslib.Encoder(sample_rate, channels, opuslib.APPLICATION_VOIP)
+  encoder.bitrate = opus_bitrate
+
+  frame_size = frameSize(sample_rate)
+  frame_bytes = frame_size * channels * 2
+  pcm = memoryview(pcm).cast("B")
+  samples = len(pcm) // (channels * 2)
+
+  encoded = [encoded_header.pack(samples)]
+  for frame_start in range(0, len(pcm), frame_bytes):
+    frame = pcm[frame_start:frame_start + frame_bytes]
+    if len(frame) < frame_bytes:
+      frame = bytes(frame) + bytes(frame_bytes - len(frame))
+    packet = encoder.encode(bytes(frame), frame_size)
+    encoded.append(packet_header.pack(len(packet)))
+    encoded.append(packet)
+  return b"".join(encoded)
+
+def _packets(encoded):
+  offset = encoded_header.size
+  while offset < len(encoded):
+    (packet_length,) = packet_header.unpack_from(encoded, offset)
+    offset += packet_header.size
+    yield bytes(encoded[offset:offset + packet_length])
+    offset += packet_length
+
+## Decodes straight into a float32 array (between -1 and 1, channels interleaved), which is what Whisper takes
+def decodeOpus(encoded, sample_rate: int, channels: int=1):
+  (samples,) = encoded_header.unpack_from(encoded)
+  decoder = opuslib.Decoder(sample_rate, channels)
+  frame_size = frameSize(sample_rate)
+  frame_length = frame_size * channels
+
+  frame_count = -(-samples // frame_size)
+  audio = np.zeros(frame_count * frame_length, dtype=np.float32)
+  position = 0
+  for packet in _packets(encoded):
+    decoded = np.frombuffer(decoder.decode_float(packet, frame_size), dtype=np.float32)
+    audio[position:position + len(decoded)] = decoded
+    position += frame_length
+  return audio[:samples * channels]
+
+## Decodes back into 16-bit PCM bytes (for writing WAVs to play back)
+def decodeOpusPcm(encoded, sample_rate: int, channels: int=1) -> bytes:
+  (samples,) = encoded_header.unpack_from(encoded)
+  decoder = opuslib.Decoder(sample_rate, channels)
+  frame_size = frameSize(sample_rate)
+  pcm = b"".join([decoder.decode(packet, frame_size) for packet in _packets(encoded)])
+  return pcm[:samples * channels * 2]
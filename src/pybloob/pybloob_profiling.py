@@ -0,0 +1,148 @@
+#!/bin/env python3
+""" Profiles a running Core, by asking it over MQTT to sample what every one of its threads is doing for a while.
+Every pybloob Core listens for this on bloob/<device_id>/cores/<core_id>/debug/profile, and only starts sampling (in
+its own thread) once asked, so it costs nothing otherwise.
+
+Run with: python src/pybloob/pybloob_profiling.py --device-id test --core stt_util --seconds 10 > stt_util.folded
+(the default "collapsed" output can be turned into a flamegraph with flamegraph.pl or speedscope, or use --format top
+for a table of the functions most often seen)
+"""
+import argparse
+import collections
+import os
+import random
+import sys
+import threading
+import time
+
+# A thread only counts as busy in a sample if it used at least this much of the time since the last one on the CPU, so
+# threads waiting for something (a lock, a queue, a socket, a sleep) are left out unless include_idle is set
+busy_threshold = 0.1
+# Where there are no per-thread CPU clocks, stacks whose innermost frame is in one of these are taken as waiting instead
+idle_files = {"threading.py", "selectors.py", "queue.py"}
+
+def _frameName(frame):
+  code = frame.f_code
+  # ";" separates frames in the collapsed format
+  return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+
+def _threadCpuTime(thread_id: int):
+  try:
+    return time.clock_gettime(time.pthread_getcpuclockid(thread_id))
+  except (AttributeError, OSError):
+    return None
+
+## Samples the stack of every thread (other than its own) every interval seconds until seconds have passed. Returns
+## (thread name, stack from outermost to innermost frame) -> times seen, and how many samples were taken.
+def sample(seconds: float, interval: float=0.005, include_idle: bool=False):
+  stacks = collections.Counter()
+  own_thread = threading.get_ident()
+  samples = 0
+  # Thread id -> CPU time at the last sample
+  cpu_times = {}
+  last_sample_time = time.monotonic()
+  end_time = last_sample_time + seconds
+  while time.monotonic() < end_time:
+    sample_time = time.monotonic()
+    thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+    for thread_id, frame in sys._current_frames().items():
+      if thread_id == own_thread:
+        continue
+      if not include_idle:
+        cpu_time = _threadCpuTime(thread_id)
+        if cpu_time == None:
+          if os.path.basename(frame.f_code.co_filename) in idle_files:
+            continue
+        else:
+          last_cpu_time = cpu_times.get(thread_id)
+          cpu_times[thread_id] = cpu_time
+          if last_cpu_time == None or cpu_time - last_cpu_time < busy_threshold * (sample_time - last_sample_time):
+            continue
+      stack = []
+      while frame != None:
+        stack.append(_frameName(frame))
+        frame = frame.f_back
+      stacks[(thread_names.get(thread_id, str(thread_id)), tuple(reversed(stack)))] += 1
+    last_sample_time = sample_time
+    samples += 1
+    time.sleep(interval)
+  return stacks, samples
+
+## One line per distinct stack, "thread;outer;...;inner count", as taken by flamegraph.pl and speedscope
+def formatCollapsed(stacks: collections.Counter):
+  return "\n".join(f"{';'.join((thread_name,) + stack)} {count}" for (thread_name, stack), count in sorted(stacks.items()))
+
+## The functions seen most often, by the share of every thread's stacks seen that they were running in (own) or were
+## anywhere in (total)
+def formatTop(stacks: collections.Counter, samples: int, limit: int=40):
+  own_counts = collections.Counter()
+  total_counts = collections.Counter()
+  for (thread_name, stack), count in stacks.items():
+    own_counts[stack[-1]] += count
+    for function in set(stack):
+      total_counts[function] += count
+  stacks_seen = max(sum(stacks.values()), 1)
+  lines = [f"{stacks_seen} stacks over {samples} samples", f"{'Own':>8}{'Total':>8}  Function"]
+  for function, total_count in total_counts.most_common(limit):
+    lines.append(f"{own_counts[function] / stacks_seen:>8.1%}{total_count / stacks_seen:>8.1%}  {function}")
+  return "\n".join(lines)
+
+profile_formats = {"collapsed": lambda stacks, samples: formatCollapsed(stacks), "top": formatTop}
+
+## Samples this process as asked by request (a pybloob.ProfileRequestMessage), returning (profile text, samples taken)
+def profile(request):
+  import pybloob
+  profile_format = request.format or "collapsed"
+  if profile_format not in profile_formats:
+    raise ValueError(f"Unknown profile format {profile_format}, expected one of {', '.join(profile_formats)}")
+  seconds = min(request.seconds or pybloob.profile_default_seconds, pybloob.profile_max_seconds)
+  interval = max(request.interval or 0.005, 0.001)
+  stacks, samples = sample(seconds, interval, bool(request.include_idle))
+  return profile_formats[profile_format](stacks, max(samples, 1)), samples
+
+if __name__ == "__main__":
+  arg_parser = argparse.ArgumentParser()
+  arg_parser.add_argument('--host', default="localhost")
+  arg_parser.add_argument('--port', default=1883, type=int)
+  arg_parser.add_argument('--user')
+  arg_parser.add_argument('--pass')
+  arg_parser.add_argument('--device-id', default="test")
+  arg_parser.add_argument('--core', required=True, help="ID of the Core to profile")
+  arg_parser.add_argument('--seconds', default=10, type=float)
+  arg_parser.add_argument('--interval', default=0.005, type=float, help="Seconds between samples")
+  arg_parser.add_argument('--format', default="collapsed", choices=list(profile_formats))
+  arg_parser.add_argument('--include-idle', action="store_true", help="Also count threads that are waiting on something")
+  arguments = arg_parser.parse_args()
+
+  import pybloob
+
+  request = pybloob.ProfileRequestMessage(str(random.randint(1, 1000000)), arguments.seconds, arguments.interval, arguments.format, arguments.include_idle)
+  profile_topic = f"bloob/{arguments.device_id}/cores/{arguments.core}/debug/profile"
+  finished = threading.Event()
+
+  def onReply(client, userdata, message):
+    try:
+      reply = pybloob.ProfileMessage.decode(message.payload)
+    except pybloob.MessageError:
+      return
+    if reply.id != request.id:
+      return
+    if reply.error != None:
+      print(f"{arguments.core} couldn't profile itself: {reply.error}", file=sys.stderr)
+    else:
+      print(f"Took {reply.samples} samples over {reply.seconds} s", file=sys.stderr)
+      print(reply.profile)
+    finished.set()
+
+  client = pybloob.createMqttClient()
+  if arguments.user != None:
+    client.username_pw_set(arguments.user, arguments.__dict__.get("pass"))
+  client.on_message = onReply
+  client.connect(arguments.host, arguments.port)
+  client.subscribe(profile_topic + "/finished", pybloob.bloobQOS)
+  client.publish(profile_topic, request.encode(), qos=pybloob.bloobQOS)
+  client.loop_start()
+  print(f"Profiling {arguments.core} for {arguments.seconds} s", file=sys.stderr)
+  if not finished.wait(arguments.seconds + 10):
+    sys.exit(f"{arguments.core} didn't reply, is it running (and using a pybloob new enough to be profiled)?")
+  client.loop_stop()
@@ -0,0 +1,119 @@
+import concurrent.futures
+import threading
+
+import pybloob
+
+# Request / response calls to other Cores and Utils over a Core's one persistent connection. Each call publishes a
+# request, and returns a Future which is resolved once a reply with the same id arrives on the reply topic. Reply
+# topics are subscribed to (once, and again on reconnecting) before the first request is published, and the broker
+# handles what one connection sends in order, so even the quickest reply can't be missed. Many calls can be in flight
+# at once, each with its own timeout, and cancelling a call's Future forgets about it.
+#
+# transcript = c.call(f"bloob/{remote_device}/cores/stt_util/transcribe", audio_payload,
+#   f"bloob/{remote_device}/cores/stt_util/finished", request_id, pybloob.TranscriptMessage.decode, timeout=30).result()
+class RpcClient:
+  ## Requests are sent with publish(topic, payload, qos=qos) if given (like pybloob.Core._publish), or straight through
+  ## mqtt_client otherwise. log(text, level) is used to report broken replies, which are otherwise skipped.
+  def __init__(self, mqtt_client, qos: int=pybloob.bloobQOS, publish=None, log=None):
+    self.mqtt_client = mqtt_client
+    self.qos = qos
+    self.publish = publish or mqtt_client.publish
+    self.log = log
+    # Reply topic -> function that decodes its replies into something with an .id
+    self.reply_decoders = {}
+    # (reply topic, request id) -> Future, with a call's dropped topic (if it has one) also counting as a reply topic
+    self.pending_calls = {}
+    self.dropped_topics = set()
+    self._lock = threading.Lock()
+
+  ## Publishes payload to topic, returning a concurrent.futures.Future that's resolved with the first reply on
+  ## reply_topic whose decoded .id is request_id, or fails with TimeoutError if none arrives within timeout seconds.
+  ## If dropped_topic is given, the Future fails with pybloob.DroppedError once a DroppedMessage for request_id arrives
+  ## there, so a request the other end gave up on isn't waited on until the timeout.
+  def call(self, topic: str, payload, reply_topic: str, request_id: str, decode, timeout: float=None, dropped_topic: str=None) -> concurrent.futures.Future:
+    future = concurrent.futures.Future()
+    call_keys = [(reply_topic, request_id)]
+    if dropped_topic != None:
+      call_keys.append((dropped_topic, request_id))
+    previous_calls = []
+    with self._lock:
+      self._subscribe(reply_topic, decode)
+      if dropped_topic != None:
+        self._subscribe(dropped_topic, pybloob.DroppedMessage.decode)
+        self.dropped_topics.add(dropped_topic)
+      # Only the newest call with an id gets its reply
+      for call_key in call_keys:
+        previous_calls.append(self.pending_calls.pop(call_key, None))
+        self.pending_calls[call_key] = future
+    for previous_call in previous_calls:
+      if previous_call != None:
+        previous_call.cancel()
+
+    future.add_done_callback(lambda done_future: self._forget(call_keys, done_future))
+    if timeout != None:
+      timer = threading.Timer(timeout, self._timeOut, (future, timeout))
+      timer.daemon = True
+      timer.start()
+      future.add_done_callback(lambda done_future: timer.cancel())
+
+    self.publish(topic, payload, qos=self.qos)
+    return future
+
+  ## As call, but blocks until the reply arrives, returning it (or raising TimeoutError or pybloob.DroppedError)
+  def request(self, topic: str, payload, reply_topic: str, request_id: str, decode, timeout: float=None, dropped_topic: str=None):
+    return self.call(topic, payload, reply_topic, request_id, decode, timeout, dropped_topic).result()
+
+  ## Cancels every call still waiting for a reply
+  def cancelAll(self):
+    with self._lock:
+      futures = list(self.pending_calls.values())
+    for future in futures:
+      future.cancel()
+
+  ## Subscribes to the reply topics again, for after reconnecting
+  def resubscribe(self):
+    with self._lock:
+      reply_topics = list(self.reply_decoders.keys())
+    if len(reply_topics) > 0:
+      self.mqtt_client.subscribe([(reply_topic, self.qos) for reply_topic in reply_topics])
+
+  # Called with the lock held
+  def _subscribe(self, reply_topic: str, decode):
+    if reply_topic not in self.reply_decoders:
+      self.reply_decoders[reply_topic] = decode
+      self.mqtt_client.message_callback_add(reply_topic, self._onReply)
+      self.mqtt_client.subscribe(reply_topic, self.qos)
+
+  def _forget(self, call_keys: list, future: concurrent.futures.Future):
+    with self._lock:
+      for call_key in call_keys:
+        if self.pending_calls.get(call_key) is future:
+          del self.pending_calls[call_key]
+
+  def _timeOut(self, future: concurrent.futures.Future, timeout: float):
+    try:
+      future.set_exception(TimeoutError(f"No reply within {timeout}s"))
+    except concurrent.futures.InvalidStateError:
+      pass
+
+  # Called from the network thread, for every message on a reply topic, including replies to other clients' calls
+  def _onReply(self, client, userdata, message):
+    decode = self.reply_decoders.get(message.topic)
+    if decode == None:
+      return
+    try:
+      reply = decode(message.payload)
+    except ValueError as e:
+      if self.log != None:
+        self.log(f"Ignoring a broken reply on {message.topic}: {e}", pybloob.log_level_warning)
+      return
+    with self._lock:
+      future = self.pending_calls.pop((message.topic, reply.id), None)
+    if future != None:
+      try:
+        if message.topic in self.dropped_topics:
+          future.set_exception(pybloob.DroppedError(reply.id, reply.reason))
+        else:
+          future.set_result(reply)
+      except concurrent.futures.InvalidStateError:
+        pass
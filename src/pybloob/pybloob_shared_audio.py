@@ -0,0 +1,103 @@
+import mmap
+import os
+import pathlib
+import struct
+import threading
+import time
+
+# When the Util producing audio (like the recorder) and the one consuming it (like the STT) are on the same machine,
+# there's no need to send the audio itself through the broker. The producer writes it into a ring buffer file in
+# /dev/shm (so it's only ever in memory), and sends a small descriptor saying where it is instead. pybloob.Core decides
+# when that's possible, and pybloob.AudioMessage.decode reads it back, so Utils don't deal with this directly.
+#
+# Each entry in the ring is a header of (sequence number, length), then the audio. The descriptor holds the same
+# sequence number, so if the ring has since wrapped around and the audio's been overwritten, that's noticed instead of
+# reading whatever is there now. Consumers get a copy of the audio, and the header is checked again once it's copied,
+# since the producer could wrap around and start writing over it mid-copy. Nothing points into the ring afterwards.
+default_shared_audio_path = pathlib.Path("/dev/shm/bloob/shared_audio")
+default_ring_size = 16 * 1024 * 1024 # About 8 minutes of 16KHz 16-bit mono audio
+
+entry_header = struct.Struct("!QI4x")
+descriptor_header = struct.Struct("!QII")
+
+## The ID of this boot of this machine, which only a producer and consumer on the same machine will share. Returns
+## None where that can't be found (non-Linux systems), in which case shared audio is never used.
+def sharedAudioHostId():
+  try:
+    with open("/proc/sys/kernel/random/boot_id", "r") as boot_id_file:
+      return boot_id_file.read().strip()
+  except OSError:
+    return None
+
+class SharedAudioRing:
+  def __init__(self, name: str, size: int=default_ring_size, path: pathlib.Path=default_shared_audio_path):
+    self.name = name
+    self.size = size
+    path.mkdir(parents=True, exist_ok=True)
+
+    ring_fd = os.open(path.joinpath(name), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+      os.ftruncate(ring_fd, size)
+      self.ring = mmap.mmap(ring_fd, size)
+    finally:
+      os.close(ring_fd)
+
+    # Start from the time so that a restarted producer doesn't reuse sequence numbers a consumer could still have
+    self.sequence = time.time_ns()
+    self.offset = 0
+    self._lock = threading.Lock()
+
+  ## Copies audio into the ring, returning the descriptor to send instead of it.
+  ## Raises ValueError if the audio can't fit in the ring at all.
+  def write(self, audio) -> bytes:
+    audio_length = len(audio)
+    entry_length = entry_header.size + audio_length
+    if entry_length > self.size:
+      raise ValueError(f"{audio_length} bytes of audio doesn't fit in the {self.size} byte shared audio ring")
+
+    with self._lock:
+      if self.offset + entry_length > self.size:
+        self.offset = 0
+      self.sequence += 1
+      entry_header.pack_into(self.ring, self.offset, self.sequence, audio_length)
+      self.ring[self.offset + entry_header.size:self.offset + entry_length] = audio
+      descriptor = descriptor_header.pack(self.sequence, self.offset, audio_length) + self.name.encode()
+      self.offset += entry_length
+    return descriptor
+
+  def close(self):
+    self.ring.close()
+
+# Ring name -> mmap, so consumers open each producer's ring once
+_opened_rings = {}
+_opened_rings_lock = threading.Lock()
+
+## Returns a copy (as bytes) of the audio a descriptor points to, which the caller owns.
+## Raises ValueError if the descriptor's broken, the ring can't be opened, or the audio was overwritten before or while it was copied.
+def readSharedAudio(descriptor, path: pathlib.Path=default_shared_audio_path):
+  if len(descriptor) < descriptor_header.size:
+    raise ValueError(f"Shared audio descriptor is {len(descriptor)} bytes, shorter than its {descriptor_header.size} byte header")
+  sequence, offset, audio_length = descriptor_header.unpack_from(descriptor)
+  name = bytes(descriptor[descriptor_header.size:]).decode()
+  if "/" in name:
+    raise ValueError(f"Invalid shared audio ring name \"{name}\"")
+
+  with _opened_rings_lock:
+    ring = _opened_rings.get(name)
+    if ring == None:
+      try:
+        with open(path.joinpath(name), "rb") as ring_file:
+          ring = mmap.mmap(ring_file.fileno(), 0, access=mmap.ACCESS_READ)
+      except (OSError, ValueError) as e:
+        raise ValueError(f"Couldn't open shared audio ring \"{name}\": {repr(e)}")
+      _opened_rings[name] = ring
+
+  if offset + entry_header.size + audio_length > len(ring):
+    raise ValueError("Shared audio descriptor points past the end of its ring")
+  if entry_header.unpack_from(ring, offset) != (sequence, audio_length):
+    raise ValueError("Shared audio was overwritten before it was read")
+  audio = ring[offset + entry_header.size:offset + entry_header.size + audio_length]
+  # The producer writes an entry's header before its audio, so anything written over ours mid-copy changed this too
+  if entry_header.unpack_from(ring, offset) != (sequence, audio_length):
+    raise ValueError("Shared audio was overwritten while it was read")
+  return audio
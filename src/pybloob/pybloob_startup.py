@@ -0,0 +1,75 @@
+#!/bin/env python3
+""" Shows where each Core's startup time went (see pybloob.StartupProfiler), as published to bloob/<device_id>/startup/+
+
+Run with: python src/pybloob/pybloob_startup.py --device-id test
+
+With --run, instead runs that Core, timing every module it imports, so its breakdown also lists the slowest imports:
+python src/pybloob/pybloob_startup.py --device-id test --run src/utils/stt/stt_util_bb_core.py
+"""
+import argparse
+import builtins
+import pathlib
+import runpy
+import sys
+import threading
+import time
+
+## Times each import statement that loads a new module, recording it in import_times (name -> seconds). Modules
+## imported while importing another count towards that one, rather than being listed themselves.
+def timeImports(import_times: dict):
+  original_import = builtins.__import__
+  importing = threading.local()
+
+  def timedImport(name, globals=None, locals=None, fromlist=(), level=0):
+    if level != 0 or name in sys.modules or getattr(importing, "depth", 0) > 0:
+      return original_import(name, globals, locals, fromlist, level)
+    importing.depth = 1
+    import_start = time.perf_counter()
+    try:
+      return original_import(name, globals, locals, fromlist, level)
+    finally:
+      importing.depth = 0
+      import_times[name] = import_times.get(name, 0) + time.perf_counter() - import_start
+
+  builtins.__import__ = timedImport
+
+if __name__ == "__main__":
+  arg_parser = argparse.ArgumentParser()
+  arg_parser.add_argument('--host', default="localhost")
+  arg_parser.add_argument('--port', default=1883, type=int)
+  arg_parser.add_argument('--user')
+  arg_parser.add_argument('--pass')
+  arg_parser.add_argument('--device-id', default="test")
+  arg_parser.add_argument('--run', help="Path of a Core to run, timing its imports")
+  arguments = arg_parser.parse_args()
+
+  pybloob_import_start = time.perf_counter()
+  import pybloob
+  pybloob_import_time = time.perf_counter() - pybloob_import_start
+
+  if arguments.run != None:
+    pybloob.import_times["pybloob"] = pybloob_import_time
+    timeImports(pybloob.import_times)
+    core_path = pathlib.Path(arguments.run).absolute()
+    sys.argv = [str(core_path), "--device-id", arguments.device_id, "--host", arguments.host, "--port", str(arguments.port)]
+    if arguments.user != None:
+      sys.argv += ["--user", arguments.user, "--pass", arguments.__dict__.get("pass")]
+    sys.path.insert(0, str(core_path.parent))
+    runpy.run_path(str(core_path), run_name="__main__")
+    sys.exit()
+
+  def printReport(client, userdata, message):
+    try:
+      report = pybloob.decodeJson(message.payload)
+      print(f"[{report['core_id']}] {pybloob.formatStartupReport(report)}")
+    except (ValueError, KeyError, TypeError):
+      pass
+
+  client = pybloob.createMqttClient()
+  if arguments.user != None:
+    client.username_pw_set(arguments.user, arguments.__dict__.get("pass"))
+  client.on_message = printReport
+  client.connect(arguments.host, arguments.port)
+  client.subscribe(f"bloob/{arguments.device_id}/startup/+", pybloob.bloobQOS)
+  print(f"Showing startup breakdowns from bloob/{arguments.device_id}/startup/+")
+  client.loop_forever()
@@ -0,0 +1,103 @@
+#!/bin/env python3
+""" Collects the spans published to bloob/<device_id>/traces into a timeline of each request
+
+Run with: python src/pybloob/pybloob_tracing.py --device-id test
+"""
+import threading
+import time
+
+import pybloob
+
+class TraceCollector:
+  ## A request's timeline is complete once settle_time seconds pass without any new spans for it
+  def __init__(self, settle_time: float=3):
+    self.settle_time = settle_time
+    self.spans = {}
+    self.last_span_times = {}
+    self._lock = threading.Lock()
+
+  def add(self, span: dict):
+    if span.get("id") == None:
+      return
+    with self._lock:
+      self.spans.setdefault(span["id"], []).append(span)
+      self.last_span_times[span["id"]] = time.monotonic()
+
+  ## For use as a paho-mqtt message callback
+  def onMessage(self, client, userdata, message):
+    try:
+      self.add(pybloob.decodeJson(message.payload))
+    except (ValueError, AttributeError):
+      pass
+
+  ## Returns the timeline of a request: every span (with times in seconds from the start of the request, which is when
+  ## the wakeword was detected, going by the orchestrator's "wakeword" span), along with
+  ## time_to_transcript, core_time, tts_time and time_to_first_audio (the first audio played after the TTS first
+  ## finished, which with a streamed output is the first part's speech), which are None if the request didn't get that far
+  def timeline(self, request_id: str):
+    with self._lock:
+      spans = sorted(self.spans.get(request_id, []), key=lambda span: span["start"])
+    if len(spans) == 0:
+      return None
+
+    origin = spans[0]["start"]
+    timeline = {
+      "id": request_id,
+      "spans": [{**span, "offset": span["start"] - origin, "duration": span["end"] - span["start"]} for span in spans],
+      "total_time": max(span["end"] for span in spans) - origin,
+    }
+    spans_by_name = {}
+    for span in spans:
+      spans_by_name.setdefault(span["name"], []).append(span)
+
+    timeline["time_to_transcript"] = spans_by_name["transcribe"][-1]["end"] - origin if "transcribe" in spans_by_name else None
+    timeline["core_time"] = sum(span["end"] - span["start"] for span in spans_by_name.get("core", [])) if "core" in spans_by_name else None
+    timeline["tts_time"] = sum(span["end"] - span["start"] for span in spans_by_name.get("tts", [])) if "tts" in spans_by_name else None
+
+    timeline["time_to_first_audio"] = None
+    if "tts" in spans_by_name:
+      # Playback that ended before any speech was ready is the listening chimes
+      first_tts_end = min(span["end"] for span in spans_by_name["tts"])
+      answer_playbacks = [span for span in spans_by_name.get("playback", []) if span["end"] >= first_tts_end]
+      if len(answer_playbacks) > 0:
+        timeline["time_to_first_audio"] = min(span["end"] for span in answer_playbacks) - origin
+    return timeline
+
+  ## Returns (and forgets about) the timelines of requests that have settled
+  def completed(self):
+    now = time.monotonic()
+    with self._lock:
+      settled_ids = [request_id for request_id, last_span_time in self.last_span_times.items() if now - last_span_time >= self.settle_time]
+    timelines = [self.timeline(request_id) for request_id in settled_ids]
+    with self._lock:
+      for request_id in settled_ids:
+        self.spans.pop(request_id, None)
+        self.last_span_times.pop(request_id, None)
+    return timelines
+
+def formatTimeline(timeline: dict):
+  lines = [f"Request {timeline['id']} ({timeline['total_time'] * 1000:.0f} ms)"]
+  for span in timeline["spans"]:
+    lines.append(f"  {span['offset'] * 1000:8.0f} ms  +{span['duration'] * 1000:7.0f} ms  {span['core_id']}: {span['name']}")
+  for measurement in ["time_to_transcript", "core_time", "tts_time", "time_to_first_audio"]:
+    if timeline[measurement] != None:
+      lines.append(f"  {measurement}: {timeline[measurement] * 1000:.0f} ms")
+  return "\n".join(lines)
+
+if __name__ == "__main__":
+  arguments = pybloob.coreArgParse()
+  collector = TraceCollector()
+
+  client = pybloob.createMqttClient()
+  if arguments.user != None:
+    client.username_pw_set(arguments.user, arguments.__dict__.get("pass"))
+  client.on_message = collector.onMessage
+  client.connect(arguments.host, arguments.port)
+  client.subscribe(f"bloob/{arguments.device_id}/traces", pybloob.bloobQOS)
+  client.loop_start()
+
+  print(f"Collecting traces from bloob/{arguments.device_id}/traces")
+  while True:
+    time.sleep(0.5)
+    for timeline in collector.completed():
+      print(formatTimeline(timeline))
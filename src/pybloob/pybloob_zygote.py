@@ -0,0 +1,207 @@
+#!/bin/env python3
+""" Starts Python Cores by forking them from one process that has already imported the modules they all use (pybloob,
+paho, requests, numpy and so on), rather than each starting a fresh interpreter and importing everything again. The
+Cores start sooner, and share the memory those modules take up (copy-on-write) instead of each having its own copy.
+
+Run with: python src/pybloob/pybloob_zygote.py --device-id test src/cores/calc/calc_bb_core.py src/utils/stt/stt_util_bb_core.py
+(or set the Orchestrator's "preload_python_cores" to have it do this for you)
+
+With --measure, waits for each Core to register (publish its Core Config or audio capabilities), then prints how long
+that took and how much memory each Core is using, and stops them. Add --cold to start them the usual way instead, to
+compare against.
+"""
+import argparse
+import atexit
+import gc
+import importlib
+import os
+import pathlib
+import runpy
+import signal
+import subprocess
+import sys
+import time
+import traceback
+
+from pybloob_memory import memoryUsage
+
+# Imported before forking, where they're installed
+preloaded_modules = ["pybloob", "pybloob_async", "paho.mqtt.client", "paho.mqtt.publish", "paho.mqtt.subscribe", "aiomqtt", "requests", "numpy"]
+
+## Imports every module in modules that's installed, returning the ones that were
+def preload(modules: list=preloaded_modules):
+  loaded_modules = []
+  for module_name in modules:
+    try:
+      importlib.import_module(module_name)
+      loaded_modules.append(module_name)
+    except ImportError:
+      pass
+  # Objects that exist now are never freed, so stop the garbage collector touching (and so copying) their memory
+  gc.freeze()
+  return loaded_modules
+
+# Follows the naming convention where Cores are named {core_id}_bb_core
+def coreIdFromPath(core_path: pathlib.Path):
+  return core_path.name.split("_bb_core")[0]
+
+## Forks, and runs the Core at core_path in the child as if it had been run directly. Returns the child's pid.
+def forkCore(core_path: pathlib.Path, core_arguments: list, close_fds: list=[]):
+  pid = os.fork()
+  if pid != 0:
+    return pid
+
+  exit_code = 0
+  try:
+    # Undo what the zygote set up for itself
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    atexit._clear()
+    for fd in close_fds:
+      os.close(fd)
+    gc.unfreeze()
+    # The Core's startup time (see pybloob.StartupProfiler) counts from now, not from when the zygote started
+    if "pybloob" in sys.modules:
+      sys.modules["pybloob"].startup_origin = time.monotonic()
+
+    sys.argv = [str(core_path)] + core_arguments
+    # Where the Core would've been able to import from had it been run directly, plus wherever the zygote could
+    sys.path.insert(0, str(core_path.parent))
+    runpy.run_path(str(core_path), run_name="__main__")
+  except SystemExit as e:
+    exit_code = e.code if type(e.code) == int else (0 if e.code == None else 1)
+  except KeyboardInterrupt:
+    pass
+  except BaseException:
+    traceback.print_exc()
+    exit_code = 1
+  finally:
+    # Never return into the zygote's code. Run the Core's exit functions (like pybloob.Core.disconnect) ourselves, as
+    # os._exit skips them.
+    atexit._run_exitfuncs()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(exit_code)
+
+class Zygote:
+  def __init__(self, core_paths: list, core_arguments: list):
+    self.core_paths = [pathlib.Path(core_path).absolute() for core_path in core_paths]
+    self.core_arguments = core_arguments
+    # pid -> Core path
+    self.children = {}
+    self.start_times = {}
+
+  ## Starts every Core, forking them from this process unless cold, in which case they're run as new processes
+  def start(self, cold: bool=False, close_fds: list=[]):
+    for core_path in self.core_paths:
+      self.start_times[coreIdFromPath(core_path)] = time.monotonic()
+      if cold:
+        # Able to import the same things as a forked Core, like a pybloob that's next to this rather than installed
+        environment = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)), os.environ.get("PYTHONPATH")]))}
+        pid = subprocess.Popen([sys.executable, str(core_path)] + self.core_arguments, env=environment).pid
+      else:
+        pid = forkCore(core_path, self.core_arguments, close_fds)
+      self.children[pid] = core_path
+
+  ## Passes the signal on to every Core
+  def signalChildren(self, signal_number: int):
+    for pid in self.children:
+      try:
+        os.kill(pid, signal_number)
+      except ProcessLookupError:
+        pass
+
+  ## Waits for every Core to exit, logging each one that does
+  def wait(self):
+    while len(self.children) > 0:
+      try:
+        pid, status = os.wait()
+      except ChildProcessError:
+        break
+      except InterruptedError:
+        continue
+      core_path = self.children.pop(pid, None)
+      if core_path != None:
+        print(f"[core_zygote] {coreIdFromPath(core_path)} exited ({os.waitstatus_to_exitcode(status)})")
+
+  ## Waits (up to timeout seconds) for every Core to register, returning core_id -> seconds from starting it until then
+  def measure(self, monitor, timeout: float=120):
+    registration_times = {}
+    core_ids = [coreIdFromPath(core_path) for core_path in self.core_paths]
+
+    def onMessage(client, userdata, message):
+      # Retained messages are from earlier runs
+      if message.retain:
+        return
+      core_id = message.topic.split("/")[-2] if message.topic.endswith("/config") else message.topic.split("/")[-1]
+      if core_id in self.start_times and core_id not in registration_times:
+        registration_times[core_id] = time.monotonic() - self.start_times[core_id]
+
+    monitor.on_message = onMessage
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and not all(core_id in registration_times for core_id in core_ids):
+      monitor.loop(0.1)
+    return registration_times
+
+def formatMeasurements(zygote: Zygote, registration_times: dict):
+  lines = [f"{'Core':<24}{'Registered':>12}{'RSS':>12}{'PSS':>12}"]
+  total_pss = 0
+  for pid, core_path in zygote.children.items():
+    core_id = coreIdFromPath(core_path)
+    rss, pss = memoryUsage(pid)
+    total_pss += pss or 0
+    registration_time = f"{registration_times[core_id]:.2f} s" if core_id in registration_times else "never"
+    lines.append(f"{core_id:<24}{registration_time:>12}{(rss or 0) / 1048576:>9.1f} MB{(pss or 0) / 1048576:>9.1f} MB")
+  lines.append(f"Total PSS: {total_pss / 1048576:.1f} MB")
+  return "\n".join(lines)
+
+if __name__ == "__main__":
+  arg_parser = argparse.ArgumentParser()
+  arg_parser.add_argument('--host', default="localhost")
+  arg_parser.add_argument('--port', default=1883, type=int)
+  arg_parser.add_argument('--user')
+  arg_parser.add_argument('--pass')
+  arg_parser.add_argument('--device-id', default="test")
+  arg_parser.add_argument('--measure', action="store_true", help="Report how long each Core takes to register and how much memory it uses, then stop")
+  arg_parser.add_argument('--cold', action="store_true", help="Start the Cores as new processes, without preloading anything")
+  arg_parser.add_argument('--timeout', default=120, type=float, help="How long --measure waits for the Cores to register")
+  arg_parser.add_argument('cores', nargs="+", help="Paths of the Cores to start")
+  arguments = arg_parser.parse_args()
+
+  core_arguments = ["--device-id", arguments.device_id, "--host", arguments.host, "--port", str(arguments.port)]
+  if arguments.user != None:
+    core_arguments += ["--user", arguments.user, "--pass", arguments.__dict__.get("pass")]
+
+  if not arguments.cold:
+    preload_start = time.monotonic()
+    loaded_modules = preload()
+    print(f"[core_zygote] Preloaded {', '.join(loaded_modules)} in {time.monotonic() - preload_start:.2f} s")
+
+  zygote = Zygote(arguments.cores, core_arguments)
+
+  monitor = None
+  if arguments.measure:
+    import pybloob
+    # Connected and subscribed before the Cores start, without a network thread, as this process is about to fork
+    monitor = pybloob.createMqttClient()
+    if arguments.user != None:
+      monitor.username_pw_set(arguments.user, arguments.__dict__.get("pass"))
+    monitor.connect(arguments.host, arguments.port)
+    monitor.subscribe([(f"bloob/{arguments.device_id}/cores/+/config", 0), (f"bloob/{arguments.device_id}/audio_capabilities/+", 0)])
+    monitor.loop(1)
+
+  def stop(signal_number, frame):
+    zygote.signalChildren(signal.SIGINT)
+  signal.signal(signal.SIGINT, stop)
+  signal.signal(signal.SIGTERM, stop)
+
+  zygote.start(cold=arguments.cold, close_fds=[monitor.socket().fileno()] if monitor != None else [])
+
+  if arguments.measure:
+    registration_times = zygote.measure(monitor, arguments.timeout)
+    # Let anything the Cores do just after registering (like loading models) settle before measuring memory
+    time.sleep(2)
+    print(formatMeasurements(zygote, registration_times))
+    zygote.signalChildren(signal.SIGINT)
+
+  zygote.wait()
@@ -7,6 +7,7 @@ setup(
    author='Issac Dowling',
    author_email='contact@issacdowling.com',
    packages=find_packages(),
-   py_modules=["pybloob"],
-   install_requires=['paho-mqtt'], #external packages as dependencies
+   py_modules=["pybloob", "pybloob_async", "pybloob_shared_audio", "pybloob_opus", "pybloob_tracing", "pybloob_metrics", "pybloob_host", "pybloob_zygote", "pybloob_startup", "pybloob_rpc", "pybloob_http", "pybloob_profiling", "pybloob_memory", "pybloob_harness", "pybloob_corpus"],
+   install_requires=['paho-mqtt', 'aiomqtt'], #external packages as dependencies
+   extras_require={'opus': ['opuslib', 'numpy'], 'fast': ['orjson'], 'http': ['requests']}, # For compressing audio sent between devices, faster JSON messages, and pybloob.HttpClient
 )
\ No newline at end of file
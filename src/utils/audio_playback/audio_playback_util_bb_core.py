@@ -1,18 +1,19 @@
 #!/bin/env python3
 """ MQTT connected Audio playback program for Blueberry, making use of MPV
 
-Wishes to be provided with {"id", id: str, "audio": audio: str}, where audio is a WAV file, encoded as b64 bytes then decoded into a string, over MQTT to "bloob/{arguments.device_id}/cores/audio_playback_util/play_file"
+Wishes to be provided with a pybloob.AudioMessage (binary header + WAV or PCM audio), or the older {"id", id: str, "audio": audio: str} JSON, where audio is a WAV file, encoded as b64 bytes then decoded into a string, over MQTT to "bloob/{arguments.device_id}/cores/audio_playback_util/play_file"
 
 Will respond with {"id": received_id: str}. To "bloob/{arguments.device_id}/cores/audio_playback_util/finished"
 """
 import asyncio
 import aiomqtt
-import json
-import base64
 import pathlib
 import os
 import mpv
 import signal
+import collections
+import threading
+import time
 
 import paho.mqtt.publish as publish
 
@@ -28,8 +29,6 @@ last_audio_file_path = f"{audio_playback_temp_path}/last_played_audio.wav"
 if not os.path.exists(audio_playback_temp_path):
 	os.makedirs(audio_playback_temp_path)
 
-audio_playback_system = mpv.MPV()
-
 core_id = "audio_playback_util"
 
 arguments = pybloob.coreArgParse()
@@ -49,33 +48,82 @@ core_config = {
 }
 
 c.publishConfig(core_config)
+c.publishAudioCapabilities()
 
 c.log("Starting up...")
 
-def play(audio):
-	## Save last played audio to tmp for debugging
-	with open(last_audio_file_path,'wb+') as audio_file:
-		#Encoding is like this because the string must first be encoded back into the base64 bytes format, then decoded again, this time as b64, into the original bytes.
-		audio_file.write(base64.b64decode(audio.encode()))
+## "audio_output" picks MPV's audio output, like "null" to play to nowhere (for benchmarking without speakers)
+central_config = c.getCentralConfig()
+mpv_options = {}
+if "audio_output" in central_config:
+	mpv_options["ao"] = central_config["audio_output"]
+audio_playback_system = mpv.MPV(**mpv_options)
+
+# Audio for the request that's playing, so that more audio for it (like the next part of a streamed Core output) is
+# queued up after what's playing, while audio for any other request replaces it
+last_played_id = None
+parts_played = 0
+
+# (request id, when it was received) for each file loaded into MPV that it hasn't started on yet, oldest first, so the
+# "playback" span runs until the user actually starts hearing it. MPV starts files in the order they're loaded, and
+# drops any still queued when a file replaces them. starting is the file MPV's loading, until it starts playing.
+waiting_to_play = collections.deque()
+starting = None
+waiting_to_play_lock = threading.Lock()
+
+# These are run on MPV's event thread
+@audio_playback_system.event_callback("start-file")
+def startingFile(event):
+	global starting
+	with waiting_to_play_lock:
+		starting = waiting_to_play.popleft() if len(waiting_to_play) > 0 else None
+
+@audio_playback_system.event_callback("playback-restart")
+def startedPlaying(event):
+	global starting
+	with waiting_to_play_lock:
+		started, starting = starting, None
+	if started != None:
+		c.publishSpan(started[0], "playback", started[1], time.time())
+
+def play(audio_message):
+	global last_played_id, parts_played
+	received = time.time()
+	if audio_message.id == last_played_id:
+		parts_played += 1
+		mode = "append-play"
+	else:
+		last_played_id = audio_message.id
+		parts_played = 0
+		mode = "replace"
+
+	## Save last played audio to tmp for debugging, with each part in its own file, as earlier ones may still be queued
+	audio_file_path = last_audio_file_path if parts_played == 0 else f"{audio_playback_temp_path}/last_played_audio_{parts_played}.wav"
+	audio_message.writeWav(audio_file_path)
 
 	c.log("Playing received audio")
-	audio_playback_system.play(last_audio_file_path)
+	with waiting_to_play_lock:
+		if mode == "replace":
+			waiting_to_play.clear()
+		waiting_to_play.append((audio_message.id, received))
+	audio_playback_system.loadfile(audio_file_path, mode)
 
 async def connect():
 	
 	async with aiomqtt.Client(arguments.host) as client:
 		# await client.subscribe(f"bloob/{arguments.device_id}/audio_recorder/finished") # This is for testing, it'll automatically play what the TTS says
-		c.log("Waiting for input...")
+		c.log("Waiting for input...", pybloob.log_level_debug)
 		await client.subscribe(f"bloob/{arguments.device_id}/cores/audio_playback_util/play_file")
+		c.finishStartup()
 		async for message in client.messages:
 			try:
-				message_payload = json.loads(message.payload.decode())
-				if(message_payload.get('audio') != None and message_payload.get('id') != None):
-					play(message_payload["audio"])
+				audio_message = pybloob.AudioMessage.decode(message.payload)
+				# Its "playback" span is published once MPV starts playing it (see startedPlaying)
+				play(audio_message)
 
-					await client.publish(f"bloob/{arguments.device_id}/cores/audio_playback_util/finished", json.dumps({"id": message_payload.get('id')}), qos=1)
+				await client.publish(f"bloob/{arguments.device_id}/cores/audio_playback_util/finished", pybloob.PlaybackFinishedMessage(audio_message.id).encode(), qos=1)
 			except:
-				c.log("Error with payload.")
+				c.log("Error with payload.", pybloob.log_level_warning)
 
 if __name__ == "__main__":
 	try:
@@ -3,14 +3,12 @@
 
 Wishes to be provided with {"id": identifier_of_this_audio_recorder_request: str} over MQTT to "bloob/{arguments.device_id}/cores/audio_recorder_util/record_speech"
 
-Will respond with {"id": received_id: str, "audio": audio: str}, where audio is a WAV file, encoded as b64 bytes, then decoded into a string. To "bloob/{arguments.device_id}/cores/audio_recorder_util/finished"
+Will respond with a pybloob.AudioMessage (binary header + raw 16-bit PCM audio) with the received id. To "bloob/{arguments.device_id}/cores/audio_recorder_util/finished"
 """
-import json
-import base64
+import time
 import pathlib
 import os
-
-import paho.mqtt.publish as publish
+import queue
 
 default_temp_path = pathlib.Path("/dev/shm/bloob")
 audio_recorder_temp_path = default_temp_path.joinpath("audio_recorder")
@@ -49,7 +47,6 @@ c.log("Starting up...")
 recorded_audio_wav_path = str(audio_recorder_temp_path.joinpath("recorded_audio.wav"))
 
 import numpy as np
-import wave
 ## Set audio variables
 channels = 1 # Mono since stereo would be a waste of data
 sample_rate = 16000 # Also saves data, though it may be changed in the future
@@ -76,15 +73,19 @@ c.log(f"Found pipewire at index {mic_index}")
 c.log("Opening Mic")
 mic_stream = audio_recording_system.open(format=paInt16, channels=channels, rate=sample_rate, input=True, frames_per_buffer=frame_size, input_device_index=mic_index)
 
-import paho.mqtt.subscribe as mqtt_subscribe
-import paho.mqtt.publish as publish
+# Requests arrive over the Core's connection and wait here, so none are missed while the last one's being recorded
+record_requests = queue.Queue()
+c.subscribe(f"bloob/{arguments.device_id}/cores/audio_recorder_util/record_speech", lambda client, userdata, message: record_requests.put(message.payload))
 
+c.finishStartup()
 while True:
   try:
-    request_id = json.loads(mqtt_subscribe.simple(f"bloob/{arguments.device_id}/cores/audio_recorder_util/record_speech", hostname = arguments.host, port = arguments.port ).payload.decode())["id"]
+    request_id = pybloob.RecordSpeechMessage.decode(record_requests.get()).id
+    recording_start = time.time()
     speech_buffer = []
-  except json.decoder.JSONDecodeError:
-    c.log("Recieved invalid JSON")
+  except pybloob.MessageError as e:
+    c.log(f"Recieved an invalid request: {e}", pybloob.log_level_warning)
+    continue
   while True:
 
     ## Begin capturing audio
@@ -107,15 +108,11 @@ while True:
 
     c.log(f"Finished recording, saving audio to {recorded_audio_wav_path}")
 
-    with wave.open(recorded_audio_wav_path, 'wb') as wf:
-      wf.setnchannels(channels)
-      wf.setsampwidth(audio_recording_system.get_sample_size(paInt16))
-      wf.setframerate(sample_rate)
-      wf.writeframes(b''.join(speech_buffer))
-
-    with open(recorded_audio_wav_path, 'rb') as wf:
-      audio_to_send = base64.b64encode(wf.read()).decode()
+    recorded_audio = pybloob.AudioMessage(request_id, b''.join(speech_buffer), sample_rate, pybloob.audio_format_pcm, channels)
+    recorded_audio.writeWav(recorded_audio_wav_path)
 
     c.log("Saved audio")
-    publish.single(topic = f"bloob/{arguments.device_id}/cores/audio_recorder_util/finished", payload= json.dumps({"id": request_id, "audio" : audio_to_send}), hostname = c.mqtt_host, port = c.mqtt_port, auth=c.mqtt_auth, qos=pybloob.bloobQOS)
+    # The orchestrator passes this on to the STT, so if that's on this machine, the audio goes through shared memory
+    c.publishAudio(f"bloob/{arguments.device_id}/cores/audio_recorder_util/finished", recorded_audio, consumer="stt_util")
+    c.publishSpan(request_id, "record", recording_start, time.time(), {"audio_seconds": len(recorded_audio.audio) / (sample_rate * 2)})
     break
\ No newline at end of file
@@ -41,6 +41,7 @@ func main() {
 	flag.Parse()
 
 	c.DeviceId = *deviceId
+	c.Id = "intent_parser_util"
 	c.FriendlyName = friendlyName
 
 	//// Set up MQTT
@@ -75,6 +76,12 @@ func main() {
 	if token := client.Subscribe(fmt.Sprintf("bloob/%s/cores/+/intents/+", *deviceId), bloob.BloobQOS, intentHandler); token.Wait() && token.Error() != nil {
 		c.LogFatal(token.Error().Error())
 	}
+	if token := client.Subscribe(fmt.Sprintf("bloob/%s/cores/+/intent_bundle", *deviceId), bloob.BloobQOS, intentBundleHandler); token.Wait() && token.Error() != nil {
+		c.LogFatal(token.Error().Error())
+	}
+	if token := client.Subscribe(fmt.Sprintf("bloob/%s/cores/+/collection_bundle", *deviceId), bloob.BloobQOS, collectionBundleHandler); token.Wait() && token.Error() != nil {
+		c.LogFatal(token.Error().Error())
+	}
 	if token := client.Subscribe(fmt.Sprintf("bloob/%s/cores/intent_parser_util/run", *deviceId), bloob.BloobQOS, parseHandler); token.Wait() && token.Error() != nil {
 		c.LogFatal(token.Error().Error())
 	}
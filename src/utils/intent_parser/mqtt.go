@@ -3,6 +3,7 @@ package main
 import (
 	"encoding/json"
 	"fmt"
+	"time"
 
 	bloob "blueberry/gobloob"
 
@@ -17,6 +18,7 @@ const parseResponseTopic string = "bloob/%s/cores/intent_parser_util/finished"
 const instantIntentListTopic string = "bloob/%s/instant_intents"
 
 var parseHandler mqtt.MessageHandler = func(client mqtt.Client, message mqtt.Message) {
+	parseStart := time.Now()
 	var currentParse bloob.ParseRequest
 	err := json.Unmarshal(message.Payload(), &currentParse)
 	if err != nil {
@@ -33,11 +35,17 @@ var parseHandler mqtt.MessageHandler = func(client mqtt.Client, message mqtt.Mes
 		c.LogFatal(token.Error().Error())
 	}
 
+	c.PublishSpan(currentParse.Id, "intent_parse", parseStart, time.Now(), map[string]interface{}{"intent": intentParsed.IntentId})
+
 	c.Log(fmt.Sprintf("Intent: %s, Core: %s, Parsed Text: %s", intentParsed.IntentId, intentParsed.CoreId, intentParsed.ParsedText))
 
 }
 
 var collectionHandler mqtt.MessageHandler = func(client mqtt.Client, message mqtt.Message) {
+	// A blank retained message means the Collection was removed
+	if len(message.Payload()) == 0 {
+		return
+	}
 	var receivedCollection bloob.Collection
 	err := json.Unmarshal(message.Payload(), &receivedCollection)
 	if err != nil {
@@ -51,12 +59,103 @@ var collectionHandler mqtt.MessageHandler = func(client mqtt.Client, message mqt
 }
 
 var intentHandler mqtt.MessageHandler = func(client mqtt.Client, message mqtt.Message) {
+	if len(message.Payload()) == 0 {
+		return
+	}
 	var receivedIntent bloob.Intent
 	err := json.Unmarshal(message.Payload(), &receivedIntent)
 	if err != nil {
 		c.LogFatal(fmt.Sprintf("Failed to parse received intent: %s", err.Error()))
 	}
 	c.Log(fmt.Sprintf("Received intent \"%s\" for Core \"%s\"", receivedIntent.Id, receivedIntent.CoreId))
+	if registerIntent(receivedIntent) {
+		publishInstantIntents(client)
+	}
+}
+
+// Bundle topic -> version of the last bundle received on it, so a bundle that hasn't changed isn't processed again
+var bundleVersions map[string]string = make(map[string]string)
+
+// Bundle topic -> IDs of the Intents / Collections its last bundle registered, so any left out of the next one (or
+// all of them, if the bundle is cleared) can be removed rather than lingering
+var bundleIntentIds map[string][]string = make(map[string][]string)
+var bundleCollectionIds map[string][]string = make(map[string][]string)
+
+var intentBundleHandler mqtt.MessageHandler = func(client mqtt.Client, message mqtt.Message) {
+	// A blank retained message means the bundle was removed, which is handled as an empty bundle
+	var receivedBundle bloob.IntentBundle
+	if len(message.Payload()) != 0 {
+		err := json.Unmarshal(message.Payload(), &receivedBundle)
+		if err != nil {
+			c.LogFatal(fmt.Sprintf("Failed to parse received intent bundle: %s", err.Error()))
+		}
+	}
+	if version, ok := bundleVersions[message.Topic()]; ok && version == receivedBundle.Version {
+		return
+	}
+	bundleVersions[message.Topic()] = receivedBundle.Version
+
+	c.Log(fmt.Sprintf("Received bundle of %d intents (version %s)", len(receivedBundle.Intents), receivedBundle.Version))
+	instantIntentsChanged := false
+	receivedIds := make(map[string]bool)
+	for _, receivedIntent := range receivedBundle.Intents {
+		receivedIds[receivedIntent.Id] = true
+		// Registered afresh, so wakewords the Intent no longer has don't stay behind
+		if removeInstantIntents(receivedIntent.Id) {
+			instantIntentsChanged = true
+		}
+		if registerIntent(receivedIntent) {
+			instantIntentsChanged = true
+		}
+	}
+	for _, intentId := range bundleIntentIds[message.Topic()] {
+		if !receivedIds[intentId] && unregisterIntent(intentId) {
+			instantIntentsChanged = true
+		}
+	}
+	bundleIntentIds[message.Topic()] = mapKeys(receivedIds)
+	if instantIntentsChanged {
+		publishInstantIntents(client)
+	}
+}
+
+var collectionBundleHandler mqtt.MessageHandler = func(client mqtt.Client, message mqtt.Message) {
+	var receivedBundle bloob.CollectionBundle
+	if len(message.Payload()) != 0 {
+		err := json.Unmarshal(message.Payload(), &receivedBundle)
+		if err != nil {
+			c.LogFatal(fmt.Sprintf("Failed to parse received collection bundle: %s", err.Error()))
+		}
+	}
+	if version, ok := bundleVersions[message.Topic()]; ok && version == receivedBundle.Version {
+		return
+	}
+	bundleVersions[message.Topic()] = receivedBundle.Version
+
+	c.Log(fmt.Sprintf("Received bundle of %d collections (version %s)", len(receivedBundle.Collections), receivedBundle.Version))
+	receivedIds := make(map[string]bool)
+	for _, receivedCollection := range receivedBundle.Collections {
+		receivedIds[receivedCollection.Id] = true
+		collections[receivedCollection.Id] = receivedCollection
+	}
+	for _, collectionId := range bundleCollectionIds[message.Topic()] {
+		if !receivedIds[collectionId] {
+			delete(collections, collectionId)
+		}
+	}
+	bundleCollectionIds[message.Topic()] = mapKeys(receivedIds)
+}
+
+func mapKeys(items map[string]bool) []string {
+	keys := make([]string, 0, len(items))
+	for key := range items {
+		keys = append(keys, key)
+	}
+	return keys
+}
+
+// Stores an Intent, returning whether it had wakewords that were added to the Instant Intents
+func registerIntent(receivedIntent bloob.Intent) bool {
 	intents[receivedIntent.Id] = receivedIntent
 
 	// if there are wakewords associated with an Intent, register those
@@ -64,10 +163,33 @@ var intentHandler mqtt.MessageHandler = func(client mqtt.Client, message mqtt.Me
 		for _, wakeword := range receivedIntent.Wakewords {
 			instantIntents[wakeword] = receivedIntent
 		}
-		instantIntentListJson, err := json.Marshal(instantIntents)
-		if err != nil {
-			c.LogFatal(fmt.Sprintf("Failed to encode the list of Instant Intents: %s", err.Error()))
+		return true
+	}
+	return false
+}
+
+// Removes an Intent, returning whether it had wakewords that were removed from the Instant Intents
+func unregisterIntent(intentId string) bool {
+	delete(intents, intentId)
+	return removeInstantIntents(intentId)
+}
+
+// Removes the Instant Intents registered by an Intent, returning whether there were any
+func removeInstantIntents(intentId string) bool {
+	removed := false
+	for wakeword, instantIntent := range instantIntents {
+		if instantIntent.Id == intentId {
+			delete(instantIntents, wakeword)
+			removed = true
 		}
-		client.Publish(fmt.Sprintf(instantIntentListTopic, *deviceId), bloob.BloobQOS, true, instantIntentListJson)
 	}
+	return removed
+}
+
+func publishInstantIntents(client mqtt.Client) {
+	instantIntentListJson, err := json.Marshal(instantIntents)
+	if err != nil {
+		c.LogFatal(fmt.Sprintf("Failed to encode the list of Instant Intents: %s", err.Error()))
+	}
+	client.Publish(fmt.Sprintf(instantIntentListTopic, *deviceId), bloob.BloobQOS, true, instantIntentListJson)
 }
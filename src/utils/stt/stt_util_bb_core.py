@@ -1,18 +1,15 @@
 #!/bin/env python3
 """ MQTT connected STT engine for Blueberry, making use of OpenAI Whisper, through faster-whisper
 
-Wishes to be provided with {"id": identifier_of_this_tts_request: str, "audio": text_to_speak: str}, where audio is a WAV file, encoded as b64 bytes, then decoded into a string, over MQTT to "bloob/{arguments.device_id}/cores/stt_util/transcribe"
+Wishes to be provided with a pybloob.AudioMessage (binary header + WAV or PCM audio), or the older {"id": identifier_of_this_tts_request: str, "audio": text_to_speak: str} JSON, where audio is a WAV file, encoded as b64 bytes, then decoded into a string, over MQTT to "bloob/{arguments.device_id}/cores/stt_util/transcribe"
 
 Will respond with {"id", id: str, "text": transcript} to "bloob/{arguments.device_id}/cores/stt_util/finished"
 """
-import paho.mqtt.client as mqtt
-import json
-import base64
+import time
+import io
 import pathlib
 import os
 
-import paho.mqtt.subscribe as subscribe
-import paho.mqtt.publish as publish
 
 default_temp_path = pathlib.Path("/dev/shm/bloob")
 stt_temp_path = default_temp_path.joinpath("stt")
@@ -25,7 +22,6 @@ default_stt_path = default_data_path.joinpath("stt")
 if not os.path.exists(default_stt_path):
   os.makedirs(default_stt_path, exist_ok=True)
 
-transcribed_audio_path = stt_temp_path.joinpath("transcribed_audio.wav")
 
 if not os.path.exists(stt_temp_path):
   os.makedirs(stt_temp_path)
@@ -49,6 +45,7 @@ core_config = {
 }
 
 c.publishConfig(core_config)
+c.publishAudioCapabilities()
 
 c.log("Starting up...")
 
@@ -59,6 +56,8 @@ central_config = c.getCentralConfig()
 
 if central_config["mode"] == "local":
   c.log("Running STT locally")
+  model_load_start = time.monotonic()
+  model_rss_start = c.memory.rss()
   # Dynamic import so this isn't necessary to install on machines running this remotely
   from faster_whisper import WhisperModel
 
@@ -77,63 +76,102 @@ if central_config["mode"] == "local":
     model = WhisperModel(model_size_or_path=central_config['model'], device="cpu", download_root=default_stt_path)
 
   c.log(f"Loaded Model: {central_config['model']}")
+  c.startup.add("model_load", model_load_start, time.monotonic())
+  c.memory.addModel("whisper", model_rss_start)
 elif central_config["mode"].startswith("remote"):
   c.log(f"Using remote STT services from the device \"{central_config['mode'].split(':')[1]}\"")
+  # To find out whether the remote STT can take Opus compressed audio
+  c.watchAudioCapabilities(central_config['mode'].split(':')[1])
 
-def transcribe(audio): 
-  # TODO: Send audio to STT directly rather than using a file for it. Still record audio to /dev/shm for option to replay
+# How long inference takes compared to the length of the audio, where under 1 is faster than real time
+real_time_factor_buckets = [0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 5]
+
+def transcribe(audio_message):
   # TODO: Figure out why large models (distil and normal) cause this to significantly slow down, where any other model does it instantly
   # across significantly different tiers of hardware
 
   c.log("Transcribing...")
 
+  # 16KHz mono PCM or Opus (what the recorder sends) can go straight to Whisper as an array without a file, anything
+  # else is handed over as a WAV for it to decode and resample
+  if audio_message.format in [pybloob.audio_format_pcm, pybloob.audio_format_opus] and audio_message.sample_rate == 16000 and audio_message.channels == 1:
+    audio = audio_message.asFloat32()
+  else:
+    audio = io.BytesIO(audio_message.asWav())
+
   raw_spoken_words = ""
+  inference_start = time.perf_counter()
   segments, info = model.transcribe(audio, beam_size=5, condition_on_previous_text=False) #condition_on_previous_text=False reduces hallucinations and inference time with no downsides for our short text
   for segment in segments:
     raw_spoken_words += segment.text
+  inference_time = time.perf_counter() - inference_start
   c.log(f"Transcribed words: {raw_spoken_words}")
 
+  c.metrics.histogram("stt_inference_seconds").observe(inference_time)
+  if info.duration > 0:
+    c.metrics.histogram("stt_real_time_factor", buckets=real_time_factor_buckets).observe(inference_time / info.duration)
+
   return raw_spoken_words
 
-def remote_transcribe(message_json: dict):
+def remote_transcribe(audio_message):
   remote_stt_device = central_config["mode"].split(":")[1]
+  # Audio that came through shared memory gets put back in the message, since the remote device can't read it, and is
+  # Opus compressed if the remote STT can take that
+  payload = c.encodeAudio(audio_message, consumer=core_id, consumer_device=remote_stt_device)
   remote_stt_publish = f"bloob/{remote_stt_device}/cores/stt_util/transcribe"
   remote_stt_subscribe = f"bloob/{remote_stt_device}/cores/stt_util/finished"
-  publish.single(remote_stt_publish, json.dumps(message_json), hostname=c.mqtt_host, port=c.mqtt_port, auth=c.mqtt_auth)
+  # If the remote STT drops the request (like when it's too busy), that's passed on straight away, rather than waiting out the timeout
+  remote_stt_dropped = f"bloob/{remote_stt_device}/cores/stt_util/dropped"
+
+  # Replies to other requests the remote STT is dealing with are ignored, as they won't have this request's id
+  # No point waiting past the request's deadline
+  timeout = central_config.get("remote_timeout", 30)
+  if audio_message.deadline != None:
+    timeout = max(min(timeout, audio_message.deadline - time.time()), 0)
+  c.log(f"Waiting for response from \"{remote_stt_device}\"'s remote STT")
+  try:
+    received_remote_tts = c.call(remote_stt_publish, payload, remote_stt_subscribe, audio_message.id, pybloob.TranscriptMessage.decode, timeout=timeout, dropped_topic=remote_stt_dropped).result()
+  except TimeoutError:
+    raise TimeoutError(f"\"{remote_stt_device}\"'s remote STT didn't respond within {timeout:.1f} s")
 
-  # This section to make sure it ignores other potential requests being dealt with by the remote STT
-  received_id = "?"
-  while received_id != message_json["id"]:
-    c.log(f"Waiting for response from \"{remote_stt_device}\"'s remote STT")
-    received_remote_tts = json.loads(subscribe.simple(remote_stt_subscribe, hostname=c.mqtt_host, port=c.mqtt_port, auth=c.mqtt_auth).payload)
-    received_id = received_remote_tts["id"]
+  c.log(f"Transcribed words: {received_remote_tts.text}")
 
-  c.log(f"Transcribed words: {received_remote_tts['text']}")
+  return received_remote_tts.text
 
-  return received_remote_tts["text"]
+# Requests are queued as they arrive and transcribed one at a time, skipping any that have passed their deadline or been
+# superseded by the time they're reached (and saying so, so the Orchestrator isn't left waiting on them)
+requests = pybloob.RequestQueue(max_size=central_config.get("max_queued", 8), metrics=c.metrics, log=c.log, on_drop=lambda request, reason: c.publishDropped(request.id, reason))
 
 def on_message(client, _, message):
   try:
-    c.log("Waiting for input...")
-    msg_json = json.loads(message.payload.decode())
-
-    if central_config["mode"] == "local":
-      with open(transcribed_audio_path,'wb+') as audio_file:
-        #Encoding is like this because the string must first be encoded back into the base64 bytes format, then decoded again, this time as b64, into the original bytes.
-        audio_file.write(base64.b64decode(msg_json["audio"].encode()))
-      transcription = transcribe(str(transcribed_audio_path))
-    elif central_config["mode"].startswith("remote"):
-      transcription = remote_transcribe(msg_json)
-  except KeyError:
-    c.log("Couldn't find the correct keys in recieved JSON")
-  c.log("Publishing output")
-  stt_mqtt.publish(f"bloob/{arguments.device_id}/cores/stt_util/finished", json.dumps({"id": msg_json["id"], "text": transcription}), qos=1)
-
-stt_mqtt = mqtt.Client()
-stt_mqtt.connect(arguments.host, arguments.port)
-stt_mqtt.on_message = on_message
+    audio_message = pybloob.AudioMessage.decode(message.payload)
+  except ValueError as e:
+    c.log(f"Couldn't read the received audio: {e}", pybloob.log_level_warning)
+    return
+  requests.put(audio_message)
 
-stt_mqtt.subscribe(f"bloob/{arguments.device_id}/cores/stt_util/transcribe")
+c.subscribe(f"bloob/{arguments.device_id}/cores/stt_util/transcribe", on_message)
+c.finishStartup()
 
+while True:
+  c.log("Waiting for input...", pybloob.log_level_debug)
+  audio_message = requests.get()
 
-stt_mqtt.loop_forever()
\ No newline at end of file
+  # A request that can't be transcribed (like the remote STT not answering, or the connection to it dropping) is dropped,
+  # rather than answered with an empty transcript
+  try:
+    with c.span(audio_message.id, "transcribe", mode=central_config["mode"]):
+      if central_config["mode"] == "local":
+        transcription = transcribe(audio_message)
+      elif central_config["mode"].startswith("remote"):
+        transcription = remote_transcribe(audio_message)
+  except pybloob.DroppedError as e:
+    c.log(f"The remote STT dropped request {audio_message.id} ({e.reason})", pybloob.log_level_warning)
+    requests.drop(audio_message, e.reason)
+    continue
+  except Exception as e:
+    c.log(f"Couldn't transcribe request {audio_message.id}: {repr(e)}", pybloob.log_level_error)
+    requests.drop(audio_message, "failed")
+    continue
+  c.log("Publishing output")
+  c.publish(f"bloob/{arguments.device_id}/cores/stt_util/finished", pybloob.TranscriptMessage(audio_message.id, transcription).encode())
@@ -3,21 +3,18 @@
 
 Wishes to be provided with {"id": identifier_of_this_tts_request: str, "text": text_to_speak: str} over MQTT to "bloob/{arguments.device_id}/cores/tts_util/run"
 
-Will respond with {"id": received_id: str, "audio": audio: str}, where audio is a WAV file, encoded as b64 bytes, then decoded into a string, to "bloob/{arguments.device_id}/cores/tts_util/finished"
+Will respond with a pybloob.AudioMessage (binary header + raw 16-bit PCM audio) with the received id, to "bloob/{arguments.device_id}/cores/tts_util/finished"
 """
 import subprocess
 import asyncio
+import threading
 import aiomqtt
 import sys
 import re
-import json
-import base64
+import time
 import pathlib
 import os
 
-from piper import download, PiperVoice
-import wave
-
 import paho.mqtt.subscribe as subscribe
 import paho.mqtt.publish as publish
 
@@ -64,10 +61,15 @@ if not os.path.exists(default_tts_path):
 
 tts_path = default_tts_path
 tts_model_path = f"{tts_path}/{central_config['model']}.onnx"
-output_audio_path = f"{tts_temp_path}/out.wav"
+
+model_load_start = time.monotonic()
+model_rss_start = c.memory.rss()
+# Imported only once the Central Config's arrived, so registering and getting the config aren't kept waiting on Piper
+from piper import PiperVoice
 
 if not os.path.exists(tts_model_path):
 	c.log(f"Couldn't find voice ({central_config['model']}) locally, trying to download it.")
+	from piper import download
 	try:
 		download.ensure_voice_exists(central_config['model'], [tts_path], tts_path, download.get_voices(tts_path))
 	except download.VoiceNotFoundError:
@@ -77,41 +79,57 @@ if not os.path.exists(tts_model_path):
 		c.log("Voice downloaded")
 
 voice = PiperVoice.load(tts_model_path)
+c.startup.add("model_load", model_load_start, time.monotonic())
+c.memory.addModel("piper", model_rss_start)
 
-def speak(text):
+# Returns the speech as an AudioMessage of raw 16-bit mono PCM, which goes straight into the published message
+def speak(text, id):
 	speech_text = re.sub(r"^\W+|\W+$",'', text)
 	c.log(f"Inputted text - {text} - sanitised into - {speech_text}. Generating speech.")
 
-	with wave.open(output_audio_path, 'wb') as speech_wav:
-		speech_wav.setsampwidth(2) # 2 bytes, 16-bit audio
-		speech_wav.setnchannels(1)
+	synthesis_start = time.perf_counter()
+	speech = pybloob.AudioMessage(id, b"".join(voice.synthesize_stream_raw(speech_text)), voice.config.sample_rate, pybloob.audio_format_pcm)
+	synthesis_time = time.perf_counter() - synthesis_start
 
-		speech_wav.setframerate(voice.config.sample_rate)
-
-		for frame in voice.synthesize_stream_raw(speech_text):
-			speech_wav.writeframes(frame)
+	c.metrics.histogram("tts_synthesis_seconds").observe(synthesis_time)
+	speech_seconds = len(speech.audio) / (2 * voice.config.sample_rate)
+	if speech_seconds > 0:
+		c.metrics.histogram("tts_real_time_factor", buckets=[0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 1.5, 2, 5]).observe(synthesis_time / speech_seconds)
 
 	c.log(f"Spoken: {speech_text}")
+	return speech
+
+# Requests are queued as they arrive and spoken one at a time by speakLoop, which has its own thread so synthesis doesn't
+# hold up receiving, skipping any that have passed their deadline or been superseded by the time they're reached (and
+# saying so, so the Orchestrator isn't left waiting on them)
+requests = pybloob.RequestQueue(max_size=central_config.get("max_queued", 8), metrics=c.metrics, log=c.log, on_drop=lambda request, reason: c.publishDropped(request.id, reason))
+
+def speakLoop():
+	while True:
+		request = requests.get()
+		# A request that can't be spoken is dropped (saying so, like the queue does), rather than ending this thread and
+		# leaving the TTS deaf to everything after it
+		try:
+			with c.span(request.id, "tts"):
+				speech = speak(request.text, request.id)
+			c.log(f"Publishing Output")
+			# The orchestrator passes this on to audio playback, so if that's on this machine, the audio goes through shared memory
+			c.publishAudio(f"bloob/{arguments.device_id}/cores/tts_util/finished", speech, qos=1, consumer="audio_playback_util")
+		except Exception as e:
+			c.log(f"Couldn't speak request {request.id}: {repr(e)}", pybloob.log_level_error)
+			requests.drop(request, "failed")
 
 async def connect():
 	async with aiomqtt.Client(hostname=arguments.host, port=arguments.port) as client:
-		c.log(f"Waiting for input...")
+		c.log("Waiting for input...", pybloob.log_level_debug)
 		await client.subscribe(f"bloob/{arguments.device_id}/cores/tts_util/run")
+		c.finishStartup()
 		async for message in client.messages:
 			try:
-				message_payload = json.loads(message.payload.decode())
-			except:
-				c.log("Error with payload.")
-
-			if(message_payload.get('text') != None and message_payload.get('id') != None):
-				speak(message_payload.get('text'))
-				# encode speech to base64
-				c.log(f"Writing to temp file ({output_audio_path})")
-				with open(output_audio_path, 'rb') as f:
-					encoded = base64.b64encode(f.read())
-					str_encoded = encoded.decode()
-					c.log(f"Publishing Output")
-				await client.publish(f"bloob/{arguments.device_id}/cores/tts_util/finished", json.dumps({"id": message_payload.get('id'), "audio":str_encoded}), qos=1)
+				requests.put(pybloob.SpeakMessage.decode(message.payload))
+			except pybloob.MessageError as e:
+				c.log(f"Error with payload: {e}", pybloob.log_level_warning)
 
 
+threading.Thread(target=speakLoop, daemon=True, name="speak").start()
 asyncio.run(connect())
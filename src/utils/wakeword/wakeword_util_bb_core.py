@@ -7,9 +7,9 @@ Will respond with {"wakeword_id": id_of_detected_wakeword: str, "confidence": co
 """
 import sys
 import json
+import time
 import pathlib
 import os
-import paho.mqtt.publish as publish
 
 default_temp_path = pathlib.Path("/dev/shm/bloob")
 ww_temp_path = default_temp_path.joinpath("ww")
@@ -70,6 +70,8 @@ if len(enabled_wakewords) == 0:
   exit()
 
 ## Load OpenWakeword #######################
+model_load_start = time.monotonic()
+model_rss_start = c.memory.rss()
 from openwakeword import Model
 from pyaudio import PyAudio, paInt16
 import numpy as np
@@ -97,6 +99,8 @@ except ValueError:
   from openwakeword import utils
   utils.download_models(["melspectrogram.tflite"])
   oww = Model(wakeword_models=enabled_wakewords, inference_framework = "tflite")
+c.startup.add("model_load", model_load_start, time.monotonic())
+c.memory.addModel("openwakeword", model_rss_start)
 
 speech_buffer = []
 
@@ -105,21 +109,28 @@ c.log("Opening Mic")
 mic_stream = audio_recording_system.open(format=paInt16, channels=channels, rate=sample_rate, input=True, frames_per_buffer=frame_size, input_device_index=mic_index)
 
 
+# Kept hold of here so the loop doesn't have to look it up every frame
+wakeword_inference_time = c.metrics.histogram("wakeword_inference_seconds", buckets=[0.001, 0.002, 0.005, 0.01, 0.02, 0.04, 0.08, 0.16])
+
 ## Detection loop
 c.log("Waiting for wakeword:")
+c.finishStartup()
 while True:
   speech_buffer = []
   ## Begin capturing audio
   current_frame = np.frombuffer(mic_stream.read(frame_size), dtype=np.int16)
 
   # Attempt detection: if fails, loop
+  inference_start = time.perf_counter()
   prediction = oww.predict(current_frame)
+  wakeword_inference_time.observe(time.perf_counter() - inference_start)
   for model_name in prediction.keys():
     confidence = prediction[model_name]
     ## Upon detection:
     if confidence >= 0.7:
+      c.metrics.counter("wakeword_detections_total", {"wakeword": model_name}).inc()
 
-      publish.single(topic = f"bloob/{arguments.device_id}/cores/wakeword_util/finished", payload = json.dumps({"wakeword_id": model_name, "confidence": str(prediction[model_name])}), hostname = arguments.host, port = arguments.port, auth=c.mqtt_auth, qos=pybloob.bloobQOS)
+      c.publish(f"bloob/{arguments.device_id}/cores/wakeword_util/finished", pybloob.WakewordMessage(model_name, str(prediction[model_name]), time.time()).encode())
       c.log(f"Wakeword Detected: {model_name}, with confidence of {prediction[model_name]}")
       ### Feeds silence for "4 seconds" to OpenWakeWord so that it doesn't lead to repeat activations
       ### See for yourself: https://github.com/dscripka/openWakeWord/issues/37